@@ -0,0 +1,80 @@
+"""This module adds up the flooded locations into totals per region and year.
+
+Each location of the elevation grid stands for the grid cell around it, so the flooded area of a
+region in a year is the total area of its flooded cells. Cell areas are computed on a sphere: a
+cell spanning latitudes lat1 to lat2 and dlon degrees of longitude has area
+    R^2 * radians(dlon) * (sin(lat2) - sin(lat1))
+which shrinks towards the poles. The exposure of a cell (such as its population or the value of
+its assets) can also be added up, from a raster of exposure per square kilometre sampled at the
+locations.
+
+All totals are computed at once with np.bincount, grouping the flooded cells by
+(region, year), so millions of cell-years take a fraction of a second.
+"""
+from typing import Dict, Optional, Tuple
+import numpy as np
+from elevation_sources import RasterElevationSource
+from flooding import FloodResult
+from spatial_index import EARTH_RADIUS
+from instrumentation import timed
+
+
+def cell_areas(latitudes: np.ndarray, cell_size: Tuple[float, float]) -> np.ndarray:
+    """Return the area in square kilometres of the grid cells centred on each of latitudes,
+    where cell_size is the (height, width) of a cell in degrees.
+
+    >>> round(float(cell_areas(np.array([0.0]), (1.0, 1.0))[0]), 1)
+    12364.2
+    """
+    height, width = cell_size
+    south = np.radians(np.clip(latitudes - height / 2, -90, 90))
+    north = np.radians(np.clip(latitudes + height / 2, -90, 90))
+    return EARTH_RADIUS ** 2 * np.radians(width) * (np.sin(north) - np.sin(south))
+
+
+def sample_exposure(coords: np.ndarray, raster: str) -> np.ndarray:
+    """Return the exposure per square kilometre at each (latitude, longitude) row of coords,
+    read from the raster file, with 0 where the raster has no data.
+    """
+    density = RasterElevationSource(raster).sample_array(coords[:, 0], coords[:, 1])
+    return np.nan_to_num(density, nan=0.0)
+
+
+@timed()
+def flooded_totals(result: FloodResult, regions: np.ndarray, region_count: int,
+                   cell_size: Tuple[float, float], exposure: Optional[np.ndarray] = None) \
+        -> Dict[str, np.ndarray]:
+    """Return the totals of the flooded cells of result in each region and year, as arrays with
+    one row per region and one column per year of result.years:
+        - 'cells': the number of flooded cells
+        - 'area': the flooded area, in square kilometres
+        - 'exposure': the total exposure of the flooded cells, if exposure is given
+
+    regions gives the region number of each location of result.coords (-1 for locations in no
+    region, which are left out), and exposure the exposure per square kilometre of each location.
+
+    >>> coords = np.array([[0.0, 0.0], [10.0, 0.0]])
+    >>> result = FloodResult.from_points(coords, np.array([0, 1, 1]), np.array([0, 0, 1]),
+    ...                                  np.array([1.0, 2.0, 3.0]), [2020, 2030])
+    >>> flooded_totals(result, np.array([0, 0]), 1, (1.0, 1.0))['cells'].tolist()
+    [[2.0, 1.0]]
+    """
+    year_count = len(result.years)
+    year_index = np.repeat(np.arange(year_count), np.diff(result.offsets))
+    point_regions = regions[result.point_index]
+    counted = point_regions >= 0
+
+    # the (region, year) group of every flooded cell
+    groups = point_regions[counted] * year_count + year_index[counted]
+    points = result.point_index[counted]
+    areas = cell_areas(result.coords[:, 0], cell_size)
+
+    def total(weights: Optional[np.ndarray]) -> np.ndarray:
+        return np.bincount(groups, weights, minlength=region_count * year_count)\
+            .astype(float).reshape(region_count, year_count)
+
+    totals = {'cells': total(None), 'area': total(areas[points])}
+    if exposure is not None:
+        totals['exposure'] = total((areas * exposure)[points])
+
+    return totals
@@ -1,15 +1,22 @@
 """This module uses the elevation API to get altitude of certain locations.
+
+The altitudes can also be read from a local elevation raster instead, using the sources in
+elevation_sources.py.
 """
-from typing import List, Tuple, Dict
-import requests
-from map_setup import MapArea, Midpoint
+from typing import List, Tuple, Dict, Optional
+import json
+import os
+from map_setup import MapArea, Midpoint, wrap_longitude
+from elevation_sources import ElevationSource, ApiElevationSource
+from instrumentation import timed, count
 
 
 def split_into_grid(n: int, m: int, my_map: MapArea) -> Tuple[List[float], List[float]]:
     """Return the location of the grid lines for a grid of size n * n.
 
     The output will be a tuple, whose first element is a list of latitude coords and the second
-    is a list of longitude coords.
+    is a list of longitude coords. If my_map crosses the antimeridian, the longitude coords keep
+    increasing past 180.
 
     Preconditions:
         - n >= 1
@@ -18,6 +25,8 @@ def split_into_grid(n: int, m: int, my_map: MapArea) -> Tuple[List[float], List[
     >>> map1 = MapArea((40.0, 84.0), (-146.0, -50.0))
     >>> split_into_grid(4, 4, map1)
     ([40.0, 51.0, 62.0, 73.0, 84.0], [-146.0, -122.0, -98.0, -74.0, -50.0])
+    >>> split_into_grid(1, 2, MapArea((40.0, 84.0), (170.0, -170.0)))[1]
+    [170.0, 180.0, 190.0]
     """
     # retrieve the latitude and longitude coordinates of the map
     latitude = my_map.latitude
@@ -28,8 +37,8 @@ def split_into_grid(n: int, m: int, my_map: MapArea) -> Tuple[List[float], List[
     long_so_far = [longitude[0]]
 
     # get the range of how many degrees latitude/longitude the map spans
-    latitude_range = abs(latitude[1] - latitude[0])
-    longitude_range = abs(longitude[1] - longitude[0])
+    latitude_range = latitude[1] - latitude[0]
+    longitude_range = my_map.longitude_span
 
     # the "step" is equivalent to the width of the grid squares
     latitude_step = latitude_range / n
@@ -46,7 +55,9 @@ def split_into_grid(n: int, m: int, my_map: MapArea) -> Tuple[List[float], List[
 
 def get_midpoints(grid: Tuple[List[float], List[float]], my_map: MapArea) -> List[Midpoint]:
     """Return the midpoints of the grid squares.
-    The grid input is the same as the format for the split_into_grid functions output.
+    The grid input is the same as the format for the split_into_grid functions output. The
+    longitudes of the midpoints are between -180 and 180, even if the grid crosses the
+    antimeridian.
 
     Preconditions:
         - grid[0] is a list of latitude coordinates
@@ -77,12 +88,13 @@ def get_midpoints(grid: Tuple[List[float], List[float]], my_map: MapArea) -> Lis
 
     # midpoint coordinates for longitudes
     for i in range(len(longitudes) - 1):
-        lon_mp = (longitudes[i] + longitudes[i + 1]) / 2
+        lon_mp = wrap_longitude((longitudes[i] + longitudes[i + 1]) / 2)
         lon_midpoints.append(lon_mp)
 
     return [Midpoint((lat, lon), my_map) for lat in lat_midpoints for lon in lon_midpoints]
 
 
+@timed()
 def get_altitude(mid_point: Midpoint) -> float:
     """Return the altitude of a give point, using Canada Gov elevation API.
     The tuple values should containt (latitude, longitude) in given order.
@@ -98,39 +110,261 @@ def get_altitude(mid_point: Midpoint) -> float:
     # coordinates of the midpoint
     latitude, longitude = mid_point.coords
 
-    # request urls are essentially the same each request
-    # but only with the lat and lon points having different values
-    begin = 'http://geogratis.gc.ca/services/elevation/cdem/altitude?'
-    # converts the latitude and longitude points into a string
-    lat = 'lat=' + str(latitude)
-    lon = 'lon=' + str(longitude)
-
-    # combines all elements to have the final url
-    url = begin + lat + '&' + lon
-
-    r = requests.get(url)  # sends a request to url and stores data in variable r
-    data = r.json()  # converts the json information into a python readable datatype (dictionary)
+    return ApiElevationSource().altitude(latitude, longitude)
 
-    return data['altitude']  # returns only the elevation variable from nested dictionary
 
-
-def get_altitude_data(my_map: MapArea) -> Dict[Tuple[float, float], float]:
+def get_altitude_data(my_map: MapArea, source: Optional[ElevationSource] = None,
+                      checkpoint: Optional[str] = None, batch_size: int = 100) \
+        -> Dict[Tuple[float, float], float]:
     """Return a dictionary with a tuple containing (latitude, longitude) mapping to the altitude of
     that point.
 
-    The grid size for the data will be fixed at 50*50.
+    The grid size for the data will be fixed at 50*50. The altitudes are read from source, which
+    is the Canada Gov elevation API by default.
+
+    If checkpoint is given, the altitudes are fetched batch_size points at a time and every batch
+    is saved to the checkpoint file as soon as it is fetched. If the function is interrupted, the
+    next call with the same checkpoint only fetches the points that are not in the file yet.
+
+    Preconditions:
+        - batch_size >= 1
     """
+    if source is None:
+        source = ApiElevationSource()
+
     # get grid and midpoints
     grid = split_into_grid(50, 50, my_map)
     midpoints = get_midpoints(grid, my_map)
+    points = [point.coords for point in midpoints]
+
+    # ACCUMULATOR: keeps track of the altitude of every fetched point, including None
+    fetched = {}
+
+    if checkpoint is None:
+        fetched.update(zip(points, source.sample(points)))
+    else:
+        fetched.update(_read_checkpoint(checkpoint, my_map))
+        count('cache_hits', len(fetched))
+        remaining = [point for point in points if point not in fetched]
+
+        for i in range(0, len(remaining), batch_size):
+            batch = remaining[i:i + batch_size]
+            altitudes = source.sample(batch)
+            _append_checkpoint(checkpoint, my_map, list(zip(batch, altitudes)))
+            fetched.update(zip(batch, altitudes))
+
+    # if the point lies outside Canada, altitude is None
+    return {point: fetched[point] for point in points if fetched[point] is not None}
+
+
+def remaining_points(my_map: MapArea, checkpoint: str) -> List[Tuple[float, float]]:
+    """Return the points of the 50*50 grid of my_map that have not been saved to the checkpoint
+    file by get_altitude_data yet.
+    """
+    grid = split_into_grid(50, 50, my_map)
+    fetched = _read_checkpoint(checkpoint, my_map)
+
+    return [point.coords for point in get_midpoints(grid, my_map) if point.coords not in fetched]
+
+
+def _read_checkpoint(checkpoint: str, my_map: MapArea) \
+        -> Dict[Tuple[float, float], Optional[float]]:
+    """Return the altitudes saved in the checkpoint file, or an empty dictionary if there is no
+    such file or its header was not completely written.
+
+    The first line of the file records the map it was made for, and each line after it is one
+    batch of [latitude, longitude, altitude] points. A line cut off by a crash is ignored.
+    """
+    header = _read_header(checkpoint)
+    if header is None:
+        return {}
+    if header != _checkpoint_header(my_map):
+        raise ValueError('Checkpoint ' + checkpoint + ' was made for a different map')
+
+    # ACCUMULATOR: keeps track of dictionary mapping location to altitude
+    fetched = {}
+
+    with open(checkpoint) as f:
+        f.readline()  # the header
+        for line in f:
+            try:
+                batch = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # this batch was not completely written
+
+            for lat, lon, altitude in batch:
+                fetched[(lat, lon)] = altitude
+
+    return fetched
+
+
+def _append_checkpoint(checkpoint: str, my_map: MapArea,
+                       batch: List[Tuple[Tuple[float, float], Optional[float]]]) -> None:
+    """Save a batch of fetched altitudes to the end of the checkpoint file, creating it if needed.
+    A file whose header was not completely written is started again.
+    """
+    new_file = _read_header(checkpoint) is None
+
+    with open(checkpoint, 'w' if new_file else 'a+') as f:
+        if new_file:
+            f.write(json.dumps(_checkpoint_header(my_map)) + '\n')
+        else:
+            # start a new line if the previous run crashed in the middle of writing one
+            end = f.seek(0, os.SEEK_END)
+            f.seek(end - 1)
+            if f.read(1) != '\n':
+                f.write('\n')
+        f.write(json.dumps([[point[0], point[1], altitude] for point, altitude in batch]) + '\n')
+
+        # make sure the batch is on disk before fetching the next one
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _read_header(checkpoint: str) -> Optional[Dict[str, list]]:
+    """Return the header of the checkpoint file, or None if there is no such file or its header
+    was not completely written (for example, if the file is empty).
+    """
+    if not os.path.exists(checkpoint):
+        return None
+
+    with open(checkpoint) as f:
+        line = f.readline()
+
+    try:
+        return json.loads(line) if line.endswith('\n') else None
+    except json.JSONDecodeError:
+        return None
+
+
+def _checkpoint_header(my_map: MapArea) -> Dict[str, list]:
+    """Return the first line of a checkpoint file for my_map.
+    """
+    return {'latitude': list(my_map.latitude), 'longitude': list(my_map.longitude), 'grid': 50}
+
+
+def get_altitude_data_adaptive(my_map: MapArea, threshold: Optional[float] = None,
+                               coarse: int = 16, max_depth: int = 3,
+                               budget: int = 2500, source: Optional[ElevationSource] = None) \
+        -> Dict[Tuple[float, float], float]:
+    """Return a dictionary in the same format as get_altitude_data, with extra points sampled
+    along the coast.
+
+    A coarse * coarse grid is fetched first. Afterwards, every grid square that could flood (its
+    altitude is at most threshold) or that lies on the border between land and no data (None) is
+    split into 4 smaller squares, whose midpoints are fetched next. This is repeated max_depth
+    times, or until budget altitude requests have been made. Each level is read from source (the
+    Canada Gov elevation API by default) in a single batch.
+
+    threshold is in the units of the altitudes, which compare_altitude_to_sea_level compares
+    directly to the projected sea levels. By default it is max_projected_sea_level(), so every
+    square the comparison could report as flooded is refined.
+
+    Preconditions:
+        - coarse >= 1
+        - max_depth >= 0
+        - budget >= coarse * coarse
+    """
+    if source is None:
+        source = ApiElevationSource()
+    if threshold is None:
+        threshold = max_projected_sea_level()
+
+    # the altitudes of the squares on the current level, keyed by (row, column) in that level
+    size = coarse
+    squares = [(row, col) for row in range(coarse) for col in range(coarse)]
+    level = _fetch_level(squares, size, my_map, source)
+    requests_made = len(squares)
 
     # ACCUMULATOR: keeps track of dictionary mapping location to altitude
     data = {}
+    _add_level(data, level, size, my_map)
 
-    for point in midpoints:
-        altitude = get_altitude(point)
+    for _ in range(max_depth):
+        # refine the lowest squares first so that the budget is spent where flooding is likely
+        to_refine = [square for square in level if _needs_refinement(square, level, threshold)]
+        to_refine.sort(key=lambda s: threshold if level[s] is None else level[s])
 
-        if altitude is not None:  # if the point lies outside Canada, altitude is None
-            data[point.coords] = altitude
+        # only refine as many squares as the remaining budget allows
+        to_refine = to_refine[:(budget - requests_made) // 4]
+        if to_refine == []:
+            break
+
+        children = [(2 * row + a, 2 * col + b) for row, col in to_refine
+                    for a in (0, 1) for b in (0, 1)]
+        level = _fetch_level(children, 2 * size, my_map, source)
+        requests_made += len(children)
+        size = 2 * size
+        _add_level(data, level, size, my_map)
 
     return data
+
+
+def max_projected_sea_level(predictions: Optional[tuple] = None) -> float:
+    """Return the highest sea level in predictions (the output of flooding.prediction_creator,
+    computed again if not given), in the units of the altitudes. No point higher than this is
+    reported as flooded, so there is no need to sample around it in more detail.
+
+    >>> max_projected_sea_level(([1.0, 4.0], [2.0, 3.0]))
+    4.0
+    """
+    if predictions is None:
+        # flooding imports this module, so it is only imported once it is needed
+        from flooding import prediction_creator
+        predictions = prediction_creator()
+
+    return float(max(max(prediction) for prediction in predictions))
+
+
+def _needs_refinement(square: Tuple[int, int], level: Dict[Tuple[int, int], Optional[float]],
+                      threshold: float) -> bool:
+    """Return whether the given square of level should be split into smaller squares.
+
+    A square is split if its altitude is at most threshold, or if one of its neighbours on the
+    same level has data while it does not (or the other way around).
+
+    >>> level = {(0, 0): 500.0, (0, 1): None, (1, 0): 800.0, (1, 1): 3.0}
+    >>> [_needs_refinement(s, level, 10.0) for s in [(0, 0), (0, 1), (1, 0), (1, 1)]]
+    [True, True, False, True]
+    """
+    altitude = level[square]
+    if altitude is not None and altitude <= threshold:
+        return True
+
+    row, col = square
+    for neighbour in [(row - 1, col), (row + 1, col), (row, col - 1), (row, col + 1)]:
+        if neighbour in level and (level[neighbour] is None) != (altitude is None):
+            return True
+
+    return False
+
+
+def _square_midpoint(square: Tuple[int, int], size: int, my_map: MapArea) -> Tuple[float, float]:
+    """Return the coordinates of the midpoint of the given square in a size * size grid.
+
+    >>> map1 = MapArea((40.0, 84.0), (-146.0, -50.0))
+    >>> _square_midpoint((0, 1), 2, map1)
+    (51.0, -74.0)
+    """
+    latitude_step = (my_map.latitude[1] - my_map.latitude[0]) / size
+    longitude_step = my_map.longitude_span / size
+
+    return (my_map.latitude[0] + (square[0] + 0.5) * latitude_step,
+            wrap_longitude(my_map.longitude[0] + (square[1] + 0.5) * longitude_step))
+
+
+def _fetch_level(squares: List[Tuple[int, int]], size: int, my_map: MapArea,
+                 source: ElevationSource) -> Dict[Tuple[int, int], Optional[float]]:
+    """Return the altitudes of the midpoints of the given squares of a size * size grid.
+    """
+    points = [_square_midpoint(square, size, my_map) for square in squares]
+    return dict(zip(squares, source.sample(points)))
+
+
+def _add_level(data: Dict[Tuple[float, float], float],
+               level: Dict[Tuple[int, int], Optional[float]], size: int, my_map: MapArea) -> None:
+    """Add the altitudes of the squares in level to data, skipping those with no data.
+    """
+    for square, altitude in level.items():
+        if altitude is not None:  # if the point lies outside Canada, altitude is None
+            data[_square_midpoint(square, size, my_map)] = altitude
@@ -0,0 +1,262 @@
+"""This module contains a cache for the outputs of the stages of the project's pipeline.
+
+Each output is saved on disk under a hash of everything it was computed from:
+    - the contents of the dataset files it reads
+    - the parameters it was run with, including the hashes of the stages before it
+    - the source code of the function that computes it, of the modules it lists as computing
+      it, and of the project modules they import
+so a stage only runs again when one of these changes. When the cache grows past its size limit,
+the least recently used outputs are removed first.
+
+The cache can be inspected and pruned from the command line:
+    python artifact_cache.py inspect
+    python artifact_cache.py prune --max-bytes 100000000
+"""
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+from types import ModuleType
+import argparse
+import dataclasses
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import sys
+import time
+import numpy as np
+from instrumentation import timed, count
+
+# folder that the cache is stored in by default
+CACHE_FOLDER = '.pipeline_cache'
+
+# hashes of files already read, keyed by (path, size, modification time)
+_file_hashes = {}
+
+# the folder of the project's modules: the modules they import from anywhere else (the standard
+# library and installed packages) are not hashed
+PROJECT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+
+class ArtifactCache:
+    """A size-limited cache of stage outputs on disk, keyed by the hash of their inputs.
+
+    Instance Attributes:
+        - folder: the folder the outputs and the index are stored in
+        - max_bytes: the total size of outputs kept before the least recently used are removed
+
+    Representation Invariants:
+        - self.max_bytes >= 0
+    """
+    folder: str
+    max_bytes: int
+    _index: Dict[str, Dict[str, Any]]
+
+    def __init__(self, folder: str = CACHE_FOLDER, max_bytes: int = 1024 ** 3) -> None:
+        self.folder = folder
+        self.max_bytes = max_bytes
+        os.makedirs(folder, exist_ok=True)
+
+        index_file = os.path.join(folder, 'index.json')
+        if os.path.exists(index_file):
+            with open(index_file) as f:
+                self._index = json.load(f)
+        else:
+            self._index = {}
+
+    @timed('cached_stage')
+    def stage(self, name: str, compute: Callable[[], Any], inputs: Dict[str, Any],
+              files: Sequence[str] = (), modules: Sequence[ModuleType] = ()) \
+            -> Tuple[str, Any]:
+        """Return (key, output) for the stage called name, where output is compute().
+
+        The key is stage_key(name, compute, inputs, files, modules), so inputs must contain every
+        parameter that compute's output depends on, including the keys of the stages it uses
+        the outputs of. If an output with that key is in the cache, it is returned without calling
+        compute. Otherwise (or if the saved output is missing or unreadable) compute is called and
+        its output saved.
+        """
+        key = stage_key(name, compute, inputs, files, modules)
+
+        if key in self._index:
+            try:
+                with open(self._path(key), 'rb') as f:
+                    output = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                del self._index[key]  # the output was deleted or cut off, so compute it again
+            else:
+                count('cache_hits')
+                self._index[key]['last_used'] = time.time()
+                self._save_index()
+                return (key, output)
+
+        count('cache_misses')
+        output = compute()
+        with open(self._path(key), 'wb') as f:
+            pickle.dump(output, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        self._index[key] = {'stage': name, 'size': os.path.getsize(self._path(key)),
+                            'created': time.time(), 'last_used': time.time()}
+        self.prune(self.max_bytes)
+        return (key, output)
+
+    def entries(self) -> List[Dict[str, Any]]:
+        """Return the key, stage, size and timestamps of every cached output, most recently used
+        first.
+        """
+        entries = [dict(info, key=key) for key, info in self._index.items()]
+        return sorted(entries, key=lambda entry: -entry['last_used'])
+
+    def prune(self, max_bytes: int = 0, stage: Optional[str] = None) -> int:
+        """Remove the least recently used outputs until at most max_bytes are left, and return
+        the number of outputs removed. If stage is given, only outputs of that stage are removed.
+        """
+        candidates = [entry for entry in self.entries() if stage in (None, entry['stage'])]
+        total = sum(entry['size'] for entry in self.entries())
+        removed = 0
+
+        while total > max_bytes and candidates != []:
+            entry = candidates.pop()  # least recently used
+            if os.path.exists(self._path(entry['key'])):
+                os.remove(self._path(entry['key']))
+            del self._index[entry['key']]
+            total -= entry['size']
+            removed += 1
+
+        self._save_index()
+        return removed
+
+    def _path(self, key: str) -> str:
+        """Return the path of the file the output with the given key is stored in."""
+        return os.path.join(self.folder, key + '.pickle')
+
+    def _save_index(self) -> None:
+        """Write the index to disk, replacing the old one only once the new one is complete."""
+        index_file = os.path.join(self.folder, 'index.json')
+        with open(index_file + '.tmp', 'w') as f:
+            json.dump(self._index, f)
+        os.replace(index_file + '.tmp', index_file)
+
+
+def stage_key(name: str, compute: Callable[[], Any], inputs: Dict[str, Any],
+              files: Sequence[str] = (), modules: Sequence[ModuleType] = ()) -> str:
+    """Return the key of the output of a stage: the stage name followed by the hash of inputs,
+    the contents of files, and the source code of compute, of modules, and of every project
+    module that they import (see project_imports).
+
+    Only the source of compute itself is hashed, not the rest of the module it is defined in, so
+    modules must list every module that compute's output depends on. This way, a module that
+    defines the computations of several stages (such as stages.py) can import the modules of
+    later stages without changing the keys of earlier ones.
+    """
+    digest = hashlib.sha256(name.encode())
+    _update_digest(digest, inputs)
+    for filename in files:
+        digest.update(file_hash(filename).encode())
+    digest.update(inspect.getsource(compute).encode())
+    for module in project_imports(modules):
+        digest.update(module.__name__.encode())
+        digest.update(file_hash(module.__file__).encode())
+
+    return name + '-' + digest.hexdigest()[:32]
+
+
+def project_imports(modules: Sequence[ModuleType]) -> List[ModuleType]:
+    """Return modules and every project module they import, directly or through other project
+    modules, sorted by name. A module counts as imported if it, or a function or class taken
+    from it, is a global of the importing module.
+
+    >>> [module.__name__ for module in project_imports([sys.modules[__name__]])]
+    ['artifact_cache', 'instrumentation']
+    """
+    # ACCUMULATOR: the project modules found so far, keyed by name
+    found = {}
+    to_visit = list(modules)
+
+    while to_visit != []:
+        module = to_visit.pop()
+        if module.__name__ in found or not _in_project(module):
+            continue
+        found[module.__name__] = module
+
+        for value in vars(module).values():
+            if isinstance(value, ModuleType):
+                to_visit.append(value)
+            elif getattr(value, '__module__', None) in sys.modules:
+                to_visit.append(sys.modules[value.__module__])
+
+    return [found[name] for name in sorted(found)]
+
+
+def _in_project(module: ModuleType) -> bool:
+    """Return whether module is a source file in the project's folder."""
+    filename = getattr(module, '__file__', None)
+    return filename is not None and filename.endswith('.py') \
+        and os.path.abspath(filename).startswith(PROJECT_FOLDER + os.sep) \
+        and 'site-packages' not in filename
+
+
+def file_hash(filename: str) -> str:
+    """Return the sha256 hash of the contents of the file.
+
+    The hash is remembered for as long as the file's size and modification time are unchanged,
+    so each file is only read once per run.
+    """
+    stat = os.stat(filename)
+    signature = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+
+    if signature not in _file_hashes:
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        _file_hashes[signature] = digest.hexdigest()
+
+    return _file_hashes[signature]
+
+
+def _update_digest(digest: Any, value: Any) -> None:
+    """Add value to the hash digest, so that equal values always give equal hashes.
+
+    Dictionaries are hashed in sorted key order, arrays by their type, shape and contents, and
+    dataclasses by their fields.
+    """
+    if isinstance(value, dict):
+        digest.update(b'{')
+        for key in sorted(value, key=repr):
+            _update_digest(digest, key)
+            _update_digest(digest, value[key])
+        digest.update(b'}')
+    elif isinstance(value, (list, tuple)):
+        digest.update(b'[')
+        for item in value:
+            _update_digest(digest, item)
+        digest.update(b']')
+    elif isinstance(value, np.ndarray):
+        digest.update(repr((value.dtype.str, value.shape)).encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+    elif dataclasses.is_dataclass(value):
+        digest.update(type(value).__name__.encode())
+        _update_digest(digest, dataclasses.asdict(value))
+    else:
+        digest.update(repr(value).encode())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inspect or prune the pipeline cache.')
+    parser.add_argument('command', choices=['inspect', 'prune'])
+    parser.add_argument('--folder', default=CACHE_FOLDER, help='the cache folder')
+    parser.add_argument('--max-bytes', type=int, default=0,
+                        help='when pruning, the total size to prune down to (default: empty)')
+    parser.add_argument('--stage', help='when pruning, only remove outputs of this stage')
+    args = parser.parse_args()
+
+    cache = ArtifactCache(args.folder)
+    if args.command == 'inspect':
+        for cached in cache.entries():
+            print('%-50s %12d bytes  last used %s' % (
+                cached['key'], cached['size'],
+                time.strftime('%Y-%m-%d %H:%M', time.localtime(cached['last_used']))))
+        print('%d outputs, %d bytes' % (len(cache.entries()),
+                                        sum(entry['size'] for entry in cache.entries())))
+    else:
+        print('Removed %d outputs' % cache.prune(args.max_bytes, args.stage))
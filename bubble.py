@@ -1,34 +1,303 @@
 """Generate a bubble map of locations at risk of flooding"""
-from typing import Dict
+from typing import Dict, List, Optional
+import numpy as np
 import plotly.express as px
+import plotly.graph_objects as go
 import pandas as pd
+from flooding import FloodResult
+from map_setup import MapArea, wrap_longitude
+from instrumentation import timed, count
 
+# the area shown by the maps, unless they are given another map area
+LATITUDE_RANGE = [40, 84]
+LONGITUDE_RANGE = [-146, -50]
 
-def draw_map(data: Dict[str, list]) -> None:
-    """Draw a bubble map of the data using plotly express."""
+# the largest bubble diameter, in pixels, as in plotly express
+MAX_BUBBLE_SIZE = 20
+
+# JavaScript applying the frames of build_delta_figure when the year slider moves, to be passed
+# as the post_script of the figure's show or write_html
+DELTA_SCRIPT = """
+var gd = document.getElementById('{plot_id}');
+var points = gd.layout.meta.points, frames = gd.layout.meta.frames;
+var state = new Map(), current = -1, timer = null;
+
+function setDepths(change) {
+    change.id.forEach(function (id, k) {
+        state.set(id, [change.depth[k], change.low ? change.low[k] : null,
+                       change.high ? change.high[k] : null]);
+    });
+}
+
+function showFrame(i) {
+    if (i < current) {
+        state = new Map();
+        current = -1;
+    }
+    for (var f = current + 1; f <= i; f++) {
+        frames[f].remove.forEach(function (id) { state.delete(id); });
+        setDepths(frames[f].add);
+        setDepths(frames[f].update);
+    }
+    current = i;
+
+    var lat = [], lon = [], size = [], text = [];
+    state.forEach(function (depths, id) {
+        lat.push(points.lat[id]);
+        lon.push(points.lon[id]);
+        size.push(Math.max(depths[0], 0));
+        text.push('Height below sea level: ' + depths[0] + ' m'
+                  + (depths[1] === null ? '' : ' (' + depths[1] + ' to ' + depths[2] + ')'));
+    });
+    Plotly.restyle(gd, {lat: [lat], lon: [lon], 'marker.size': [size], hovertext: [text]}, [0]);
+}
+
+function moveSlider(i) {
+    Plotly.relayout(gd, {'sliders[0].active': i});
+    showFrame(i);
+}
+
+gd.on('plotly_sliderchange', function (event) { showFrame(event.step._index); });
+gd.on('plotly_buttonclicked', function (event) {
+    clearInterval(timer);
+    if (event.button.label === 'Play') {
+        timer = setInterval(function () {
+            if (current + 1 >= frames.length) {
+                clearInterval(timer);
+            } else {
+                moveSlider(current + 1);
+            }
+        }, 500);
+    }
+});
+showFrame(0);
+"""
+
+
+@timed()
+def draw_map(data: Dict[str, list], my_map: Optional[MapArea] = None) -> None:
+    """Draw a bubble map of the data using plotly express, showing my_map (North America by
+    default).
+    """
+    build_figure(data, my_map=my_map).show()
+
+
+def build_figure(data: Dict[str, list],
+                 title: str = 'Areas at risk of flooding in the next century',
+                 my_map: Optional[MapArea] = None) -> go.Figure:
+    """Return the bubble map of the data drawn by draw_map, without showing it."""
     df = pd.DataFrame.from_dict(data)
     df.head()
     df['text'] = 'Height below sea level: ' + (df['diff']).astype(str) + ' m'
 
+    # ensemble results also have a 5-95% band, whose median can be above sea level
+    if 'diff_high' in df:
+        df['text'] += (' (' + df['diff_low'].astype(str) + ' to '
+                       + df['diff_high'].astype(str) + ')')
+    df['size'] = df['diff'].clip(lower=0)
+
     fig = px.scatter_geo(df,
                          lon='lon',
                          lat='lat',
                          hover_name='text',
-                         size="diff",
+                         size="size",
                          animation_frame='year',
                          category_orders={"year": [2020, 2030, 2040, 2050, 2060,
                                                    2070, 2080, 2090, 2100]}
                          )
 
+    _style(fig, title, my_map)
+
+    return fig
+
+
+@timed()
+def update_figure(fig: go.Figure, old: FloodResult, new: FloodResult,
+                  title: str = 'Areas at risk of flooding in the next century',
+                  my_map: Optional[MapArea] = None) -> go.Figure:
+    """Return fig, the bubble map of old made by build_figure, updated to show new, an update of
+    old (see flooding.update_comparison). title and my_map must be the ones fig was built with.
+
+    Only the frames of the years whose flooded locations or depths changed are redrawn, in
+    place. The figure is only built again if a year starts or stops having flooded locations,
+    since plotly express gives such a year no frame.
+
+    Preconditions:
+        - old.years == new.years
+        - the locations of old and new are in (latitude, longitude) order
+    """
+    if _flooded_years(old) != _flooded_years(new):
+        return build_figure(new.to_long(), title, my_map)
+
+    first = fig.frames[0].name if len(fig.frames) > 0 else None
+    frames = {frame.name: frame for frame in fig.frames}
+    for i, year in enumerate(new.years):
+        if str(year) in frames and not _same_year(old, new, i):
+            points = _frame_points(new, i)
+            frames[str(year)].data[0].update(points)
+            if str(year) == first:
+                fig.data[0].update(points)
+            count('frames_redrawn')
+
+    # the bubbles of every frame are scaled by the deepest location of any year
+    sizeref = max(float(new.depth.max()), 0.0) / MAX_BUBBLE_SIZE ** 2
+    if len(fig.data) > 0 and fig.data[0].marker.sizeref != sizeref:
+        for trace in [fig.data[0]] + [frame.data[0] for frame in fig.frames]:
+            trace.marker.sizeref = sizeref
+
+    return fig
+
+
+@timed()
+def draw_delta_map(result: FloodResult,
+                   title: str = 'Areas at risk of flooding in the next century',
+                   my_map: Optional[MapArea] = None) -> None:
+    """Draw the same bubble map as draw_map, from the frames of build_delta_figure."""
+    build_delta_figure(result, title, my_map=my_map).show(post_script=DELTA_SCRIPT)
+
+
+def build_delta_figure(result: FloodResult,
+                       title: str = 'Areas at risk of flooding in the next century',
+                       decimals: int = 2, my_map: Optional[MapArea] = None) -> go.Figure:
+    """Return a bubble map of result whose year slider only stores the changes between years.
+
+    Instead of a plotly animation frame with every flooded location of every year, the figure
+    stores each location once and, for each year, the frame_deltas from the year before. The
+    figure must be shown or saved with post_script=DELTA_SCRIPT, which applies the frames in the
+    browser when the slider moves. Depths are rounded to the given number of decimals.
+    """
+    frames = frame_deltas(result, decimals)
+    max_depth = max([float(result.depth.max()) if len(result.depth) > 0 else 0.0, 1e-9])
+
+    fig = go.Figure(go.Scattergeo(
+        lat=[], lon=[], mode='markers', hovertext=[],
+        hovertemplate='<b>%{hovertext}</b><br>lat=%{lat}<br>lon=%{lon}<extra></extra>',
+        marker=dict(size=[], sizemode='area',
+                    sizeref=2 * max_depth / MAX_BUBBLE_SIZE ** 2)))
+
     fig.update_layout(
-        title_text='Areas at risk of flooding in the next century',
+        meta={'points': {'lat': result.coords[:, 0].tolist(),
+                         'lon': result.coords[:, 1].tolist()},
+              'frames': frames},
+        sliders=[dict(active=0, currentvalue=dict(prefix='year='),
+                      steps=[dict(label=str(year), method='skip') for year in result.years])],
+        updatemenus=[dict(type='buttons', direction='left', x=0.1, y=0, xanchor='right',
+                          yanchor='top', showactive=False,
+                          buttons=[dict(label='Play', method='skip'),
+                                   dict(label='Pause', method='skip')])])
+    _style(fig, title, my_map)
+
+    return fig
+
+
+def frame_deltas(result: FloodResult, decimals: int = 2) -> List[Dict]:
+    """Return the changes to the flooded locations from each year of result to the next, with
+    the first year's changes starting from no flooded locations.
+
+    Each change is a dictionary with the keys
+        - 'remove': the locations (rows of result.coords) no longer flooded
+        - 'add': the newly flooded locations, as {'id': [...], 'depth': [...]}
+        - 'update': the still flooded locations whose depth changed, in the same form as 'add'
+    where the depths are rounded to decimals, and ensemble results also have 'low' and 'high'
+    depths.
+    """
+    bands = {'depth': result.depth}
+    if result.depth_low is not None:
+        bands.update(low=result.depth_low, high=result.depth_high)
+    bands = {name: values.astype(float).round(decimals) for name, values in bands.items()}
+
+    # ACCUMULATOR: the changes from each year to the next
+    deltas = []
+    previous = np.zeros(0, dtype=np.int64)
+    previous_values = {name: np.zeros(0) for name in bands}
+
+    for i in range(len(result.years)):
+        year = slice(result.offsets[i], result.offsets[i + 1])
+        ids = result.point_index[year]
+        order = np.argsort(ids)
+        ids = ids[order].astype(np.int64)
+        values = {name: band[year][order] for name, band in bands.items()}
+
+        _, here, before = np.intersect1d(ids, previous, return_indices=True)
+        kept = np.zeros(len(ids), dtype=bool)
+        kept[here] = True
+        changed = np.zeros(len(ids), dtype=bool)
+        for name in bands:
+            changed[here] |= values[name][here] != previous_values[name][before]
+
+        deltas.append({'remove': np.setdiff1d(previous, ids).tolist(),
+                       'add': _depths(ids, values, ~kept),
+                       'update': _depths(ids, values, kept & changed)})
+        previous, previous_values = ids, values
+
+    return deltas
+
+
+def _flooded_years(result: FloodResult) -> List[int]:
+    """Return the years of result with at least one flooded location."""
+    return [year for i, year in enumerate(result.years)
+            if result.offsets[i + 1] > result.offsets[i]]
+
+
+def _same_year(old: FloodResult, new: FloodResult, i: int) -> bool:
+    """Return whether the flooded locations and depths of year i are the same in old and new."""
+    return all(np.array_equal(a, b) for a, b in zip(_year_rows(old, i), _year_rows(new, i)))
+
+
+def _year_rows(result: FloodResult, i: int) -> List[np.ndarray]:
+    """Return the flooded locations and depths (and 5-95% bands) of year i of result."""
+    year = slice(result.offsets[i], result.offsets[i + 1])
+    rows = [result.coords[result.point_index[year]], result.depth[year]]
+    if result.depth_low is not None:
+        rows.extend([result.depth_low[year], result.depth_high[year]])
+    return rows
+
+
+def _frame_points(result: FloodResult, i: int) -> Dict:
+    """Return the points of the frame of year i of build_figure(result.to_long())."""
+    year = slice(result.offsets[i], result.offsets[i + 1])
+    coords = result.coords[result.point_index[year]]
+    depth = result.depth[year].astype(float)
+    text = ['Height below sea level: ' + str(value) + ' m' for value in depth.tolist()]
+
+    # ensemble results also have a 5-95% band, as in build_figure
+    if result.depth_low is not None:
+        text = [line + ' (' + str(low) + ' to ' + str(high) + ')' for line, low, high
+                in zip(text, result.depth_low[year].astype(float).tolist(),
+                       result.depth_high[year].astype(float).tolist())]
+
+    return {'lat': coords[:, 0], 'lon': coords[:, 1], 'hovertext': np.array(text, dtype=object),
+            'marker': {'size': np.maximum(depth, 0)}}
+
+
+def _depths(ids: np.ndarray, values: Dict[str, np.ndarray], selected: np.ndarray) -> Dict:
+    """Return the selected locations and their depths, in the form used by frame_deltas."""
+    change = {'id': ids[selected].tolist()}
+    for name, band in values.items():
+        change[name] = band[selected].tolist()
+    return change
+
+
+def _style(fig: go.Figure, title: str, my_map: Optional[MapArea] = None) -> None:
+    """Set the title and the map area of a bubble map, which is my_map if it is given and North
+    America otherwise.
+    """
+    if my_map is None:
+        area = dict(scope='north america', lataxis=dict(range=LATITUDE_RANGE),
+                    lonaxis=dict(range=LONGITUDE_RANGE))
+    else:
+        # centre the projection on the map, so that a map crossing the antimeridian is not split
+        west = my_map.longitude[0]
+        east = west + my_map.longitude_span
+        area = dict(scope='world', projection=dict(rotation=dict(
+                        lon=wrap_longitude((west + east) / 2))),
+                    lataxis=dict(range=list(my_map.latitude)), lonaxis=dict(range=[west, east]))
+
+    fig.update_layout(
+        title_text=title,
         showlegend=False,
         geo=dict(
-            scope='north america',
             landcolor='rgb(217, 217, 217)',
-            lataxis=dict(range=[40, 84]),
-            lonaxis=dict(range=[-146, -50])
+            **area
         )
     )
-
-    fig.show()
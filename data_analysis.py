@@ -3,15 +3,196 @@
 We will use the semi-empirical sea level projection model outlined here:
 https://www-jstor-org.myaccess.library.utoronto.ca/stable/20035254?pq-origsite=summon&seq=1#metadata_info_tab_contents
 
-We will also use the regression methods from sci-kit learn to get our predictions
+The regressions are ordinary least squares fits solved with numpy. They work on many temperature
+series at once: each series is a column of a matrix, and every column is fitted against the same
+design matrix with a single factorization.
+
+These fits give different projections than the scikit-learn regressions this module used before.
+Those fitted powers of the raw years (2006 ** 6 is about 7e19), which are so nearly collinear
+that the solver kept only 3 of the 6 directions, and the "degree 6" curve was really a much
+smaller fit with larger residuals. Here, the years are first mapped onto [-1, 1], so the full
+degree 6 polynomial is fitted, with smaller residuals on every temperature series. Its steeper
+extrapolation changes the projections: for the first series of datasets/Temperatures.py, the sea
+level in 2100 drops from 690 to 246, and the third series is fitted a small negative constant.
+scikit-learn is no longer used anywhere, so it is not in the requirements.
 """
-from typing import Dict
-from sklearn.preprocessing import PolynomialFeatures
-from sklearn.linear_model import LinearRegression
+from typing import Dict, List, Optional
+from dataclasses import dataclass
 import numpy as np
 from dataset_cleaner import read_sea_level_data
+from instrumentation import timed, count
 
 
+###################################################################################################
+# Batched polynomial regression
+###################################################################################################
+@dataclass
+class PolynomialFit:
+    """Polynomials fitted to one or more series that share the same x values.
+
+    The polynomials are in terms of (x - center) / scale instead of x, which keeps a high degree
+    fit on values like 2006..2100 numerically well-conditioned.
+
+    Instance Attributes:
+        - coefficients: array of shape (degree + 1, number of series), where column j holds the
+          coefficients of series j, from the constant term up
+        - center: the value subtracted from x before evaluating the polynomials
+        - scale: the value (x - center) is divided by before evaluating the polynomials
+
+    Representation Invariants:
+        - self.coefficients.ndim == 2
+        - self.scale > 0
+    """
+    coefficients: np.ndarray
+    center: float
+    scale: float
+
+    @property
+    def degree(self) -> int:
+        """Return the degree of the fitted polynomials."""
+        return self.coefficients.shape[0] - 1
+
+
+def polynomial_design_matrix(x: np.ndarray, degree: int, center: float = 0.0,
+                             scale: float = 1.0) -> np.ndarray:
+    """Return the design matrix of a polynomial regression on x, with one row per value in x and
+    one column per power of (x - center) / scale, from 0 to degree.
+
+    >>> polynomial_design_matrix(np.array([1.0, 3.0]), 2, center=2.0)
+    array([[ 1., -1.,  1.],
+           [ 1.,  1.,  1.]])
+    """
+    scaled = (np.asarray(x, dtype=float).ravel() - center) / scale
+    return scaled[:, np.newaxis] ** np.arange(degree + 1)
+
+
+def fit_polynomials(x: np.ndarray, y: np.ndarray, degree: int = 6) -> PolynomialFit:
+    """Return the least squares polynomials of the given degree fitted to each column of y
+    against x.
+
+    y may be a single series of shape (len(x),) or a matrix of shape (len(x), number of series).
+    All columns are solved with one factorization of the design matrix.
+
+    Preconditions:
+        - len(x) > degree
+        - y.shape[0] == len(x)
+
+    >>> fit = fit_polynomials(np.array([0.0, 1.0, 2.0]), np.array([1.0, 3.0, 5.0]), degree=1)
+    >>> evaluate_polynomials(fit, np.array([3.0])).round(6).tolist()
+    [[7.0]]
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if y.ndim == 1:
+        y = y[:, np.newaxis]
+
+    # map x onto [-1, 1]
+    center = (x.max() + x.min()) / 2
+    scale = max((x.max() - x.min()) / 2, 1.0)
+
+    count('fits', y.shape[1])
+    design = polynomial_design_matrix(x, degree, center, scale)
+    coefficients = np.linalg.lstsq(design, y, rcond=None)[0]
+
+    return PolynomialFit(coefficients, center, scale)
+
+
+def evaluate_polynomials(fit: PolynomialFit, x: np.ndarray) -> np.ndarray:
+    """Return an array of shape (len(x), number of series) with the value of every fitted
+    polynomial at every value in x.
+    """
+    return polynomial_design_matrix(x, fit.degree, fit.center, fit.scale) @ fit.coefficients
+
+
+def integrate_anomalies(fit: PolynomialFit, years: List[float], n: int = 100,
+                        y0: int = 2012) -> np.ndarray:
+    """Return an array of shape (len(years), number of series) with the midpoint Riemann sum
+    approximation of the integral from y0 to each year of T(year) - T(y0), where T is each of
+    the fitted temperature curves.
+
+    Preconditions:
+        - n >= 1
+    """
+    dx = (np.asarray(years, dtype=float) - y0) / n  # length of the intervals
+    midpoints = y0 + dx[:, np.newaxis] * (np.arange(n) + 0.5)  # midpoint of every interval
+
+    temperatures = evaluate_polynomials(fit, midpoints)
+    t0 = evaluate_polynomials(fit, np.array([y0]))  # temperature at y0
+
+    sums = (temperatures - t0).reshape(len(dx), n, -1).sum(axis=1)
+    return dx[:, np.newaxis] * sums
+
+
+def regression_slopes(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """Return the slope of the least squares line (with intercept) of each column of y against
+    the same column of x.
+
+    Preconditions:
+        - x.shape == y.shape or y.ndim == 1 and len(y) == x.shape[0]
+
+    >>> regression_slopes(np.array([[0.0], [1.0], [2.0]]), np.array([1.0, 3.0, 5.0])).tolist()
+    [2.0]
+    """
+    y = np.asarray(y, dtype=float)
+    if y.ndim == 1 and x.ndim == 2:
+        y = y[:, np.newaxis]
+
+    count('fits', 1 if x.ndim == 1 else x.shape[1])
+    x_centered = x - x.mean(axis=0)
+    y_centered = y - y.mean(axis=0)
+
+    return (x_centered * y_centered).sum(axis=0) / (x_centered ** 2).sum(axis=0)
+
+
+def calibration_constants(fit: PolynomialFit,
+                          sea_levels: Optional[Dict[int, float]] = None,
+                          years: Optional[List[int]] = None, n: int = 100,
+                          y0: int = 2012) -> np.ndarray:
+    """Return the proportionality constant between sea level and integral of temperature for
+    each of the fitted temperature curves, as an array of shape (number of series,).
+
+    The constants are fitted over the given years, which are 2006 to 2018 (all the years with sea
+    level data) by default. n and y0 are passed on to integrate_anomalies.
+
+    Preconditions:
+        - years is None or all(year in sea_levels for year in years)
+    """
+    if sea_levels is None:
+        sea_levels = read_sea_level_data('datasets/global_timeseries_measures.nc.nc4')
+    if years is None:
+        years = list(range(2006, 2019))
+
+    x = integrate_anomalies(fit, years, n, y0)  # integral
+    y = np.array([sea_levels[i] for i in years], dtype=float)  # sea level
+
+    return regression_slopes(x, y)
+
+
+def sea_level_projections(years: List[int], temp_years: np.ndarray,
+                          temperatures: np.ndarray, degree: int = 6, n: int = 100,
+                          y0: int = 2012, calibration_years: Optional[List[int]] = None,
+                          sea_levels: Optional[Dict[int, float]] = None) -> np.ndarray:
+    """Return an array of shape (len(years), number of series) with the predicted sea level in
+    each year for each temperature series (column) of temperatures.
+
+    This is the same calculation as sea_level_prediction, done for every series at once. The
+    defaults of degree (of the temperature curves), n and y0 (see integrate_anomalies) and
+    calibration_years (see calibration_constants) are the ones sea_level_prediction uses.
+
+    Preconditions:
+        - temperatures.shape[0] == len(temp_years)
+        - all(2006 <= year <= 2100 for year in temp_years)
+        - len(temp_years) > degree
+    """
+    fit = fit_polynomials(temp_years, temperatures, degree)
+    constants = calibration_constants(fit, sea_levels, calibration_years, n, y0)
+    return constants * integrate_anomalies(fit, years, n, y0)
+
+
+###################################################################################################
+# Single series projection
+###################################################################################################
+@timed()
 def temp_year_regression(year: float, temp: Dict[int, float]) -> float:
     """Return an estimated value of the temperature for a certain year.
     This is done by running a polynomial regression on the values in temp (temperature vs year).
@@ -20,43 +201,25 @@ def temp_year_regression(year: float, temp: Dict[int, float]) -> float:
         - 2006 <= year <= 2100
         - all(2006 <= year <= 2100 for year in temp)
     """
-    # Polynomial regression:
     # retrieve x and y values as numpy arrays
-    x = np.array([[yr] for yr in temp])  # years
+    x = np.array(list(temp), dtype=float)  # years
     y = np.array([temp[yr] for yr in temp])  # temperatures
 
     # run a polynomial regression of degree 6
-    poly_reg = PolynomialFeatures(degree=6)
-    x_poly = poly_reg.fit_transform(x)
-    poly_reg.fit(x_poly, y)
-    lin_reg = LinearRegression()
-    lin_reg.fit(x_poly, y)
-
-    # Value prediction:
-    year_value = np.array([[year]])
-    year_poly = poly_reg.fit_transform(year_value)
-    prediction = lin_reg.predict(year_poly)
+    fit = fit_polynomials(x, y, degree=6)
 
-    return float(prediction)
+    return float(evaluate_polynomials(fit, np.array([year]))[0, 0])
 
 
 def integration_approximation(year: int, temp: Dict[int, float]) -> float:
     """Return the midpoint Riemann sum approximation of the integral from 2012 to year of the
     temperature in year - temperature in 2012 (T(year) - T0)
     """
-    sum_so_far = 0
-    n = 100  # number of sub-intervals taken
-    y0 = 2012
-    t0 = temp_year_regression(y0, temp)  # temperature at 2012
-    dx = (year - y0) / n  # length of the intervals
-
-    for i in range(n):
-        y = y0 + dx / 2 + i * dx  # gets midpoint of interval
-        sum_so_far += temp_year_regression(y, temp) - t0
-
-    return dx * sum_so_far
+    fit = _fit_temperatures(temp)
+    return float(integrate_anomalies(fit, [year])[0, 0])
 
 
+@timed()
 def finding_constant(temp: Dict[int, float]) -> float:
     """Return the proportionality constant between sea level and integral of temperature from 2012
     to a certain year. The slope of the linear regression (sea level vs temperature) is the constant
@@ -64,16 +227,7 @@ def finding_constant(temp: Dict[int, float]) -> float:
     This proportionality is based on the semi-empirical model detailed here:
     https://www-jstor-org.myaccess.library.utoronto.ca/stable/20035254?pq-origsite=summon&seq=1#metadata_info_tab_contents
     """
-    # retrieve the x and y axes for our linear regression as numpy arrays
-    x = np.array([[integration_approximation(i, temp)] for i in range(2006, 2019)])  # integral
-    y = np.array([read_sea_level_data('datasets/global_timeseries_measures.nc.nc4')[i]
-                  for i in range(2006, 2019)])  # sea level
-
-    # run linear regression
-    model = LinearRegression()
-    model.fit(x, y)
-
-    return float(model.coef_)
+    return float(calibration_constants(_fit_temperatures(temp))[0])
 
 
 def sea_level_prediction(year: int, temp: Dict[int, float]) -> float:
@@ -84,3 +238,12 @@ def sea_level_prediction(year: int, temp: Dict[int, float]) -> float:
     """
     a = finding_constant(temp)
     return a * integration_approximation(year, temp)
+
+
+def _fit_temperatures(temp: Dict[int, float]) -> PolynomialFit:
+    """Return the degree 6 polynomial fitted to the temperatures in temp.
+    """
+    x = np.array(list(temp), dtype=float)  # years
+    y = np.array([temp[yr] for yr in temp])  # temperatures
+
+    return fit_polynomials(x, y, degree=6)
@@ -4,13 +4,18 @@ There are two main datasets we are working with:
     - Average Surface Temperates by Year and Location (includes predicted values)
     - Global Average Sea Level
 """
-from typing import Dict
+from typing import Dict, Optional, Sequence, Union
+import json
+import os
 import netCDF4 as nc
+import numpy as np
+from instrumentation import timed, count
 
 
 ###################################################################################################
 # Cleanup Temperature data
 ###################################################################################################
+@timed()
 def read_temperature_data(lat: float, lon: float, filename: str) -> Dict[int, float]:
     """Return a dictionary where the key is a certain year and the value is the
     average temperature in Kelvin for that year and inputted location.
@@ -20,20 +25,117 @@ def read_temperature_data(lat: float, lon: float, filename: str) -> Dict[int, fl
         - -180 <= lon <= 179.5
         - filename != ''
     """
-    # use the netCDF4 library to read the NetCDF file
-    ds = nc.Dataset(filename)
+    # yearly averages of 'tas', the NetCDF variable representing temperature
+    averages = annual_mean_temperatures(filename, lat, lon)
 
-    # 'tas' is a NetCDF variable representing temperature
-    temp = ds['tas']
-
-    # dictionary accessing the arrays within temp
-    temperatures = {i + 2006: float('%7.4f' % (temp[12 * i, lat, lon])) for i in range(0, 95)}
+    # dictionary mapping year to average temperature
+    temperatures = {i + 2006: float('%7.4f' % averages[i]) for i in range(len(averages))}
     return temperatures
 
 
+@timed()
+def annual_mean_temperatures(filename: str, lat: Union[float, slice, None] = None,
+                             lon: Union[float, slice, None] = None,
+                             months: Optional[Sequence[int]] = None, chunk_years: int = 10,
+                             cache: Optional[str] = None) -> np.ndarray:
+    """Return the yearly average of the monthly temperatures in the NetCDF file, with one row
+    per year starting in 2006.
+
+    lat and lon select the location the same way as in read_temperature_data. Either can also be
+    a slice, or None for the whole axis. For a single location the result has shape (years,),
+    otherwise it has shape (years, latitudes, longitudes).
+
+    If months is given, only those months of each year are averaged (0 is January), which gives
+    seasonal averages instead, e.g. months=[5, 6, 7] for summer.
+
+    The file is read chunk_years years at a time, so only one chunk of monthly values is in
+    memory at once. If cache is given, the result is written to that .npy file while it is
+    computed and returned as a memory-mapped array, and later calls with the same cache read it
+    from there, unless the NetCDF file has changed since or the call has different arguments
+    (which are saved next to the cache, in a .json file of the same name).
+
+    Preconditions:
+        - filename != ''
+        - chunk_years >= 1
+        - months is None or all(0 <= month < 12 for month in months)
+    """
+    key = _cache_key(filename, lat, lon, months, chunk_years)
+    if cache is not None and os.path.exists(cache) \
+            and os.path.getmtime(cache) >= os.path.getmtime(filename) \
+            and _read_cache_key(cache) == key:
+        count('cache_hits')
+        return np.load(cache, mmap_mode='r')
+
+    if cache is not None and os.path.exists(cache + '.json'):
+        os.remove(cache + '.json')  # the cache is only valid again once it is rewritten
+
+    count('files_opened')
+    with nc.Dataset(filename) as ds:
+        # 'tas' is a NetCDF variable representing temperature, indexed by (month, lat, lon)
+        temp = ds['tas']
+        years = temp.shape[0] // 12
+        location = (slice(None) if lat is None else lat, slice(None) if lon is None else lon)
+        selected = slice(None) if months is None else list(months)
+
+        # ACCUMULATOR: yearly averages, filled in one chunk at a time
+        averages = None
+
+        for first in range(0, years, chunk_years):
+            last = min(first + chunk_years, years)
+            monthly = np.ma.filled(temp[(slice(12 * first, 12 * last),) + location], np.nan)
+
+            # group the months of each year together and average them
+            monthly = monthly.reshape((last - first, 12) + monthly.shape[1:])
+            chunk = monthly[:, selected].mean(axis=1)
+
+            if averages is None:
+                shape = (years,) + chunk.shape[1:]
+                if cache is None:
+                    averages = np.empty(shape)
+                else:
+                    averages = np.lib.format.open_memmap(cache, mode='w+', dtype=np.float64,
+                                                         shape=shape)
+            averages[first:last] = chunk
+
+    if cache is not None:
+        averages.flush()
+        with open(cache + '.json', 'w') as f:
+            json.dump(key, f)
+
+    return averages
+
+
+def _cache_key(filename: str, lat: Union[float, slice, None], lon: Union[float, slice, None],
+               months: Optional[Sequence[int]], chunk_years: int) -> Dict[str, object]:
+    """Return the arguments of annual_mean_temperatures that its cache was computed with, in a
+    form that can be saved as JSON.
+
+    >>> _cache_key('tas.nc', 45.0, slice(0, 10), None, 10)['lon']
+    [0, 10, None]
+    """
+    def location(value: Union[float, slice, None]) -> object:
+        if isinstance(value, slice):
+            return [value.start, value.stop, value.step]
+        return None if value is None else float(value)
+
+    return {'filename': os.path.abspath(filename), 'lat': location(lat), 'lon': location(lon),
+            'months': None if months is None else [int(month) for month in months],
+            'chunk_years': chunk_years}
+
+
+def _read_cache_key(cache: str) -> Optional[Dict[str, object]]:
+    """Return the arguments saved next to the cache file, or None if there are none."""
+    try:
+        with open(cache + '.json') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
 ###################################################################################################
 # Cleanup Sea level data
 ###################################################################################################
+@timed()
 def read_sea_level_data(filename: str) -> Dict[int, float]:
     """Return a dictionary where the key is a year and the value is the average sea level change
     for that year (from 2006 to 2018).
@@ -42,6 +144,7 @@ def read_sea_level_data(filename: str) -> Dict[int, float]:
         - filename != ''
     """
     # use the netCDF4 library to read the NetCDF file
+    count('files_opened')
     ds = nc.Dataset(filename)
 
     # 'global_average_sea_level_change' contains sea level values
@@ -0,0 +1,250 @@
+"""This module contains the sources that elevation data can be read from.
+
+There are two kinds of sources:
+    - the Canada Gov elevation API, which answers one point per HTTP request
+    - a local elevation raster (DEM) file, which can answer any number of points at once without
+      a network connection
+
+Both return None for points they have no data for, so they can be used interchangeably by
+get_altitude_data() in altitudes.py. Both can also be sampled from several threads at once (see
+pipelined.py).
+"""
+from typing import List, Optional, Tuple
+from abc import ABC, abstractmethod
+import os
+import threading
+import numpy as np
+import requests
+from instrumentation import timed, count
+
+# the raster is read in windows of at most this many rows and columns, one per block of the
+# raster that has points in it, so points spread over a large raster never load all of it
+BLOCK_SIZE = 512
+
+
+class ElevationSource(ABC):
+    """A source of elevation data.
+
+    This is an abstract class. Subclasses must implement the sample method.
+    """
+
+    @abstractmethod
+    def sample(self, points: List[Tuple[float, float]]) -> List[Optional[float]]:
+        """Return the altitude of each (latitude, longitude) point in points, in the same order.
+        The altitude is None for points that this source has no data for.
+        """
+        raise NotImplementedError
+
+
+class ApiElevationSource(ElevationSource):
+    """The Canada Gov elevation API, queried one point at a time.
+
+    Each thread that samples the source gets its own session, since a requests.Session is not
+    safe to share between threads.
+
+    Instance Attributes:
+        - url: the url of the altitude endpoint of the API
+    """
+    url: str
+    _sessions: threading.local
+
+    def __init__(self, url: str = 'http://geogratis.gc.ca/services/elevation/cdem/altitude') \
+            -> None:
+        self.url = url
+        self._sessions = threading.local()
+
+    @timed('elevation_sample')
+    def sample(self, points: List[Tuple[float, float]]) -> List[Optional[float]]:
+        """Return the altitude of each point in points, using one request per point.
+        """
+        return [self.altitude(point[0], point[1]) for point in points]
+
+    def altitude(self, latitude: float, longitude: float) -> Optional[float]:
+        """Return the altitude of the given point, or None if it lies outside Canada.
+        """
+        # converts the latitude and longitude points into a string
+        lat = 'lat=' + str(latitude)
+        lon = 'lon=' + str(longitude)
+
+        # combines all elements to have the final url
+        url = self.url + '?' + lat + '&' + lon
+
+        count('http_calls')
+        r = self._session().get(url)  # sends a request to url and stores data in variable r
+        data = r.json()  # converts the json information into a python readable datatype
+
+        return data['altitude']  # returns only the elevation variable from nested dictionary
+
+    def _session(self) -> requests.Session:
+        """Return the session of the current thread, opening it on first use.
+        """
+        # reuse the same connection between requests instead of opening one per point
+        if not hasattr(self._sessions, 'session'):
+            self._sessions.session = requests.Session()
+        return self._sessions.session
+
+
+class RasterElevationSource(ElevationSource):
+    """A local elevation raster (DEM) file in geographic (latitude/longitude) coordinates.
+
+    ESRI ASCII grids (.asc) are converted once to a binary copy next to the original file, which
+    is then memory-mapped, so only the parts of the raster around the sampled points are read from
+    disk. GeoTIFF files (.tif, .tiff) are read window by window using the rasterio library, which
+    needs to be installed separately. A rasterio dataset cannot be read from several threads at
+    once, so its windows are read one at a time.
+
+    Instance Attributes:
+        - filename: the path of the raster file
+        - shape: the number of (rows, columns) in the raster
+        - top: the latitude of the top edge of the raster
+        - left: the longitude of the left edge of the raster
+        - cell_size: the width and height of a raster cell in degrees
+        - nodata: the value used in the raster for cells with no data
+
+    Representation Invariants:
+        - self.cell_size > 0
+    """
+    filename: str
+    shape: Tuple[int, int]
+    top: float
+    left: float
+    cell_size: float
+    nodata: Optional[float]
+    _data: Optional[np.ndarray]
+    _dataset: object
+    _lock: threading.Lock
+
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self._data = None
+        self._dataset = None
+        self._lock = threading.Lock()
+
+        extension = os.path.splitext(filename)[1].lower()
+        if extension == '.asc':
+            self._open_ascii_grid()
+        elif extension in ('.tif', '.tiff'):
+            self._open_geotiff()
+        else:
+            raise ValueError('Unsupported raster format: ' + filename)
+
+    @timed('elevation_sample')
+    def sample(self, points: List[Tuple[float, float]]) -> List[Optional[float]]:
+        """Return the altitude of each point in points, with None for points outside the raster
+        or on cells with no data.
+        """
+        if points == []:
+            return []
+
+        coords = np.array(points, dtype=float)
+        values = self.sample_array(coords[:, 0], coords[:, 1])
+
+        return [None if np.isnan(v) else float(v) for v in values]
+
+    def sample_array(self, latitudes: np.ndarray, longitudes: np.ndarray) -> np.ndarray:
+        """Return the altitudes at the given points as an array, with nan for points outside the
+        raster or on cells with no data.
+
+        The raster is split into blocks of BLOCK_SIZE * BLOCK_SIZE cells, and for each block
+        with points in it, only the smallest window containing those points is read.
+        """
+        rows = np.floor((self.top - latitudes) / self.cell_size).astype(np.int64)
+        cols = np.floor((longitudes - self.left) / self.cell_size).astype(np.int64)
+        inside = (rows >= 0) & (rows < self.shape[0]) & (cols >= 0) & (cols < self.shape[1])
+
+        # ACCUMULATOR: altitudes of the points, nan until they are read
+        values = np.full(latitudes.shape, np.nan)
+        if not inside.any():
+            return values
+
+        rows, cols = rows[inside], cols[inside]
+        blocks = (rows // BLOCK_SIZE) * (self.shape[1] // BLOCK_SIZE + 1) + cols // BLOCK_SIZE
+        order = np.argsort(blocks, kind='stable')
+        starts = np.flatnonzero(np.diff(blocks[order], prepend=-1))
+
+        # ACCUMULATOR: the altitudes of the points inside the raster, block by block
+        found = np.empty(len(rows))
+        for start, stop in zip(starts, np.append(starts[1:], len(order))):
+            points = order[start:stop]
+            r0, r1 = rows[points].min(), rows[points].max() + 1
+            c0, c1 = cols[points].min(), cols[points].max() + 1
+            window = self._read_window(r0, r1, c0, c1)
+            found[points] = window[rows[points] - r0, cols[points] - c0]
+        count('windows_read', len(starts))
+
+        if self.nodata is not None:
+            found[found == self.nodata] = np.nan
+        values[inside] = found
+
+        return values
+
+    def _read_window(self, r0: int, r1: int, c0: int, c1: int) -> np.ndarray:
+        """Return the rows r0 to r1 and columns c0 to c1 (exclusive) of the raster.
+        """
+        if self._data is not None:
+            return self._data[r0:r1, c0:c1]
+
+        from rasterio.windows import Window
+        with self._lock:
+            return self._dataset.read(1, window=Window(c0, r0, c1 - c0, r1 - r0))
+
+    def _open_ascii_grid(self) -> None:
+        """Read the header of the ESRI ASCII grid and memory-map its binary copy, creating the
+        copy first if it does not exist or is older than the grid.
+        """
+        # ACCUMULATOR: header values keyed by lowercase name
+        header = {}
+        with open(self.filename) as f:
+            for _ in range(6):
+                position = f.tell()
+                parts = f.readline().split()
+                if parts == [] or not parts[0][0].isalpha():
+                    f.seek(position)  # the NODATA_value line is optional
+                    break
+                header[parts[0].lower()] = float(parts[1])
+
+            self.shape = (int(header['nrows']), int(header['ncols']))
+            self.cell_size = header['cellsize']
+            self.nodata = header.get('nodata_value')
+
+            # the lower-left corner is given either as the corner of the cell or its center
+            if 'xllcenter' in header:
+                self.left = header['xllcenter'] - self.cell_size / 2
+                bottom = header['yllcenter'] - self.cell_size / 2
+            else:
+                self.left = header['xllcorner']
+                bottom = header['yllcorner']
+            self.top = bottom + self.shape[0] * self.cell_size
+
+            binary = self.filename + '.npy'
+            count('files_opened')
+            if not os.path.exists(binary) \
+                    or os.path.getmtime(binary) < os.path.getmtime(self.filename):
+                converted = np.lib.format.open_memmap(binary, mode='w+', dtype=np.float32,
+                                                      shape=self.shape)
+                # convert row by row so the whole grid is never held in memory as text
+                for row in range(self.shape[0]):
+                    converted[row] = np.array(f.readline().split(), dtype=np.float32)
+                converted.flush()
+                del converted
+            else:
+                count('cache_hits')
+
+        self._data = np.load(binary, mmap_mode='r')
+
+    def _open_geotiff(self) -> None:
+        """Open the GeoTIFF file with rasterio and read its georeferencing.
+        """
+        try:
+            import rasterio
+        except ImportError:
+            raise ImportError('Reading GeoTIFF files requires the rasterio library') from None
+
+        count('files_opened')
+        self._dataset = rasterio.open(self.filename)
+        transform = self._dataset.transform
+        self.shape = (self._dataset.height, self._dataset.width)
+        self.cell_size = transform.a
+        self.left = transform.c
+        self.top = transform.f
+        self.nodata = self._dataset.nodata
@@ -0,0 +1,109 @@
+"""This module contains an ensemble version of the sea level projection in data_analysis.py.
+
+The projection in data_analysis.py gives one number per year, but both of its inputs are
+uncertain: the degree 6 temperature curve is fitted to noisy yearly values, and the constant
+relating sea level to the temperature integral is fitted to only 13 years of sea level data.
+Here, many versions (members) of the projection are computed at once:
+    - each member's temperature curve is fitted to the original curve plus a resampling of its
+      residuals (a residual bootstrap)
+    - each member's constant is fitted to a resampling of the 2006-2018 sea level points
+All members are evaluated together as NumPy matrix operations, so that percentile bands of the
+projected sea level can be computed for thousands of members in well under a second.
+"""
+from typing import Dict, List, Optional, Tuple, Union
+import numpy as np
+from dataset_cleaner import read_sea_level_data
+from data_analysis import PolynomialFit, fit_polynomials, evaluate_polynomials, \
+    integrate_anomalies, regression_slopes
+from sea_level_models import SeaLevelModel, get_model, term_responses, calibrate
+from instrumentation import timed
+
+# the years used to fit the proportionality constant, as in data_analysis.finding_constant
+CALIBRATION_YEARS = list(range(2006, 2019))
+
+
+@timed()
+def ensemble_predictions(temp: Dict[int, float], years: List[int], members: int = 1000,
+                         seed: Optional[Union[int, np.random.SeedSequence]] = None,
+                         model: Optional[str] = None) -> np.ndarray:
+    """Return an array of shape (members, len(years)), where row i is the sea level predicted by
+    ensemble member i for each year in years.
+
+    If model is given, every member predicts with the model registered under that name in
+    sea_level_models.py instead of the model of data_analysis.py.
+
+    Preconditions:
+        - members >= 1
+        - all(2006 <= year <= 2100 for year in years)
+        - all(2006 <= year <= 2100 for year in temp)
+    """
+    rng = np.random.default_rng(seed)
+    sea_levels = read_sea_level_data('datasets/global_timeseries_measures.nc.nc4')
+
+    # one temperature curve per member
+    curves = _bootstrap_temperature_curves(temp, members, rng)
+
+    if model is not None:
+        return _model_predictions(get_model(model), curves, years, sea_levels, rng)
+
+    # integrals for the calibration years and the requested years, shape (years, members)
+    integrals = integrate_anomalies(curves, CALIBRATION_YEARS + list(years))
+    calibration = integrals[:len(CALIBRATION_YEARS)]
+    projection = integrals[len(CALIBRATION_YEARS):]
+
+    # resample the calibration points for each member, shape (13, members)
+    picks = rng.integers(0, len(CALIBRATION_YEARS), size=(len(CALIBRATION_YEARS), members))
+    x = np.take_along_axis(calibration, picks, axis=0)
+    y = np.array([sea_levels[year] for year in CALIBRATION_YEARS], dtype=float)[picks]
+
+    # slope of the linear regression of sea level vs integral, for every member at once
+    constants = regression_slopes(x, y)
+
+    return (constants * projection).T
+
+
+def prediction_bands(temp: Dict[int, float], years: List[int], members: int = 1000,
+                     percentiles: Tuple[float, ...] = (5, 50, 95),
+                     seed: Optional[Union[int, np.random.SeedSequence]] = None,
+                     model: Optional[str] = None) -> np.ndarray:
+    """Return an array of shape (len(percentiles), len(years)), where row i contains the
+    percentiles[i]-th percentile of the ensemble's predicted sea level for each year in years,
+    predicted with model (see ensemble_predictions).
+
+    Preconditions:
+        - members >= 1
+        - all(0 <= p <= 100 for p in percentiles)
+    """
+    predictions = ensemble_predictions(temp, years, members, seed, model)
+    return np.percentile(predictions, percentiles, axis=0)
+
+
+def _model_predictions(model: SeaLevelModel, curves: PolynomialFit, years: List[int],
+                       sea_levels: Dict[int, float], rng: np.random.Generator) -> np.ndarray:
+    """Return the predictions of ensemble_predictions for the members' temperature curves, made
+    with model, with the calibration points resampled for each member in the same way.
+    """
+    members = curves.coefficients.shape[1]
+    responses = term_responses(model, curves, CALIBRATION_YEARS + list(years))
+
+    picks = rng.integers(0, len(CALIBRATION_YEARS), size=(len(CALIBRATION_YEARS), members))
+    x = np.take_along_axis(responses[:, :len(CALIBRATION_YEARS)], picks[np.newaxis], axis=1)
+    y = np.array([sea_levels[year] for year in CALIBRATION_YEARS], dtype=float)[picks]
+
+    coefficients = calibrate(x, y)
+    return np.einsum('iys,is->sy', responses[:, len(CALIBRATION_YEARS):], coefficients)
+
+
+def _bootstrap_temperature_curves(temp: Dict[int, float], members: int,
+                                  rng: np.random.Generator) -> PolynomialFit:
+    """Return members temperature curves, fitted to temp plus resampled residuals of the fit to
+    temp.
+    """
+    years = np.array(list(temp), dtype=float)
+    values = np.array([temp[year] for year in temp], dtype=float)
+
+    fitted = evaluate_polynomials(fit_polynomials(years, values), years)[:, 0]
+    residuals = values - fitted
+
+    resampled = residuals[rng.integers(0, len(residuals), size=(len(residuals), members))]
+    return fit_polynomials(years, fitted[:, np.newaxis] + resampled)
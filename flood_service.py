@@ -0,0 +1,336 @@
+"""This module serves flood depth queries over HTTP, so other programs can ask about any location
+instead of reading the bubble map.
+
+The altitudes and the sea level predictions are loaded into memory once, when the service
+starts, and every query is answered from those arrays by the asyncio event loop, so many clients
+can be connected at once. Queries:
+    GET /depth?lat=45.3&lon=-75.7&year=2050
+        the flood depth at a location in a year (0 if it does not flood, and null if the location
+        is outside the map or more than about one grid cell from every location of
+        altitude_data, where there is no altitude to compare)
+    GET /flooded?south=44&west=-80&north=46&east=-74&year=2050
+        the locations in a bounding box that flood in a year, with their depths
+    GET /totals?year=2050
+        the number of flooded cells and the flooded area (in square kilometres) of each region
+        in a year (see aggregation.py)
+    POST /depth, POST /flooded and POST /totals
+        several queries at once, sent as {"queries": [{...}, ...]} with the same fields as the
+        GET parameters, and answered as {"results": [...]} in the same order
+
+Years between the predicted decades are interpolated linearly, and the altitude at a location
+between the points of altitude_data is interpolated with a spatial_index.PointIndex.
+
+Run the service, and measure it with the load generator in this module:
+    python flood_service.py serve --port 8000
+    python flood_service.py bench --port 8000 --clients 32 --requests 5000
+"""
+from typing import Any, Dict, List, Optional, Tuple
+import argparse
+import asyncio
+import json
+import time
+from urllib.parse import parse_qsl, urlsplit
+import numpy as np
+from flooding import DECADES, FloodResult, altitude_arrays, region_ids, prediction_creator
+from aggregation import flooded_totals
+from map_tiles import grid_layout
+from map_setup import MapArea, CANADA
+from spatial_index import PointIndex, DEGREE_LENGTH
+from instrumentation import count
+
+# the largest request body accepted, in bytes
+MAX_BODY = 16 * 1024 * 1024
+
+
+class QueryError(Exception):
+    """Raised when a query is missing a field or asks for something that cannot be answered."""
+
+
+class FloodModel:
+    """The altitudes and sea level predictions that queries are answered from.
+
+    Instance Attributes:
+        - index: a spatial index of the locations, with their altitudes as values
+        - regions: the region (prediction row) of each location, or -1 if it has none
+        - projections: the predicted sea level of each region (rows) in each year (columns)
+        - years: the years of the columns of projections, in increasing order
+        - my_map: the map whose quadrants are the regions
+        - cell_size: the (height, width) in degrees of the grid cell around each location
+        - max_distance: the furthest a query can be from its nearest location, in kilometres,
+          for its altitude to be interpolated: the diagonal of the widest grid cell
+
+    Representation Invariants:
+        - len(self.regions) == len(self.index.coords)
+        - self.projections.shape[1] == len(self.years)
+    """
+    index: PointIndex
+    regions: np.ndarray
+    projections: np.ndarray
+    years: List[int]
+    my_map: MapArea
+    cell_size: Tuple[float, float]
+    max_distance: float
+
+    def __init__(self, altitudes: Dict[Tuple[float, float], float],
+                 predictions: Optional[tuple] = None, my_map: MapArea = CANADA,
+                 years: Optional[List[int]] = None) -> None:
+        """Load the model from altitudes and the output of flooding.prediction_creator(), which
+        is computed if predictions is not given.
+        """
+        coords, elevations = altitude_arrays(altitudes)
+        self.index = PointIndex(coords, elevations)
+        self.my_map = my_map
+        self.regions = region_ids(coords, my_map)
+        self.projections = np.array(prediction_creator() if predictions is None
+                                    else predictions, dtype=float)
+        self.years = DECADES if years is None else years
+
+        layout, _, _ = grid_layout(coords)
+        self.cell_size = (layout[1], layout[4])
+        widest = np.cos(np.radians(np.abs(coords[:, 0]).min()))
+        self.max_distance = DEGREE_LENGTH * float(np.hypot(layout[1], layout[4] * widest))
+
+    def depths(self, lats: np.ndarray, lons: np.ndarray, years: np.ndarray) -> np.ndarray:
+        """Return the flood depth at each location (lats[i], lons[i]) in years[i]: how far the
+        predicted sea level is above the location's altitude, or 0 if it is below. Locations
+        with no prediction, outside my_map, or further than max_distance from every location are
+        given nan.
+
+        >>> model = FloodModel({(45.0, -100.0): 0.0, (45.0, -99.0): 0.0, (46.0, -100.0): 2.0,
+        ...                     (46.0, -99.0): 2.0}, [[1.0] * 9] * 4)
+        >>> model.depths(np.array([45.5, 10.0, 80.0]), np.array([-99.5, 50.0, -60.0]),
+        ...              np.array([2050, 2050, 2050])).tolist()
+        [0.0, nan, nan]
+        >>> model.depths(np.array([45.0]), np.array([-99.0]), np.array([2050])).tolist()
+        [1.0]
+        """
+        queries = np.column_stack([lats, lons])
+        elevations = self.index.bilinear(queries)
+        regions = region_ids(queries, self.my_map)
+        distances, _ = self.index.nearest(queries)
+        known = (regions >= 0) & self.my_map.contains(queries) \
+            & (distances[:, 0] <= self.max_distance)
+
+        sea_levels = self._sea_levels(years)[np.maximum(regions, 0), np.arange(len(queries))]
+        return np.where(known, np.maximum(sea_levels - elevations, 0), np.nan)
+
+    def flooded(self, south: float, west: float, north: float, east: float, year: int) \
+            -> List[List[float]]:
+        """Return [latitude, longitude, depth] for every location of altitude_data in the
+        bounding box that floods in year.
+        """
+        points = self.index.in_box(south, west, north, east)
+        regions = self.regions[points]
+        points, regions = points[regions >= 0], regions[regions >= 0]
+
+        depth = self._sea_levels(np.array([year]))[regions, 0] - self.index.values[points]
+        flooded = depth >= 0
+
+        return np.column_stack([self.index.coords[points[flooded]],
+                                depth[flooded]]).tolist()
+
+    def totals(self, year: float) -> Dict[str, List[float]]:
+        """Return the number of flooded cells ('cells') and the flooded area in square
+        kilometres ('area') of each region in year.
+        """
+        depth = self._sea_levels(np.array([year]))[self.regions, 0] - self.index.values
+        flooded = np.flatnonzero((depth >= 0) & (self.regions >= 0))
+
+        result = FloodResult.from_points(self.index.coords, flooded,
+                                         np.zeros(len(flooded), dtype=np.int64), depth[flooded],
+                                         [year])
+        totals = flooded_totals(result, self.regions[flooded], len(self.projections),
+                                self.cell_size)
+        return {name: values[:, 0].tolist() for name, values in totals.items()}
+
+    def _sea_levels(self, years: np.ndarray) -> np.ndarray:
+        """Return the predicted sea level of every region (rows) in each of years (columns),
+        interpolated between the predicted years.
+        """
+        years = np.asarray(years, dtype=float)
+        if len(years) > 0 and (years.min() < self.years[0] or years.max() > self.years[-1]):
+            raise QueryError('year must be between %d and %d' % (self.years[0], self.years[-1]))
+
+        return np.array([np.interp(years, self.years, row) for row in self.projections])
+
+
+def answer(model: FloodModel, path: str, queries: List[Dict[str, Any]]) -> List[Any]:
+    """Return the answers to queries of the given path ('/depth' or '/flooded'), in order.
+    Every /depth query is answered at once.
+    """
+    if path == '/depth':
+        lats, lons, years = (np.array([_number(query, key) for query in queries])
+                             for key in ('lat', 'lon', 'year'))
+        depths = model.depths(lats, lons, years)
+        return [None if np.isnan(depth) else float(depth) for depth in depths]
+    elif path == '/flooded':
+        return [model.flooded(_number(query, 'south'), _number(query, 'west'),
+                              _number(query, 'north'), _number(query, 'east'),
+                              _number(query, 'year'))
+                for query in queries]
+    elif path == '/totals':
+        return [model.totals(_number(query, 'year')) for query in queries]
+    else:
+        raise KeyError(path)
+
+
+async def serve(model: FloodModel, host: str = '127.0.0.1', port: int = 8000) -> None:
+    """Answer queries of model over HTTP on host:port until cancelled."""
+    server = await asyncio.start_server(lambda reader, writer: _handle(model, reader, writer),
+                                        host, port)
+    async with server:
+        await server.serve_forever()
+
+
+async def load_test(host: str, port: int, clients: int = 32, requests: int = 5000,
+                    batch: int = 1, my_map: MapArea = CANADA, seed: Optional[int] = None) \
+        -> Dict[str, float]:
+    """Send requests /depth queries of batch random locations to the service at host:port from
+    clients concurrent connections, and return the throughput and latency percentiles.
+    """
+    rng = np.random.default_rng(seed)
+    latencies = []
+
+    async def client(n: int) -> None:
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for _ in range(n):
+                queries = [{'lat': float(rng.uniform(*my_map.latitude)),
+                            'lon': float(rng.uniform(*my_map.longitude)),
+                            'year': int(rng.integers(DECADES[0], DECADES[-1] + 1))}
+                           for _ in range(batch)]
+                body = json.dumps({'queries': queries}).encode()
+                start = time.perf_counter()
+                writer.write(b'POST /depth HTTP/1.1\r\nHost: %s\r\nContent-Type: application/json'
+                             b'\r\nContent-Length: %d\r\n\r\n' % (host.encode(), len(body)) + body)
+                status, _ = await _read_message(reader)
+                latencies.append(time.perf_counter() - start)
+                if status.split()[1] != b'200':
+                    raise RuntimeError('service answered ' + status.decode())
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client(requests // clients + (i < requests % clients))
+                           for i in range(clients)])
+    elapsed = time.perf_counter() - start
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    return {'requests': len(latencies), 'seconds': elapsed,
+            'requests_per_second': len(latencies) / elapsed,
+            'queries_per_second': len(latencies) * batch / elapsed,
+            'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99}
+
+
+async def _handle(model: FloodModel, reader: asyncio.StreamReader,
+                  writer: asyncio.StreamWriter) -> None:
+    """Answer the requests of one client connection, keeping it open between requests unless
+    the client asks to close it.
+    """
+    try:
+        while True:
+            try:
+                request_line, headers, body = await _read_request(reader)
+            except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+                return
+
+            status, answer_body = _respond(model, request_line, body)
+            count('service_requests')
+            writer.write(b'HTTP/1.1 %s\r\nContent-Type: application/json\r\n'
+                         b'Content-Length: %d\r\n\r\n' % (status.encode(), len(answer_body))
+                         + answer_body)
+            await writer.drain()
+
+            if headers.get('connection', '').lower() == 'close':
+                return
+    finally:
+        writer.close()
+
+
+def _respond(model: FloodModel, request_line: bytes, body: bytes) -> Tuple[str, bytes]:
+    """Return the HTTP status and the JSON body answering the request."""
+    try:
+        method, target, _ = request_line.decode('latin-1').split()
+        url = urlsplit(target)
+
+        if method == 'GET':
+            result = answer(model, url.path, [dict(parse_qsl(url.query))])[0]
+        elif method == 'POST':
+            queries = json.loads(body)['queries']
+            result = {'results': answer(model, url.path, queries)}
+        else:
+            return ('405 Method Not Allowed', json.dumps({'error': 'use GET or POST'}).encode())
+    except KeyError as error:
+        if error.args == (url.path,):
+            return ('404 Not Found', json.dumps({'error': 'unknown path ' + url.path}).encode())
+        return ('400 Bad Request', json.dumps({'error': 'missing ' + str(error)}).encode())
+    except (QueryError, ValueError, TypeError) as error:
+        return ('400 Bad Request', json.dumps({'error': str(error)}).encode())
+
+    if url.path == '/depth' and method == 'GET':
+        result = {'depth': result}
+    elif url.path == '/flooded' and method == 'GET':
+        result = {'points': result}
+
+    return ('200 OK', json.dumps(result).encode())
+
+
+async def _read_request(reader: asyncio.StreamReader) -> Tuple[bytes, Dict[str, str], bytes]:
+    """Return the request line, headers (with lowercase names) and body of the next request."""
+    request_line, headers = await _read_message(reader, body=False)
+    length = int(headers.get('content-length', 0))
+    if length > MAX_BODY:
+        raise ValueError('request body too large')
+    body = await reader.readexactly(length) if length > 0 else b''
+    return (request_line, headers, body)
+
+
+async def _read_message(reader: asyncio.StreamReader, body: bool = True) -> Tuple[bytes, Any]:
+    """Return the first line and the headers (with lowercase names) of the next HTTP message,
+    or its first line and body if body is True.
+    """
+    first_line = (await reader.readuntil(b'\r\n')).rstrip()
+    if first_line == b'':
+        raise ConnectionError('connection closed')
+
+    headers = {}
+    line = await reader.readuntil(b'\r\n')
+    while line != b'\r\n':
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+        line = await reader.readuntil(b'\r\n')
+
+    if not body:
+        return (first_line, headers)
+    return (first_line, await reader.readexactly(int(headers.get('content-length', 0))))
+
+
+def _number(query: Dict[str, Any], key: str) -> float:
+    """Return the number in query[key], which may be a string from a GET parameter."""
+    return float(query[key])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve flood depth queries over HTTP.')
+    parser.add_argument('command', choices=['serve', 'bench'])
+    parser.add_argument('--host', default='127.0.0.1', help='the address to serve on')
+    parser.add_argument('--port', type=int, default=8000, help='the port to serve on')
+    parser.add_argument('--clients', type=int, default=32,
+                        help='when benchmarking, the number of concurrent connections')
+    parser.add_argument('--requests', type=int, default=5000,
+                        help='when benchmarking, the total number of requests')
+    parser.add_argument('--batch', type=int, default=1,
+                        help='when benchmarking, the number of queries per request')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        from datasets.AltitudeData import altitude_data
+        print('Loading the model...')
+        service_model = FloodModel(altitude_data)
+        print('Serving on http://%s:%d' % (args.host, args.port))
+        asyncio.run(serve(service_model, args.host, args.port))
+    else:
+        results = asyncio.run(load_test(args.host, args.port, args.clients, args.requests,
+                                        args.batch))
+        for name, value in results.items():
+            print('%-20s %12.2f' % (name, value))
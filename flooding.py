@@ -1,13 +1,26 @@
 """This module contains functions that compare the altitude at a point to the current sea level.
 """
-from typing import Dict, Tuple, List
+from typing import Dict, Iterable, Tuple, List, Optional
+from dataclasses import dataclass
+import numpy as np
 from datasets.Temperatures import temp1, temp2, temp3, temp4
-from data_analysis import sea_level_prediction
+from data_analysis import sea_level_prediction, sea_level_projections, fit_polynomials
+from sea_level_models import model_projections
+from ensembles import prediction_bands
 from altitudes import split_into_grid
-from map_setup import MapArea
+from map_setup import MapArea, CANADA
+from regions import RegionIndex
+from instrumentation import timed
 
 
-def compare_altitude_to_sea_level(altitudes: Dict) -> Dict:
+@timed()
+def compare_altitude_to_sea_level(altitudes: Dict, members: int = 0,
+                                  seed: Optional[int] = None,
+                                  predictions: Optional[tuple] = None,
+                                  regions: Optional[RegionIndex] = None,
+                                  compact: bool = False,
+                                  land: Optional[np.ndarray] = None,
+                                  my_map: MapArea = CANADA) -> Dict:
     """Returns a dictionary with keys 'year', 'lat', 'lon', 'diff'.
     The values in diff are the differences between each location's predicted sea level and
     altitude throughout each decade of 2020-2100.
@@ -15,41 +28,186 @@ def compare_altitude_to_sea_level(altitudes: Dict) -> Dict:
     The values in the returned dictionary will only contain those below sea level (negative
     difference).
 
+    If members is positive, the sea level is instead predicted by an ensemble of that many
+    members (see ensembles.py). The returned dictionary then has two more keys, 'diff_low' and
+    'diff_high', with the 5th and 95th percentiles of the difference, while 'diff' is the median.
+    Every location whose 95th percentile is below sea level is included.
+
+    If predictions is given, it is used instead of computing the sea level predictions again. It
+    must be the output of prediction_creator(), or of ensemble_prediction_creator(members, seed)
+    if members is positive.
+
+    If regions is given, each location uses the predictions of the region it lies in (see
+    regions.py) instead of the quadrant of my_map (the map of Canada by default), and locations
+    outside every region are skipped. Unless predictions is given, they are computed from the
+    temperature series in each region's 'temperature' property.
+
+    If compact is True, the same results are returned as a FloodResult, which stores them in a
+    fraction of the memory, instead of a dictionary.
+
+    If land is given, it is the land mask of the locations in altitudes, in the same order (see
+    land_mask.py), and the water locations are skipped.
+
     Preconditions:
         - all(-90 <= location[0] <= 90 for location in altitudes)
         - all(-180 <= location[1] <= 180 for location in altitudes)
         - altitudes is formatted in the same way as the values in AltitudeData
     """
-    # ACCUMULATOR
-    full_data = {'year': [], 'lat': [], 'lon': [], 'diff': []}
+    # find the region of every location: the quadrants of my_map by default
+    coords, elevations = altitude_arrays(altitudes)
+    if regions is None:
+        temps = [temp1, temp2, temp3, temp4]
+        region_numbers = region_ids(coords, my_map)
+    else:
+        temps = None if predictions is not None else region_temperatures(regions)
+        region_numbers = regions.assign(coords)
 
-    # create map of canada
-    map_area = MapArea((40.0, 84.0), (-146.0, -50.0))
+    if land is not None:
+        region_numbers = np.where(land, region_numbers, -1)
 
-    # get sea level predictions for 4 locations
-    predictions = prediction_creator()
+    if members > 0:
+        if predictions is None:
+            predictions = ensemble_prediction_creator(members, seed, temps)
+        point_index, year_index, depth, low, high = _compare_to_ensemble(
+            elevations, region_numbers, np.array(predictions))
+    else:
+        # get sea level predictions for each region
+        if predictions is None:
+            predictions = prediction_creator() if regions is None \
+                else regional_prediction_creator(temps)
 
-    for location in altitudes:
-        # select corresponding sea level prediction list
-        category = categorize(location, map_area, predictions)
-        # get the altitude of that point
-        altitude = altitudes[location]
+        # compare every location in every decade at once
+        point_index, year_index, depth = flooded_points(elevations, region_numbers,
+                                                        np.array(predictions))
+        low = high = None
 
-        # loop through decades from 2020 to 2100
-        for i in range(2020, 2101, 10):
-            sea_level = category[(i - 2020) // 10]  # get sea level for this year
-            difference = sea_level - altitude
+    if compact:
+        return FloodResult.from_points(coords, point_index, year_index, depth, low=low,
+                                       high=high)
 
-            # if difference is positive, add to accumulator
-            if difference >= 0:
-                full_data['year'].append(i)
-                full_data['lat'].append(location[0])
-                full_data['lon'].append(location[1])
-                full_data['diff'].append(difference)
+    full_data = long_format(coords, point_index, year_index, depth)
+    if low is not None:
+        full_data['diff_low'] = low.tolist()
+        full_data['diff_high'] = high.tolist()
 
     return full_data
 
 
+@timed()
+def update_comparison(result: 'FloodResult', changes: Dict[Tuple[float, float], Optional[float]],
+                      removed: Iterable[Tuple[float, float]] = (),
+                      predictions: Optional[tuple] = None,
+                      regions: Optional[RegionIndex] = None,
+                      land: Optional[np.ndarray] = None,
+                      my_map: MapArea = CANADA) -> 'FloodResult':
+    """Return result, a compact output of compare_altitude_to_sea_level, updated for new or
+    changed altitudes and removed locations, without comparing the unchanged locations again.
+
+    changes maps each added or changed location to its new altitude (None removes it, as
+    get_altitude_data leaves out locations with no altitude), and removed lists more locations to
+    remove. predictions, regions and my_map must be the same as for the call that made result,
+    except that predictions are computed again if not given. If result was made with a land
+    mask, land must be the land mask of the locations in changes, in the same order (see
+    land_mask.py), and the water locations are skipped, as compare_altitude_to_sea_level does.
+    The locations of the returned result are in (latitude, longitude) order.
+
+    The compared rows of the changed locations are merged into the rows of result, which are
+    kept in order, so an update only sorts the changed locations (result is sorted once first if
+    its locations are not in (latitude, longitude) order). A bubble map of result can be updated
+    the same way with bubble.update_figure.
+
+    Preconditions:
+        - result.depth_low is None or predictions is not None
+        - land is None or len(land) == len(changes)
+
+    >>> altitudes = {(45.0, -120.0): 0.0, (45.0, -60.0): 5.0}
+    >>> predictions = ([1.0] * 9,) * 4
+    >>> result = compare_altitude_to_sea_level(altitudes, predictions=predictions, compact=True,
+    ...                                        land=np.array([False, True]))
+    >>> changes = {(50.0, -100.0): 0.0, (45.0, -60.0): 0.5}
+    >>> updated = update_comparison(result, changes, predictions=predictions,
+    ...                             land=np.array([False, True]))
+    >>> full = compare_altitude_to_sea_level({**altitudes, **changes}, predictions=predictions,
+    ...                                      compact=True, land=np.array([False, True, False]))
+    >>> updated.coords.tolist(), updated.depth.tolist() == full.depth.tolist()
+    ([[45.0, -60.0]], True)
+    """
+    if not _in_location_order(result.coords):
+        result = _sort_locations(result)
+
+    stale = np.array(list(changes) + list(removed), dtype=float).reshape(-1, 2)
+    coords, elevations = altitude_arrays({location: altitude
+                                          for location, altitude in changes.items()
+                                          if altitude is not None})
+    order = np.lexsort((coords[:, 1], coords[:, 0]))
+    coords, elevations = coords[order], elevations[order]
+    if land is not None:
+        land = np.asarray(land, dtype=bool)[[altitude is not None
+                                             for altitude in changes.values()]][order]
+
+    # compare only the changed locations
+    if regions is None:
+        region_numbers = region_ids(coords, my_map)
+        if predictions is None:
+            predictions = prediction_creator()
+    else:
+        region_numbers = regions.assign(coords)
+        if predictions is None:
+            predictions = regional_prediction_creator(region_temperatures(regions))
+
+    if land is not None:
+        region_numbers = np.where(land, region_numbers, -1)
+
+    predictions = np.array(predictions)
+    if predictions.ndim == 3:
+        point_index, year_index, depth, low, high = _compare_to_ensemble(
+            elevations, region_numbers, predictions)
+    else:
+        point_index, year_index, depth = flooded_points(elevations, region_numbers, predictions)
+        low = high = None
+
+    # remove the changed locations from result, and insert the ones that flood now in order
+    keys = _location_keys(result.coords)
+    stale_keys = _location_keys(stale)
+    position = np.minimum(np.searchsorted(keys, stale_keys), max(len(keys) - 1, 0))
+    kept_coords = np.ones(len(keys), dtype=bool)
+    if len(keys) > 0:
+        kept_coords[position[keys[position] == stale_keys]] = False
+
+    used, point_index = np.unique(point_index, return_inverse=True)
+    point_index = point_index.reshape(-1)
+    kept_keys = keys[kept_coords]
+    inserted = np.searchsorted(kept_keys, _location_keys(coords[used]))
+    all_coords = np.insert(result.coords[kept_coords], inserted, coords[used], axis=0)
+
+    # the new row of every location: kept locations move down by the locations inserted before
+    # them, and the i-th inserted location goes after the i locations inserted before it
+    kept_rows = np.cumsum(kept_coords) - 1
+    old_rows = kept_rows + np.searchsorted(inserted, kept_rows, side='right')
+    new_rows = inserted + np.arange(len(inserted))
+
+    # merge the new flooded rows into the rows of each year, which are sorted by location
+    kept = kept_coords[result.point_index]
+    old_years = np.repeat(np.arange(len(result.years)), np.diff(result.offsets))[kept]
+    old_index = old_rows[result.point_index[kept]]
+    year_order = np.lexsort((point_index, year_index))
+    year_index = year_index[year_order]
+    new_index = new_rows[point_index[year_order]]
+    at = np.searchsorted(old_years * len(all_coords) + old_index,
+                         year_index * len(all_coords) + new_index)
+
+    kept_before = np.concatenate([[0], np.cumsum(kept)])[result.offsets]
+    offsets = kept_before + np.searchsorted(year_index, np.arange(len(result.years) + 1))
+
+    def merge(old: Optional[np.ndarray], new: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        return None if old is None else np.insert(old[kept], at, new[year_order])
+
+    return FloodResult(list(result.years), all_coords, offsets,
+                       np.insert(old_index, at, new_index).astype(np.int32),
+                       merge(result.depth, depth), merge(result.depth_low, low),
+                       merge(result.depth_high, high))
+
+
 def prediction_creator() -> Tuple[List[float], List[float], List[float], List[float]]:
     """Returns a tuple containing lists of predicted sea level rises for each decade from 2020-2100
     in 4 different geographical points.
@@ -70,6 +228,89 @@ def prediction_creator() -> Tuple[List[float], List[float], List[float], List[fl
     return (p1, p2, p3, p4)
 
 
+def regional_prediction_creator(temps: List[Dict[int, float]]) -> List[List[float]]:
+    """Returns a list containing a list of predicted sea level rises for each decade from
+    2020-2100 for every temperature series in temps, all computed at once.
+
+    Preconditions:
+        - temps != []
+        - all(list(temp) == list(temps[0]) for temp in temps)
+    """
+    temp_years = np.array(list(temps[0]), dtype=float)
+    temperatures = np.array([[temp[year] for temp in temps] for year in temps[0]])
+
+    return sea_level_projections(DECADES, temp_years, temperatures).T.tolist()
+
+
+def model_prediction_creator(model: str, temps: Optional[List[Dict[int, float]]] = None) \
+        -> Tuple[List[float], ...]:
+    """Returns a tuple containing lists of predicted sea level rises for each decade from
+    2020-2100 in the same 4 geographical points as prediction_creator, predicted with the model
+    registered under the given name in sea_level_models.py.
+
+    If temps is given, the predictions are made for each of those temperature series instead.
+
+    Preconditions:
+        - temps is None or temps != []
+        - temps is None or all(list(temp) == list(temps[0]) for temp in temps)
+    """
+    if temps is None:
+        temps = [temp1, temp2, temp3, temp4]
+
+    temp_years = np.array(list(temps[0]), dtype=float)
+    temperatures = np.array([[temp[year] for temp in temps] for year in temps[0]])
+    fit = fit_polynomials(temp_years, temperatures)
+
+    return tuple(model_projections(model, DECADES, fit).T.tolist())
+
+
+def region_temperatures(regions: RegionIndex) -> List[Dict[int, float]]:
+    """Returns the temperature series stored in the 'temperature' property of each region,
+    with the years converted to integers (GeoJSON keys are always strings).
+    """
+    return [{int(year): float(value) for year, value in region.properties['temperature'].items()}
+            for region in regions.regions]
+
+
+def ensemble_prediction_creator(members: int, seed: Optional[int] = None,
+                                temps: Optional[List[Dict[int, float]]] = None,
+                                model: Optional[str] = None) \
+        -> Tuple[List[List[float]], ...]:
+    """Returns a tuple containing the 5th, 50th and 95th percentile lists of predicted sea level
+    rises for each decade from 2020-2100 in the same 4 geographical points as prediction_creator,
+    using an ensemble of the given number of members.
+
+    If temps is given, the bands are computed for each of those temperature series instead. If
+    model is given, the members predict with that model of sea_level_models.py. Each series
+    draws its own independent random numbers, derived from seed.
+    """
+    if temps is None:
+        temps = [temp1, temp2, temp3, temp4]
+
+    seeds = np.random.SeedSequence(seed).spawn(len(temps))
+    return tuple(prediction_bands(temp, DECADES, members, (5, 50, 95), series_seed,
+                                  model).tolist()
+                 for temp, series_seed in zip(temps, seeds))
+
+
+def _compare_to_ensemble(elevations: np.ndarray, regions: np.ndarray, bands: np.ndarray) \
+        -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Returns (point_index, year_index, median, low, high) for every point and year where the
+    upper ensemble band floods, with the median, 5th and 95th percentile differences between
+    predicted sea level and altitude. bands are the prediction bands of
+    ensemble_prediction_creator, with shape (regions, 3, decades).
+    """
+    # include the point if it floods in at least the upper band
+    point_index, year_index, high = flooded_points(elevations, regions, bands[:, 2])
+
+    # the other bands of the same points and years
+    region_index = regions[point_index]
+    low = bands[region_index, 0, year_index] - elevations[point_index]
+    median = bands[region_index, 1, year_index] - elevations[point_index]
+
+    return (point_index, year_index, median, low, high)
+
+
 def categorize(location: Tuple[float, float], my_map: MapArea,
                predictions: Tuple[List[float], List[float], List[float], List[float]]) \
         -> List[float]:
@@ -88,14 +329,275 @@ def categorize(location: Tuple[float, float], my_map: MapArea,
     latitude_limit = grid[0][1]
     longitude_limit = grid[1][1]
 
+    # the longitude of the location, continuing past 180 if my_map crosses the antimeridian
+    longitude = float(my_map.unwrap(location[1]))
+
     # select corresponding prediction
-    if location[0] < latitude_limit and location[1] < longitude_limit:  # bottom-left
+    if location[0] < latitude_limit and longitude < longitude_limit:  # bottom-left
         prediction = predictions[0]
-    elif location[0] < latitude_limit and location[1] > longitude_limit:  # bottom-right
+    elif location[0] < latitude_limit and longitude > longitude_limit:  # bottom-right
         prediction = predictions[1]
-    elif location[0] > latitude_limit and location[1] < longitude_limit:  # top-left
+    elif location[0] > latitude_limit and longitude < longitude_limit:  # top-left
         prediction = predictions[2]
-    elif location[0] > latitude_limit and location[1] > longitude_limit:  # top-right
+    elif location[0] > latitude_limit and longitude > longitude_limit:  # top-right
         prediction = predictions[3]
 
     return prediction
+
+
+###################################################################################################
+# Array versions
+###################################################################################################
+# the decades that sea level is predicted for, as returned by prediction_creator
+DECADES = list(range(2020, 2101, 10))
+
+
+def altitude_arrays(altitudes: Dict[Tuple[float, float], float]) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    """Return the locations in altitudes as an array of shape (points, 2), with rows of
+    (latitude, longitude), and their altitudes as an array of shape (points,), in the same order.
+
+    >>> coords, elevations = altitude_arrays({(45.0, -75.0): 70.0, (50.0, -60.0): 0.0})
+    >>> coords.tolist(), elevations.tolist()
+    ([[45.0, -75.0], [50.0, -60.0]], [70.0, 0.0])
+    """
+    coords = np.array(list(altitudes), dtype=float).reshape(-1, 2)
+    elevations = np.array(list(altitudes.values()), dtype=float)
+    return (coords, elevations)
+
+
+def region_ids(coords: np.ndarray, my_map: MapArea) -> np.ndarray:
+    """Return the quadrant of my_map that each location in coords lies in, numbered like the
+    prediction lists in categorize (0 is bottom-left, 1 bottom-right, 2 top-left, 3 top-right).
+    Locations on the border between two quadrants are given -1, as categorize gives them no
+    prediction list.
+
+    >>> map1 = MapArea((40.0, 84.0), (-146.0, -50.0))
+    >>> region_ids(np.array([[45.0, -120.0], [45.0, -60.0], [70.0, -98.0]]), map1).tolist()
+    [0, 1, -1]
+    >>> map2 = MapArea((40.0, 84.0), (170.0, -170.0))
+    >>> region_ids(np.array([[45.0, 175.0], [45.0, -175.0]]), map2).tolist()
+    [0, 1]
+    """
+    # split map into quadrants (2*2 grid)
+    grid = split_into_grid(2, 2, my_map)
+    latitude_limit = grid[0][1]
+    longitude_limit = grid[1][1]
+    longitudes = my_map.unwrap(coords[:, 1])
+
+    regions = 2 * (coords[:, 0] > latitude_limit) + (longitudes > longitude_limit)
+    on_border = (coords[:, 0] == latitude_limit) | (longitudes == longitude_limit)
+
+    return np.where(on_border, -1, regions)
+
+
+def flooded_points(elevations: np.ndarray, regions: np.ndarray, projections: np.ndarray) \
+        -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return (point_index, year_index, depth) for every point and year where the predicted sea
+    level is at or above the point's altitude, ordered by point and then by year.
+
+    projections has one row of predicted sea levels per region, with one column per year, and
+    regions gives the row of each point (-1 for points with no prediction).
+
+    >>> flooded_points(np.array([5.0, 1.0]), np.array([0, 0]), np.array([[2.0, 6.0]]))
+    (array([0, 1, 1]), array([1, 0, 1]), array([1., 1., 5.]))
+    """
+    depth = projections[regions] - elevations[:, np.newaxis]
+    flooded = (depth >= 0) & (regions >= 0)[:, np.newaxis]
+
+    point_index, year_index = np.nonzero(flooded)
+    return (point_index, year_index, depth[point_index, year_index])
+
+
+def long_format(coords: np.ndarray, point_index: np.ndarray, year_index: np.ndarray,
+                depth: np.ndarray, years: Optional[List[int]] = None) -> Dict[str, list]:
+    """Return the dictionary with keys 'year', 'lat', 'lon', 'diff' described in
+    compare_altitude_to_sea_level, for the output of flooded_points.
+    """
+    if years is None:
+        years = DECADES
+
+    return {'year': np.array(years)[year_index].tolist(),
+            'lat': coords[point_index, 0].tolist(),
+            'lon': coords[point_index, 1].tolist(),
+            'diff': depth.tolist()}
+
+
+@dataclass
+class FloodResult:
+    """The locations below the predicted sea level in each year, stored compactly.
+
+    The coordinates of each flooded location are stored once, however many years it floods in.
+    The locations flooded in years[i] are point_index[offsets[i]:offsets[i + 1]], and their
+    depths (the differences between predicted sea level and altitude) are the same slice of
+    depth, stored as 32-bit floats.
+
+    Instance Attributes:
+        - years: the years compared
+        - coords: the (latitude, longitude) of every location that floods in at least one year
+        - offsets: where each year's slice of point_index and depth starts, and where the last ends
+        - point_index: the row of coords of each flooded location, year by year
+        - depth: the depth of each flooded location, in the same order as point_index
+        - depth_low: the 5th percentile depths if the result is from an ensemble, or None
+        - depth_high: the 95th percentile depths if the result is from an ensemble, or None
+
+    Representation Invariants:
+        - len(self.offsets) == len(self.years) + 1
+        - self.offsets[-1] == len(self.point_index) == len(self.depth)
+    """
+    years: List[int]
+    coords: np.ndarray
+    offsets: np.ndarray
+    point_index: np.ndarray
+    depth: np.ndarray
+    depth_low: Optional[np.ndarray] = None
+    depth_high: Optional[np.ndarray] = None
+
+    @staticmethod
+    def from_points(coords: np.ndarray, point_index: np.ndarray, year_index: np.ndarray,
+                    depth: np.ndarray, years: Optional[List[int]] = None,
+                    low: Optional[np.ndarray] = None,
+                    high: Optional[np.ndarray] = None) -> 'FloodResult':
+        """Return the FloodResult of the output of flooded_points for the locations in coords,
+        keeping only the coordinates of the locations that flood.
+
+        >>> result = FloodResult.from_points(np.array([[1.0, 2.0], [3.0, 4.0]]), np.array([1, 1]),
+        ...                                  np.array([0, 1]), np.array([0.5, 1.5]), [2020, 2030])
+        >>> result.coords.tolist(), result.offsets.tolist(), result.point_index.tolist()
+        ([[3.0, 4.0]], [0, 1, 2], [0, 0])
+        """
+        if years is None:
+            years = DECADES
+
+        used, point_index = np.unique(point_index, return_inverse=True)
+        order = np.lexsort((point_index, year_index))
+        offsets = np.searchsorted(year_index[order], np.arange(len(years) + 1))
+
+        def by_year(values: Optional[np.ndarray]) -> Optional[np.ndarray]:
+            return None if values is None else values[order].astype(np.float32)
+
+        return FloodResult(list(years), coords[used], offsets,
+                           point_index[order].astype(np.int32), by_year(depth), by_year(low),
+                           by_year(high))
+
+    @staticmethod
+    def concatenate(results: List['FloodResult']) -> 'FloodResult':
+        """Return the FloodResult of the locations of every result in results, which must be
+        compared over the same years and have no locations in common.
+
+        Preconditions:
+            - results != []
+            - all(result.years == results[0].years for result in results)
+            - all(result.depth_low is None for result in results) or \
+              all(result.depth_low is not None for result in results)
+
+        >>> a = FloodResult.from_points(np.array([[1.0, 2.0]]), np.array([0]), np.array([1]),
+        ...                             np.array([0.5]), [2020, 2030])
+        >>> b = FloodResult.from_points(np.array([[3.0, 4.0]]), np.array([0]), np.array([0]),
+        ...                             np.array([1.5]), [2020, 2030])
+        >>> result = FloodResult.concatenate([a, b])
+        >>> result.offsets.tolist(), result.coords[result.point_index].tolist()
+        ([0, 1, 2], [[3.0, 4.0], [1.0, 2.0]])
+        """
+        years = results[0].years
+        starts = np.cumsum([0] + [len(result.coords) for result in results])
+
+        def joined(arrays: List[Optional[np.ndarray]]) -> Optional[np.ndarray]:
+            return None if arrays[0] is None else np.concatenate(arrays)
+
+        return FloodResult.from_points(
+            np.concatenate([result.coords for result in results]),
+            joined([result.point_index + start for result, start in zip(results, starts)]),
+            joined([np.repeat(np.arange(len(years)), np.diff(result.offsets))
+                    for result in results]),
+            joined([result.depth for result in results]), years,
+            joined([result.depth_low for result in results]),
+            joined([result.depth_high for result in results]))
+
+    def year(self, year: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the coordinates and depths of the locations flooded in year.
+
+        Preconditions:
+            - year in self.years
+        """
+        i = self.years.index(year)
+        flooded = slice(self.offsets[i], self.offsets[i + 1])
+        return (self.coords[self.point_index[flooded]], self.depth[flooded])
+
+    def to_long(self) -> Dict[str, list]:
+        """Return the dictionary that compare_altitude_to_sea_level returns when compact is
+        False, ordered by location and then by year.
+        """
+        year_index = np.repeat(np.arange(len(self.years)), np.diff(self.offsets))
+        order = np.lexsort((year_index, self.point_index))
+        full_data = long_format(self.coords, self.point_index[order], year_index[order],
+                                self.depth[order].astype(float), self.years)
+
+        if self.depth_low is not None:
+            full_data['diff_low'] = self.depth_low[order].astype(float).tolist()
+            full_data['diff_high'] = self.depth_high[order].astype(float).tolist()
+
+        return full_data
+
+    def save(self, filename: str) -> None:
+        """Save the result to a NumPy .npz file, which FloodResult.load reads back."""
+        arrays = {'years': np.array(self.years), 'coords': self.coords, 'offsets': self.offsets,
+                  'point_index': self.point_index, 'depth': self.depth}
+        if self.depth_low is not None:
+            arrays.update(depth_low=self.depth_low, depth_high=self.depth_high)
+
+        with open(filename, 'wb') as f:
+            np.savez(f, **arrays)
+
+    @staticmethod
+    def load(filename: str) -> 'FloodResult':
+        """Return the result saved to filename by FloodResult.save."""
+        with np.load(filename) as arrays:
+            return FloodResult(arrays['years'].tolist(), arrays['coords'], arrays['offsets'],
+                               arrays['point_index'], arrays['depth'],
+                               arrays['depth_low'] if 'depth_low' in arrays else None,
+                               arrays['depth_high'] if 'depth_high' in arrays else None)
+
+    @property
+    def nbytes(self) -> int:
+        """The number of bytes taken by the arrays of the result."""
+        return sum(array.nbytes for array in (self.coords, self.offsets, self.point_index,
+                                              self.depth, self.depth_low, self.depth_high)
+                   if array is not None)
+
+
+def _location_keys(coords: np.ndarray) -> np.ndarray:
+    """Return a key for each (latitude, longitude) row of coords, which sort in the order of
+    the locations by latitude and then longitude.
+
+    >>> keys = _location_keys(np.array([[1.0, 2.0], [1.0, 1.0], [0.0, 3.0]]))
+    >>> np.argsort(keys).tolist()
+    [2, 1, 0]
+    """
+    # complex numbers sort by their real part and then their imaginary part
+    return coords[:, 0] + 1j * coords[:, 1]
+
+
+def _in_location_order(coords: np.ndarray) -> bool:
+    """Return whether the rows of coords are sorted by latitude and then longitude, with no row
+    repeated.
+
+    >>> _in_location_order(np.array([[1.0, 2.0], [1.0, 3.0], [2.0, 0.0]]))
+    True
+    >>> _in_location_order(np.array([[1.0, 3.0], [1.0, 2.0]]))
+    False
+    """
+    lat, lon = coords[:, 0], coords[:, 1]
+    return bool(np.all((lat[1:] > lat[:-1]) | ((lat[1:] == lat[:-1]) & (lon[1:] > lon[:-1]))))
+
+
+def _sort_locations(result: 'FloodResult') -> 'FloodResult':
+    """Return result with its locations in (latitude, longitude) order."""
+    order = np.lexsort((result.coords[:, 1], result.coords[:, 0]))
+    rank = np.empty(len(order), dtype=np.int32)
+    rank[order] = np.arange(len(order))
+    return FloodResult.from_points(result.coords[order], rank[result.point_index],
+                                   np.repeat(np.arange(len(result.years)),
+                                             np.diff(result.offsets)),
+                                   result.depth, result.years, result.depth_low,
+                                   result.depth_high)
@@ -0,0 +1,136 @@
+"""This module runs the sea level projection for every cell of a gridded temperature dataset.
+
+flooding.py only projects sea level for 4 hand-picked temperature series. Here, the temperature
+NetCDF file is split into tiles of cells, and for each tile:
+    - the yearly average temperature of every cell is read (see dataset_cleaner.py)
+    - the calibration constant and projected sea level of every cell are computed at once
+      (see data_analysis.py)
+    - the results are written to a chunked NetCDF file with variables sea_level(year, lat, lon)
+      and constant(lat, lon)
+Tiles are processed in parallel by a pool of worker processes, and only a few tiles are in
+memory at any time, so the temperature grid can be much larger than the available memory.
+"""
+from typing import Dict, List, Optional, Tuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import os
+import netCDF4 as nc
+import numpy as np
+from dataset_cleaner import annual_mean_temperatures, read_sea_level_data
+from data_analysis import fit_polynomials, calibration_constants, integrate_anomalies
+from instrumentation import timed, count
+
+# a tile of cells, given as (latitude index slice, longitude index slice)
+Tile = Tuple[slice, slice]
+
+
+@timed()
+def project_temperature_grid(filename: str, output: str, tile_size: Tuple[int, int] = (32, 32),
+                             processes: Optional[int] = None) -> None:
+    """Write the calibration constant and the projected sea level for every year of every cell
+    in the temperature NetCDF file to a new NetCDF file named output.
+
+    The grid is processed tile_size cells at a time, using processes worker processes (one per
+    CPU by default). Cells with missing temperatures are given nan.
+
+    Preconditions:
+        - filename != '' and output != ''
+        - tile_size[0] >= 1 and tile_size[1] >= 1
+        - processes is None or processes >= 1
+    """
+    sea_levels = read_sea_level_data('datasets/global_timeseries_measures.nc.nc4')
+    sea_levels = {year: float(level) for year, level in sea_levels.items()}
+
+    count('files_opened')
+    with nc.Dataset(filename) as ds:
+        months, lat_count, lon_count = ds['tas'].shape
+        coordinates = {name: ds[name][:] for name in ('lat', 'lon') if name in ds.variables}
+    years = [2006 + i for i in range(months // 12)]
+
+    tiles = split_into_tiles(lat_count, lon_count, tile_size)
+    processes = os.cpu_count() if processes is None else processes
+
+    with nc.Dataset(output, 'w') as out:
+        sea_level, constant = _create_output(out, years, lat_count, lon_count, tile_size,
+                                             coordinates)
+
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            # keep at most 2 tiles per worker queued, so finished tiles don't pile up in memory
+            pending = set()
+            for tile in tiles:
+                if len(pending) >= 2 * processes:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    _write_tiles(done, sea_level, constant)
+                pending.add(executor.submit(project_tile, filename, tile, sea_levels))
+
+            _write_tiles(wait(pending).done, sea_level, constant)
+
+
+def split_into_tiles(lat_count: int, lon_count: int, tile_size: Tuple[int, int]) -> List[Tile]:
+    """Return the tiles covering a grid of lat_count * lon_count cells, row by row.
+
+    >>> tiles = split_into_tiles(3, 4, (2, 2))
+    >>> len(tiles)
+    4
+    >>> tiles[3]
+    (slice(2, 3, None), slice(2, 4, None))
+    """
+    return [(slice(i, min(i + tile_size[0], lat_count)), slice(j, min(j + tile_size[1], lon_count)))
+            for i in range(0, lat_count, tile_size[0]) for j in range(0, lon_count, tile_size[1])]
+
+
+def project_tile(filename: str, tile: Tile, sea_levels: Dict[int, float]) \
+        -> Tuple[Tile, np.ndarray, np.ndarray]:
+    """Return the tile, the calibration constants of its cells, with shape (lat, lon), and the
+    projected sea level of its cells in every year, with shape (years, lat, lon).
+    """
+    temperatures = annual_mean_temperatures(filename, tile[0], tile[1])
+    years, height, width = temperatures.shape
+    series = temperatures.reshape(years, height * width)
+
+    # ACCUMULATORS: nan for cells with missing temperatures
+    constants = np.full(height * width, np.nan)
+    projection = np.full((years, height * width), np.nan)
+
+    valid = ~np.isnan(series).any(axis=0)
+    if valid.any():
+        fit = fit_polynomials(np.arange(2006, 2006 + years), series[:, valid])
+        constants[valid] = calibration_constants(fit, sea_levels)
+        integrals = integrate_anomalies(fit, list(range(2006, 2006 + years)))
+        projection[:, valid] = constants[valid] * integrals
+
+    return (tile, constants.reshape(height, width),
+            projection.reshape(years, height, width).astype(np.float32))
+
+
+def _create_output(out: nc.Dataset, years: List[int], lat_count: int, lon_count: int,
+                   tile_size: Tuple[int, int], coordinates: Dict[str, np.ndarray]) \
+        -> Tuple[nc.Variable, nc.Variable]:
+    """Create the dimensions and variables of the output file, and return its sea_level and
+    constant variables.
+    """
+    out.createDimension('year', len(years))
+    out.createDimension('lat', lat_count)
+    out.createDimension('lon', lon_count)
+
+    out.createVariable('year', 'i4', ('year',))[:] = years
+    for name, values in coordinates.items():
+        out.createVariable(name, values.dtype, (name,))[:] = values
+
+    # chunked by tile, so that each tile is written in one piece
+    chunks = (min(tile_size[0], lat_count), min(tile_size[1], lon_count))
+    sea_level = out.createVariable('sea_level', 'f4', ('year', 'lat', 'lon'), fill_value=np.nan,
+                                   chunksizes=(len(years),) + chunks, zlib=True)
+    constant = out.createVariable('constant', 'f8', ('lat', 'lon'), fill_value=np.nan,
+                                  chunksizes=chunks)
+    sea_level.long_name = 'projected sea level change'
+
+    return (sea_level, constant)
+
+
+def _write_tiles(futures: set, sea_level: nc.Variable, constant: nc.Variable) -> None:
+    """Write the results of the finished project_tile calls to the output variables.
+    """
+    for future in futures:
+        tile, constants, projection = future.result()
+        constant[tile[0], tile[1]] = constants
+        sea_level[:, tile[0], tile[1]] = projection
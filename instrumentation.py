@@ -0,0 +1,217 @@
+"""This module keeps track of where the time goes when the project runs.
+
+It records:
+    - timing spans, for whole stages of main.py and for individual functions
+    - counters, such as the number of regressions fitted or HTTP requests sent
+    - optionally, a cProfile profile and tracemalloc memory statistics
+
+Nothing is recorded until enable() is called, and while disabled every hook returns right away,
+so the instrumented functions run at almost their normal speed. The results can be saved as a
+JSON run report with write_report().
+"""
+from typing import Any, Callable, Dict, Iterator, Optional
+from contextlib import contextmanager
+import cProfile
+import functools
+import io
+import json
+import pstats
+import threading
+import time
+import tracemalloc
+
+# whether anything is being recorded right now
+_enabled = False
+
+# total time, number of calls and longest call of each span, keyed by span name
+_spans = {}
+
+# value of each counter, keyed by counter name
+_counters = {}
+
+# the profiler used while profiling is on, or None
+_profiler = None
+
+# guards _spans and _counters, which are updated from every thread that runs an instrumented
+# function (see pipelined.py)
+_lock = threading.Lock()
+
+
+def enable(profile: bool = False, trace_memory: bool = False) -> None:
+    """Start recording spans and counters, clearing anything recorded before.
+
+    If profile is True, every function call is also profiled with cProfile. If trace_memory is
+    True, memory allocations are traced with tracemalloc. Both of these slow the program down.
+    """
+    global _enabled, _profiler
+    reset()
+    _enabled = True
+
+    if profile:
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    if trace_memory:
+        tracemalloc.start()
+
+
+def disable() -> None:
+    """Stop recording. What was recorded so far is kept until the next enable() or reset().
+    """
+    global _enabled
+    _enabled = False
+
+    if _profiler is not None:
+        _profiler.disable()
+
+
+def reset() -> None:
+    """Clear all recorded spans, counters, profiles and memory statistics.
+    """
+    global _profiler
+    _spans.clear()
+    _counters.clear()
+    _profiler = None
+
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def is_enabled() -> bool:
+    """Return whether spans and counters are being recorded.
+    """
+    return _enabled
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """Record the time taken by the body of the with statement under the given name.
+
+    >>> enable()
+    >>> with span('example'):
+    ...     total = sum(range(10))
+    >>> report()['spans']['example']['calls']
+    1
+    >>> disable()
+    """
+    if not _enabled:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(name, time.perf_counter() - start)
+
+
+def timed(name: Optional[str] = None) -> Callable:
+    """Return a decorator that records the time of each call of the decorated function as a span.
+
+    The span is named after the function unless a name is given.
+    """
+    def decorator(func: Callable) -> Callable:
+        span_name = func.__name__ if name is None else name
+
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            if not _enabled:
+                return func(*args, **kwargs)
+
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _record(span_name, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def count(name: str, amount: int = 1) -> None:
+    """Add amount to the counter with the given name.
+
+    >>> enable()
+    >>> count('example')
+    >>> count('example', 2)
+    >>> report()['counters']['example']
+    3
+    >>> disable()
+    """
+    if _enabled:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + amount
+
+
+def report(top: int = 25) -> Dict[str, Any]:
+    """Return everything recorded so far as a dictionary that can be saved as JSON.
+
+    The dictionary has keys 'spans' and 'counters', plus 'profile' (the top functions by
+    cumulative time) if profiling was on and 'memory' (current and peak traced memory in bytes,
+    and the top allocation sites) if memory tracing was on.
+    """
+    with _lock:
+        run_report = {'spans': {name: dict(stats) for name, stats in _spans.items()},
+                      'counters': dict(_counters)}
+
+    if _profiler is not None:
+        run_report['profile'] = _profile_summary(top)
+
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        run_report['memory'] = {
+            'current': current,
+            'peak': peak,
+            'top': [{'location': str(stat.traceback), 'size': stat.size, 'count': stat.count}
+                    for stat in snapshot.statistics('lineno')[:top]]
+        }
+
+    return run_report
+
+
+def write_report(filename: str, top: int = 25) -> None:
+    """Save the report of everything recorded so far to filename as JSON.
+    """
+    with open(filename, 'w') as f:
+        json.dump(report(top), f, indent=2)
+
+
+def _record(name: str, seconds: float) -> None:
+    """Add one call taking the given number of seconds to the span with the given name.
+
+    >>> enable()
+    >>> threads = [threading.Thread(target=lambda: [_record('example', 0.0) for _ in range(1000)])
+    ...            for _ in range(8)]
+    >>> for thread in threads:
+    ...     thread.start()
+    >>> for thread in threads:
+    ...     thread.join()
+    >>> report()['spans']['example']['calls']
+    8000
+    >>> disable()
+    """
+    with _lock:
+        stats = _spans.get(name)
+        if stats is None:
+            _spans[name] = {'calls': 1, 'total': seconds, 'max': seconds}
+        else:
+            stats['calls'] += 1
+            stats['total'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+
+
+def _profile_summary(top: int) -> list:
+    """Return the top functions of the current profile, sorted by cumulative time.
+    """
+    stats = pstats.Stats(_profiler, stream=io.StringIO())
+    stats.sort_stats('cumulative')
+
+    # ACCUMULATOR: one entry per function
+    summary = []
+    for func in stats.fcn_list[:top]:
+        calls, _, total_time, cumulative_time, _ = stats.stats[func]
+        summary.append({'function': pstats.func_std_string(func), 'calls': calls,
+                        'total': total_time, 'cumulative': cumulative_time})
+
+    return summary
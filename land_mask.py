@@ -0,0 +1,102 @@
+"""This module classifies the locations of the elevation grid as land or water.
+
+The elevation API answers 0.0 for open water, so without a mask every water location is below
+the predicted sea level in every decade and is reported as flooded. A location is classified as
+water if its altitude is exactly 0 or missing (nan), or, if a coastline raster is given, if the
+raster has no data or a value of 0 or less there (for example, a grid of 1 for land and 0 for
+water, in any format elevation_sources.RasterElevationSource reads).
+
+The mask is an array of booleans in the same order as the locations, True for land. It is saved
+next to the elevation data with save_mask, together with the size and modification time of the
+coastline raster, so the mask is classified again if the raster is replaced or edited.
+compare_altitude_to_sea_level skips the water locations when it is passed the mask, so they are
+never compared or drawn.
+"""
+from typing import Optional
+import os
+import numpy as np
+from elevation_sources import RasterElevationSource
+from instrumentation import timed
+
+
+@timed()
+def classify_land(coords: np.ndarray, elevations: np.ndarray, raster: Optional[str] = None) \
+        -> np.ndarray:
+    """Return whether each (latitude, longitude) row of coords is on land, given the altitude
+    of each location in elevations and optionally the filename of a coastline raster.
+
+    >>> classify_land(np.array([[45.0, -75.0], [50.0, -60.0]]), np.array([70.0, 0.0])).tolist()
+    [True, False]
+    """
+    land = ~np.isnan(elevations) & (elevations != 0)
+
+    if raster is not None:
+        coastline = RasterElevationSource(raster).sample_array(coords[:, 0], coords[:, 1])
+        land &= ~np.isnan(coastline) & (coastline > 0)
+
+    return land
+
+
+def mask_filename(elevation_file: str) -> str:
+    """Return the name of the file the land mask of the elevation data in elevation_file is
+    saved in.
+
+    >>> mask_filename('datasets/AltitudeData.py')
+    'datasets/AltitudeData.land.npz'
+    """
+    return elevation_file.rsplit('.', 1)[0] + '.land.npz'
+
+
+def save_mask(filename: str, coords: np.ndarray, elevations: np.ndarray, land: np.ndarray,
+              raster: Optional[str] = None) -> None:
+    """Save the land mask of the locations in coords, made from elevations and the given
+    coastline raster (if any), to filename.
+    """
+    with open(filename, 'wb') as f:
+        np.savez_compressed(f, coords=coords, elevations=elevations, land=land,
+                            raster=raster_stamp(raster))
+
+
+def load_mask(filename: str, coords: np.ndarray, elevations: np.ndarray,
+              raster: Optional[str] = None) -> Optional[np.ndarray]:
+    """Return the land mask saved in filename, or None if there is no such file or it was made
+    from other locations, altitudes or coastline raster, or from an older version of the raster.
+    """
+    try:
+        with np.load(filename) as saved:
+            if 'raster' not in saved or str(saved['raster']) != raster_stamp(raster) \
+                    or saved['coords'].shape != coords.shape \
+                    or not np.array_equal(saved['coords'], coords) \
+                    or not np.array_equal(saved['elevations'], elevations, equal_nan=True):
+                return None
+            return saved['land']
+    except FileNotFoundError:
+        return None
+
+
+def raster_stamp(raster: Optional[str]) -> str:
+    """Return a string identifying the coastline raster file and its version (its size and
+    modification time), or 'None' if there is no raster.
+
+    >>> raster_stamp(None)
+    'None'
+    """
+    if raster is None:
+        return 'None'
+    try:
+        stat = os.stat(raster)
+    except FileNotFoundError:
+        return raster
+    return '%s|%d|%d' % (raster, stat.st_size, stat.st_mtime_ns)
+
+
+def land_mask(coords: np.ndarray, elevations: np.ndarray, elevation_file: str,
+              raster: Optional[str] = None) -> np.ndarray:
+    """Return the land mask of the locations in coords, loaded from the file saved next to
+    elevation_file if it is up to date, or classified and saved there otherwise.
+    """
+    land = load_mask(mask_filename(elevation_file), coords, elevations, raster)
+    if land is None:
+        land = classify_land(coords, elevations, raster)
+        save_mask(mask_filename(elevation_file), coords, elevations, land, raster)
+    return land
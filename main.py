@@ -1,9 +1,53 @@
 """This is the main file of the project and will run all the other modules.
+
+The outputs of each stage are cached in .pipeline_cache, so a run only recomputes the stages
+whose inputs changed (see stages.py). Run with --no-cache to recompute everything.
+
+Run with --report FILE to save a JSON report of how long each stage took, and add --profile or
+--trace-memory to include a cProfile profile or memory statistics in that report.
 """
-from AltitudeData import altitude_data
-from bubble import draw_map
-from flooding import compare_altitude_to_sea_level
+import argparse
+import instrumentation
+from instrumentation import span
 
 if __name__ == "__main__":
-    data = compare_altitude_to_sea_level(altitude_data)
-    draw_map(data)
+    parser = argparse.ArgumentParser(description='Map the areas at risk of flooding in Canada.')
+    parser.add_argument('--members', type=int, default=0,
+                        help='predict with an ensemble of this many members')
+    parser.add_argument('--seed', type=int, help='random seed for the ensemble')
+    parser.add_argument('--model', help='predict with this model of sea_level_models.py '
+                                        '(rahmstorf, equilibrium or lagged)')
+    parser.add_argument('--title', default='Areas at risk of flooding in the next century',
+                        help='title of the map')
+    parser.add_argument('--cache-folder', default='.pipeline_cache',
+                        help='folder to cache the outputs of each stage in')
+    parser.add_argument('--no-cache', action='store_true', help='recompute every stage')
+    parser.add_argument('--delta-frames', action='store_true',
+                        help='store only the changes between years in the map')
+    parser.add_argument('--land-only', action='store_true', help='leave out water locations')
+    parser.add_argument('--land-raster', help='coastline raster to tell land from water with')
+    parser.add_argument('--report', help='save a JSON report of the run to this file')
+    parser.add_argument('--profile', action='store_true', help='profile with cProfile')
+    parser.add_argument('--trace-memory', action='store_true', help='trace memory allocations')
+    args = parser.parse_args()
+    if args.report is None and (args.profile or args.trace_memory):
+        parser.error('--profile and --trace-memory need --report FILE to save them to')
+
+    if args.report is not None:
+        instrumentation.enable(profile=args.profile, trace_memory=args.trace_memory)
+
+    with span('load_modules'):
+        from artifact_cache import ArtifactCache
+        from stages import run_pipeline
+        from bubble import DELTA_SCRIPT
+
+    cache = None if args.no_cache else ArtifactCache(args.cache_folder)
+    with span('pipeline'):
+        figure = run_pipeline(cache, args.members, args.seed, args.title, args.delta_frames,
+                              args.land_only, args.land_raster, args.model)
+    with span('render'):
+        figure.show(post_script=DELTA_SCRIPT if args.delta_frames else None)
+
+    if args.report is not None:
+        instrumentation.disable()
+        instrumentation.write_report(args.report)
@@ -1,27 +1,115 @@
 """This module contains the MapArea and Midpoint classes.
 Together they represent the points of the map that we are working with.
 """
-from typing import Tuple
+from typing import List, Tuple
 from dataclasses import dataclass
+import numpy as np
 
 
 @dataclass
 class MapArea:
     """A map of a certain area.
 
+    The map spans the longitudes east of longitude[0] up to longitude[1]. If longitude[0] is
+    greater than longitude[1], the map crosses the antimeridian (180 degrees of longitude), and
+    the longitudes (-180, 180) span the whole globe.
+
     Instance Attributes:
         - latitude: the range of the map in latitude
-        - longitude: the range of the map in longitude
+        - longitude: the range of the map in longitude, from west to east
 
     Representation Invariants:
         - all(-90 <= l <= 90 for l in self.latitude)
         - self.latitude[0] < self.latitude[1]
         - all(-180 <= l <= 180 for l in self.longitude)
-        - self.longitude[0] < self.longitude[1]
+        - self.longitude[0] != self.longitude[1]
     """
     latitude: Tuple[float, float]
     longitude: Tuple[float, float]
 
+    @property
+    def longitude_span(self) -> float:
+        """Return the number of degrees of longitude the map spans.
+
+        >>> MapArea((40.0, 84.0), (170.0, -170.0)).longitude_span
+        20.0
+        """
+        return (self.longitude[1] - self.longitude[0]) % 360 or 360.0
+
+    @property
+    def crosses_antimeridian(self) -> bool:
+        """Return whether the map crosses the antimeridian."""
+        return self.longitude[0] > self.longitude[1]
+
+    def unwrap(self, longitudes: np.ndarray) -> np.ndarray:
+        """Return longitudes shifted by whole turns to lie within 180 degrees of the middle of
+        the map, so that they increase from west to east across the map, even past 180.
+        Longitudes that are already in that range are returned exactly as they are.
+
+        >>> MapArea((40.0, 84.0), (170.0, -170.0)).unwrap(np.array([175.0, -175.0])).tolist()
+        [175.0, 185.0]
+        """
+        west = self.longitude[0] + self.longitude_span / 2 - 180
+        longitudes = np.asarray(longitudes, dtype=float)
+        in_range = (west <= longitudes) & (longitudes < west + 360)
+        return np.where(in_range, longitudes, west + np.mod(longitudes - west, 360))
+
+    def contains(self, coords: np.ndarray) -> np.ndarray:
+        """Return whether each (latitude, longitude) row of coords lies on the map, edges
+        included.
+
+        >>> area = MapArea((40.0, 84.0), (170.0, -170.0))
+        >>> area.contains(np.array([[45.0, -175.0], [45.0, 0.0], [30.0, 175.0]])).tolist()
+        [True, False, False]
+        """
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        east_of_west = self.unwrap(coords[:, 1]) - self.longitude[0]
+        east_of_west = np.where(east_of_west < 0, east_of_west + 360, east_of_west)
+        return (coords[:, 0] >= self.latitude[0]) & (coords[:, 0] <= self.latitude[1]) \
+            & (east_of_west <= self.longitude_span)
+
+    def tiles(self, rows: int, cols: int) -> List['MapArea']:
+        """Return the rows * cols tiles that the map splits into, row by row from the south
+        west corner.
+
+        Preconditions:
+            - rows >= 1
+            - cols >= 1
+
+        >>> [tile.longitude for tile in MapArea((0.0, 10.0), (170.0, -170.0)).tiles(1, 2)]
+        [(170.0, 180.0), (-180.0, -170.0)]
+        """
+        latitude_step = (self.latitude[1] - self.latitude[0]) / rows
+        longitude_step = self.longitude_span / cols
+
+        # ACCUMULATOR: the tiles so far
+        tiles = []
+        for row in range(rows):
+            south = self.latitude[0] + row * latitude_step
+            for col in range(cols):
+                west = wrap_longitude(self.longitude[0] + col * longitude_step)
+                east = wrap_longitude(self.longitude[0] + (col + 1) * longitude_step)
+                tiles.append(MapArea((south, south + latitude_step),
+                                     (west, 180.0 if east == -180.0 else east)))
+
+        return tiles
+
+
+def wrap_longitude(longitude: float) -> float:
+    """Return longitude shifted by whole turns to lie in [-180, 180). Longitudes already in that
+    range are returned exactly as they are.
+
+    >>> wrap_longitude(190.0)
+    -170.0
+    """
+    if -180 <= longitude < 180:
+        return longitude
+    return longitude - 360 * ((longitude + 180) // 360)
+
+
+# the map of Canada, used by default
+CANADA = MapArea((40.0, 84.0), (-146.0, -50.0))
+
 
 @dataclass
 class Midpoint:
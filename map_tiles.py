@@ -0,0 +1,268 @@
+"""This module pre-renders the flood depths as a pyramid of map tiles, one pyramid per year.
+
+The bubble map sends every flooded point of every year to the browser. Instead, the depths can be
+rendered once into 256 * 256 pixel tiles in the Web Mercator layout used by web maps, stored as
+    FOLDER/YEAR/ZOOM/X/Y.png
+so that a web viewer only downloads the tiles that are visible at its current zoom. Each zoom
+level has 4 times as many tiles as the one before it, and tiles with no flooded cells are not
+written. The levels of every year are rendered in parallel by a pool of worker processes.
+
+Tiles are either PNG images, coloured from light blue (shallow) to dark blue (deep), or binary
+tiles (.bin) holding the depth of every pixel as zlib-compressed little-endian float16 values, row
+by row from the top, with nan where nothing floods. FOLDER/tiles.json describes the pyramid, and
+for PNG tiles FOLDER/index.html is a viewer with a year slider.
+
+The points must lie on a regular grid, such as the one altitudes.get_altitude_data samples. Each
+point is drawn as the grid cell around it.
+
+Render the tiles of altitude_data with:
+    python map_tiles.py tiles --max-zoom 6
+"""
+from typing import List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
+import os
+import struct
+import zlib
+import numpy as np
+from flooding import DECADES, altitude_arrays, region_ids, flooded_points, prediction_creator
+from map_setup import CANADA
+from instrumentation import timed, count
+
+# the width and height of a tile, in pixels
+TILE_SIZE = 256
+
+# the largest latitude shown on Web Mercator maps
+MAX_LATITUDE = 85.05112878
+
+# the colours of the shallowest and deepest floods in PNG tiles, as (red, green, blue)
+SHALLOW_COLOUR = (198, 219, 239)
+DEEP_COLOUR = (8, 48, 107)
+
+# a regular grid of cells, given as (south edge, cell height, rows, west edge, cell width, columns)
+GridLayout = Tuple[float, float, int, float, float, int]
+
+
+@timed()
+def render_pyramid(coords: np.ndarray, depths: np.ndarray, years: List[int], folder: str,
+                   max_zoom: int = 6, min_zoom: int = 0, tile_format: str = 'png',
+                   processes: Optional[int] = None) -> int:
+    """Render the flood depths into a tile pyramid for each year in folder, and return the number
+    of tiles written.
+
+    coords has one (latitude, longitude) row per point, and depths one row per point with the
+    flood depth in each of years, or nan where the point does not flood.
+
+    Preconditions:
+        - the points in coords lie on a regular grid
+        - depths.shape == (len(coords), len(years))
+        - 0 <= min_zoom <= max_zoom
+        - tile_format in {'png', 'bin'}
+    """
+    layout, rows, cols = grid_layout(coords)
+    grids = np.full((len(years), layout[2], layout[5]), np.nan, dtype=np.float32)
+    grids[:, rows, cols] = depths.T
+    max_depth = float(np.nanmax(grids)) if not np.isnan(grids).all() else 0.0
+
+    with ProcessPoolExecutor(max_workers=processes or os.cpu_count()) as executor:
+        futures = [executor.submit(render_level, grids[i], layout, folder, year, zoom,
+                                   tile_format, max_depth)
+                   for zoom in range(min_zoom, max_zoom + 1) for i, year in enumerate(years)]
+        written = sum(future.result() for future in futures)
+
+    count('tiles_written', written)
+    south, west = layout[0], layout[3]
+    with open(os.path.join(folder, 'tiles.json'), 'w') as f:
+        json.dump({'years': list(years), 'min_zoom': min_zoom, 'max_zoom': max_zoom,
+                   'format': tile_format, 'tile_size': TILE_SIZE, 'max_depth': max_depth,
+                   'bounds': [south, west, south + layout[1] * layout[2],
+                              west + layout[4] * layout[5]]}, f)
+    if tile_format == 'png':
+        _write_viewer(folder, years, min_zoom, max_zoom)
+
+    return written
+
+
+def grid_layout(coords: np.ndarray) -> Tuple[GridLayout, np.ndarray, np.ndarray]:
+    """Return the layout of the regular grid that the points in coords lie on, and the row and
+    column of each point in it. The grid spacing is the smallest distance between neighbouring
+    latitudes and longitudes (1 degree if there is only one).
+
+    >>> layout, rows, cols = grid_layout(np.array([[10.0, 20.0], [12.0, 20.0], [12.0, 21.0]]))
+    >>> layout
+    (9.0, 2.0, 2, 19.5, 1.0, 2)
+    >>> rows.tolist(), cols.tolist()
+    ([0, 1, 1], [0, 0, 1])
+    """
+    # ACCUMULATOR: (first edge, cell size, cell count) of the latitudes, then the longitudes
+    axes = []
+    indices = []
+    for values in coords[:, 0], coords[:, 1]:
+        unique = np.unique(values.round(9))
+        size = float(np.diff(unique).min()) if len(unique) > 1 else 1.0
+        index = np.round((values - unique[0]) / size).astype(np.int64)
+        axes.extend([float(unique[0]) - size / 2, size, int(index.max()) + 1])
+        indices.append(index)
+
+    return (tuple(axes), indices[0], indices[1])
+
+
+def render_level(grid: np.ndarray, layout: GridLayout, folder: str, year: int, zoom: int,
+                 tile_format: str = 'png', max_depth: float = 1.0) -> int:
+    """Write the tiles of one zoom level of one year's pyramid that contain flooded cells, and
+    return how many were written. grid holds the depth of each cell of layout, or nan.
+    """
+    south, height, lat_count, west, width, lon_count = layout
+    flooded_rows, flooded_cols = np.nonzero(~np.isnan(grid))
+    if len(flooded_rows) == 0:
+        return 0
+
+    # the tiles overlapped by the flooded cells
+    x0, y0 = _pixel(south + (flooded_rows + 1) * height, west + flooded_cols * width, zoom)
+    x1, y1 = _pixel(south + flooded_rows * height, west + (flooded_cols + 1) * width, zoom)
+    first_x, first_y = x0 // TILE_SIZE, y0 // TILE_SIZE
+    last_x = np.minimum((np.ceil(x1) - 1) // TILE_SIZE, 2 ** zoom - 1)
+    last_y = np.minimum((np.ceil(y1) - 1) // TILE_SIZE, 2 ** zoom - 1)
+    columns = (last_x - first_x + 1).astype(np.int64)
+    counts = columns * (last_y - first_y + 1).astype(np.int64)
+    cell = np.repeat(np.arange(len(counts)), counts)
+    rank = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    tiles = np.unique(np.column_stack([first_x[cell] + rank % columns[cell],
+                                       first_y[cell] + rank // columns[cell]]).astype(np.int64),
+                      axis=0)
+
+    written = 0
+    for x, y in tiles.tolist():
+        # the cell under the centre of every pixel of the tile
+        lats, lons = _coordinates(y * TILE_SIZE + np.arange(TILE_SIZE) + 0.5,
+                                  x * TILE_SIZE + np.arange(TILE_SIZE) + 0.5, zoom)
+        rows = np.floor((lats - south) / height).astype(np.int64)
+        cols = np.floor((lons - west) / width).astype(np.int64)
+        row_ok = (rows >= 0) & (rows < lat_count)
+        col_ok = (cols >= 0) & (cols < lon_count)
+
+        pixels = np.full((TILE_SIZE, TILE_SIZE), np.nan, dtype=np.float32)
+        pixels[np.ix_(row_ok, col_ok)] = grid[np.ix_(rows[row_ok], cols[col_ok])]
+        if np.isnan(pixels).all():
+            continue
+
+        path = os.path.join(folder, str(year), str(zoom), str(x))
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, '%d.%s' % (y, tile_format)), 'wb') as f:
+            f.write(encode_png(colour(pixels, max_depth)) if tile_format == 'png'
+                    else zlib.compress(pixels.astype('<f2').tobytes()))
+        written += 1
+
+    return written
+
+
+def colour(depths: np.ndarray, max_depth: float) -> np.ndarray:
+    """Return the RGBA image of an array of flood depths, shaded from SHALLOW_COLOUR to
+    DEEP_COLOUR by depth and transparent where the depth is nan.
+    """
+    # look the colours up in a palette of 256 shades, with the last entry transparent
+    t = np.linspace(0, 1, 255)[:, np.newaxis]
+    palette = np.zeros((256, 4), dtype=np.uint8)
+    palette[:255, :3] = ((1 - t) * np.array(SHALLOW_COLOUR) + t * np.array(DEEP_COLOUR)).round()
+    palette[:255, 3] = 200
+
+    shade = np.clip(np.nan_to_num(depths, nan=0) * (254 / max(max_depth, 1e-12)), 0, 254)
+    return palette[np.where(np.isnan(depths), 255, shade.round().astype(np.uint8))]
+
+
+def encode_png(image: np.ndarray) -> bytes:
+    """Return the PNG file of an RGBA image with shape (height, width, 4).
+
+    >>> encode_png(np.zeros((1, 1, 4), dtype=np.uint8))[:8]
+    b'\\x89PNG\\r\\n\\x1a\\n'
+    """
+    height, width, _ = image.shape
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + kind + data \
+            + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    # every row starts with filter type 0 (none)
+    rows = np.concatenate([np.zeros((height, 1), dtype=np.uint8),
+                           image.reshape(height, width * 4)], axis=1)
+    return b'\x89PNG\r\n\x1a\n' \
+        + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)) \
+        + chunk(b'IDAT', zlib.compress(rows.tobytes())) + chunk(b'IEND', b'')
+
+
+def _pixel(lat: np.ndarray, lon: np.ndarray, zoom: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the Web Mercator pixel coordinates (x, y) of the given locations at zoom, counted
+    from the top-left corner of the whole map.
+    """
+    scale = TILE_SIZE * 2 ** zoom
+    lat = np.radians(np.clip(lat, -MAX_LATITUDE, MAX_LATITUDE))
+    x = (np.asarray(lon) + 180) / 360 * scale
+    y = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2 * scale
+    return (x, y)
+
+
+def _coordinates(y: np.ndarray, x: np.ndarray, zoom: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the latitudes of the pixel rows y and the longitudes of the pixel columns x at
+    zoom, the inverse of _pixel.
+    """
+    scale = TILE_SIZE * 2 ** zoom
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(y) / scale))))
+    lon = np.asarray(x) / scale * 360 - 180
+    return (lat, lon)
+
+
+def _write_viewer(folder: str, years: List[int], min_zoom: int, max_zoom: int) -> None:
+    """Write index.html to folder: a Leaflet map of the PNG tiles with a slider to pick the year.
+    """
+    page = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Flood depth</title>
+<link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css">
+<script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+<style>html, body, #map {height: 100%%; margin: 0} #year {position: absolute; z-index: 1000;
+top: 10px; right: 10px; background: white; padding: 6px}</style></head>
+<body><div id="map"></div>
+<div id="year"><input id="slider" type="range" min="0" max="%d" value="0"> <span></span></div>
+<script>
+var years = %s;
+var map = L.map('map').setView([60, -95], 3);
+L.tileLayer('https://tile.openstreetmap.org/{z}/{x}/{y}.png',
+            {attribution: '&copy; OpenStreetMap contributors'}).addTo(map);
+var floods = L.tileLayer('{year}/{z}/{x}/{y}.png', {year: years[0], minZoom: %d,
+                         maxNativeZoom: %d, errorTileUrl: ''}).addTo(map);
+var slider = document.getElementById('slider');
+function show() {
+    floods.options.year = years[slider.value];
+    floods.redraw();
+    document.querySelector('#year span').textContent = years[slider.value];
+}
+slider.oninput = show;
+show();
+</script></body></html>
+""" % (len(years) - 1, json.dumps(list(years)), min_zoom, max_zoom)
+
+    with open(os.path.join(folder, 'index.html'), 'w') as f:
+        f.write(page)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render the flood depths as map tiles.')
+    parser.add_argument('folder', help='the folder to write the tiles to')
+    parser.add_argument('--min-zoom', type=int, default=0, help='the first zoom level')
+    parser.add_argument('--max-zoom', type=int, default=6, help='the last zoom level')
+    parser.add_argument('--format', choices=['png', 'bin'], default='png',
+                        help='PNG images or binary float16 depths')
+    parser.add_argument('--processes', type=int, help='the number of worker processes')
+    args = parser.parse_args()
+
+    from datasets.AltitudeData import altitude_data
+    point_coords, elevations = altitude_arrays(altitude_data)
+    regions = region_ids(point_coords, CANADA)
+    point_index, year_index, depth = flooded_points(elevations, regions,
+                                                    np.array(prediction_creator()))
+
+    point_depths = np.full((len(point_coords), len(DECADES)), np.nan)
+    point_depths[point_index, year_index] = depth
+    print('Wrote %d tiles' % render_pyramid(point_coords, point_depths, DECADES, args.folder,
+                                            args.max_zoom, args.min_zoom, args.format,
+                                            args.processes))
@@ -0,0 +1,185 @@
+"""This module overlaps fetching the altitudes with comparing them to the predicted sea level.
+
+main.py runs one step at a time: every altitude is fetched before any is compared, and every
+comparison finishes before the map is drawn. When the altitudes come from the elevation API, the
+CPU sits idle while they are fetched. Here the points are fetched in batches, and each batch flows
+through three stages running in their own threads as soon as it arrives:
+    1. fetch: one or more threads read the altitudes of each batch from the elevation source
+    2. compare: the batch is compared to the predicted sea level (see flooding.flooded_points)
+    3. write: the flooded points of the batch are passed to a writer and collected
+The stages are connected by bounded queues, so a stage that falls behind makes the stages before
+it wait (backpressure) instead of piling up batches in memory. If any stage fails, or the run is
+interrupted or cancelled, every stage stops at its next batch and the error is raised.
+
+Run it on the elevation API, or on a local raster with --dem FILE:
+    python pipelined.py --fetchers 8
+"""
+from typing import Callable, List, Optional, Tuple
+import argparse
+import queue
+import threading
+import numpy as np
+from altitudes import split_into_grid, get_midpoints
+from elevation_sources import ElevationSource, ApiElevationSource, RasterElevationSource
+from flooding import DECADES, FloodResult, region_ids, flooded_points, prediction_creator
+from map_setup import MapArea, CANADA
+from instrumentation import timed, count
+
+# a function given the coordinates of a batch of points and the (point_index, year_index, depth)
+# of the ones that flood, as returned by flooding.flooded_points
+Writer = Callable[[np.ndarray, np.ndarray, np.ndarray, np.ndarray], None]
+
+# how often, in seconds, waiting stages check whether the run was cancelled
+POLL_INTERVAL = 0.1
+
+
+class Cancelled(Exception):
+    """Raised when a pipelined run is cancelled before it finishes."""
+
+
+@timed()
+def run_pipelined(my_map: MapArea, source: Optional[ElevationSource] = None,
+                  predictions: Optional[tuple] = None, batch_size: int = 100,
+                  fetchers: int = 1, queue_size: int = 4, writer: Optional[Writer] = None,
+                  cancel: Optional[threading.Event] = None) -> FloodResult:
+    """Return the comparison of the 50 * 50 grid of points of my_map to the predicted sea level,
+    like compare_altitude_to_sea_level(get_altitude_data(my_map, source), compact=True), with
+    the fetching, comparing and writing of batches of batch_size points overlapped.
+
+    fetchers threads fetch batches from source at once, so a slow source such as the elevation
+    API (the default) can be fetched in parallel. source must be safe to sample from several
+    threads at once if fetchers > 1, as the sources of elevation_sources.py are (the API source
+    opens one session per thread). At most queue_size batches wait between two
+    stages. If writer is given, it is called with the flooded points of each batch as soon as
+    they are found, in the order the batches finish. Setting cancel stops the run, which then
+    raises Cancelled.
+
+    Preconditions:
+        - batch_size >= 1
+        - fetchers >= 1
+        - queue_size >= 1
+    """
+    if source is None:
+        source = ApiElevationSource()
+    if predictions is None:
+        predictions = prediction_creator()
+    if cancel is None:
+        cancel = threading.Event()
+
+    grid = split_into_grid(50, 50, my_map)
+    coords = np.array([point.coords for point in get_midpoints(grid, my_map)])
+    regions = region_ids(coords, my_map)
+    projections = np.array(predictions, dtype=float)
+    starts = list(range(0, len(coords), batch_size))
+
+    batches = queue.Queue()
+    for start in starts:
+        batches.put(start)
+    fetched = queue.Queue(maxsize=queue_size)
+    compared = queue.Queue(maxsize=queue_size)
+
+    # ACCUMULATORS: the flooded points of every batch, and the first error of any stage
+    results = []
+    errors = []
+
+    def fetch() -> None:
+        while True:
+            try:
+                start = batches.get_nowait()
+            except queue.Empty:
+                return
+            points = [tuple(point) for point in coords[start:start + batch_size].tolist()]
+            altitudes = source.sample(points)
+            count('batches_fetched')
+            _put(fetched, (start, altitudes), cancel)
+
+    def compare() -> None:
+        for _ in starts:
+            start, altitudes = _get(fetched, cancel)
+            stop = start + len(altitudes)
+            elevations = np.array([np.nan if altitude is None else altitude
+                                   for altitude in altitudes], dtype=float)
+            point_index, year_index, depth = flooded_points(elevations, regions[start:stop],
+                                                            projections)
+            _put(compared, (start, point_index + start, year_index, depth), cancel)
+
+    def write() -> None:
+        for _ in starts:
+            start, point_index, year_index, depth = _get(compared, cancel)
+            if writer is not None:
+                writer(coords, point_index, year_index, depth)
+            results.append((point_index, year_index, depth))
+
+    threads = [threading.Thread(target=_run_stage, args=(stage, cancel, errors), daemon=True)
+               for stage in [fetch] * fetchers + [compare, write]]
+    for thread in threads:
+        thread.start()
+
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(POLL_INTERVAL)
+    except KeyboardInterrupt:
+        cancel.set()
+        for thread in threads:
+            thread.join()
+        raise
+
+    if errors != []:
+        raise errors[0]
+    if cancel.is_set():
+        raise Cancelled()
+
+    return FloodResult.from_points(
+        coords, *(np.concatenate([np.zeros(0, dtype=dtype)] + [result[i] for result in results])
+                  for i, dtype in enumerate([np.int64, np.int64, float])), years=DECADES)
+
+
+def _run_stage(stage: Callable[[], None], cancel: threading.Event,
+               errors: List[BaseException]) -> None:
+    """Run stage, and cancel the other stages if it fails."""
+    try:
+        stage()
+    except Cancelled:
+        pass
+    except BaseException as error:
+        errors.append(error)
+        cancel.set()
+
+
+def _put(q: queue.Queue, item: object, cancel: threading.Event) -> None:
+    """Put item in q, waiting while q is full, unless the run is cancelled."""
+    while True:
+        if cancel.is_set():
+            raise Cancelled()
+        try:
+            q.put(item, timeout=POLL_INTERVAL)
+            return
+        except queue.Full:
+            pass
+
+
+def _get(q: queue.Queue, cancel: threading.Event) -> Tuple:
+    """Return the next item of q, waiting while q is empty, unless the run is cancelled."""
+    while True:
+        if cancel.is_set():
+            raise Cancelled()
+        try:
+            return q.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fetch and compare altitudes at the same time.')
+    parser.add_argument('--dem', help='read altitudes from this raster instead of the API')
+    parser.add_argument('--fetchers', type=int, default=1,
+                        help='the number of batches fetched at once')
+    parser.add_argument('--batch-size', type=int, default=100, help='the points per batch')
+    args = parser.parse_args()
+
+    import bubble
+    elevation_source = None if args.dem is None else RasterElevationSource(args.dem)
+    result = run_pipelined(CANADA, elevation_source,
+                           batch_size=args.batch_size, fetchers=args.fetchers)
+    bubble.draw_map(result.to_long())
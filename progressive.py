@@ -0,0 +1,214 @@
+"""This module shows a coarse preview of the flooding map first, and refines it in place.
+
+A full run shows nothing until the altitude of every point of the 50 * 50 grid is fetched and
+compared. Here, the grid is visited coarse to fine: the first pass takes every 16th row and
+column of the grid, and each pass after it halves that step, adding only the points that no
+earlier pass took, until the last pass completes the grid. After each pass, the comparison of
+every point fetched so far is passed on, so the map can be redrawn with more detail each time.
+
+The points are fetched and compared in a worker thread, while the main thread waits for the
+passes to finish and shows the previews. If the first pass is not finished when the time budget
+runs out, the main thread shows the points fetched so far (possibly none) right away, however
+slow the batch being fetched is, and the pass carries on. Points are never fetched or compared
+twice, and the final map is the same as the map of a full run.
+
+Run it on the elevation API, or on a local raster with --dem FILE, and open the HTML file it
+writes, which reloads itself until the last pass is drawn:
+    python progressive.py --output preview.html --budget 5
+"""
+from typing import Callable, List, Optional, Tuple
+import argparse
+import os
+import queue
+import threading
+import time
+import numpy as np
+from altitudes import split_into_grid, get_midpoints
+from elevation_sources import ElevationSource, ApiElevationSource, RasterElevationSource
+from flooding import DECADES, FloodResult, region_ids, flooded_points, prediction_creator
+from map_setup import MapArea, CANADA
+from pipelined import Cancelled, POLL_INTERVAL
+from instrumentation import timed, count
+
+# a function given the comparison of every point fetched so far and the fraction of the grid
+# that has been fetched, called after every pass (and when the time budget runs out)
+Preview = Callable[[FloodResult, float], None]
+
+# JavaScript reloading a preview page that is not final yet, to see the next pass
+RELOAD_SCRIPT = 'setTimeout(function () { window.location.reload(); }, 2000);'
+
+
+def refinement_passes(size: int, coarsest: int = 16) -> List[np.ndarray]:
+    """Return the indices of the points of a size * size grid (numbered row by row) that each
+    pass fetches: the first pass takes every coarsest-th row and column, and every pass after
+    it halves the step, taking only the points that no earlier pass took.
+
+    Preconditions:
+        - size >= 1
+        - coarsest >= 1 and coarsest is a power of 2
+
+    >>> [indices.tolist() for indices in refinement_passes(3, 2)]
+    [[0, 2, 6, 8], [1, 3, 4, 5, 7]]
+    """
+    rows, cols = np.divmod(np.arange(size * size), size)
+
+    # the coarsest step each point is on, so each point belongs to exactly one pass
+    passes = []
+    step = coarsest
+    taken = np.zeros(size * size, dtype=bool)
+    while step >= 1:
+        on_step = (rows % step == 0) & (cols % step == 0) & ~taken
+        passes.append(np.nonzero(on_step)[0])
+        taken |= on_step
+        step //= 2
+
+    return passes
+
+
+@timed()
+def run_progressive(my_map: MapArea = CANADA, source: Optional[ElevationSource] = None,
+                    predictions: Optional[tuple] = None, preview: Optional[Preview] = None,
+                    budget: float = 5.0, coarsest: int = 16, batch_size: int = 100,
+                    cancel: Optional[threading.Event] = None) -> FloodResult:
+    """Return the comparison of the 50 * 50 grid of points of my_map to the predicted sea level,
+    like compare_altitude_to_sea_level(get_altitude_data(my_map, source), compact=True), fetched
+    coarse to fine in the passes of refinement_passes(50, coarsest).
+
+    The altitudes are read from source (the elevation API by default), batch_size points at a
+    time, in a worker thread. preview is called from the calling thread with the comparison of
+    every point fetched so far after each pass, and also when budget seconds have passed if the
+    first pass is not finished by then, without waiting for the batch being fetched. Setting
+    cancel stops the run, which then raises Cancelled once the batch being fetched is done.
+
+    Preconditions:
+        - budget >= 0
+        - coarsest >= 1 and coarsest is a power of 2
+        - batch_size >= 1
+    """
+    start_time = time.perf_counter()
+    if source is None:
+        source = ApiElevationSource()
+    if predictions is None:
+        predictions = prediction_creator()
+
+    grid = split_into_grid(50, 50, my_map)
+    coords = np.array([point.coords for point in get_midpoints(grid, my_map)])
+    regions = region_ids(coords, my_map)
+    projections = np.array(predictions, dtype=float)
+
+    passes = refinement_passes(50, coarsest)
+    stop = threading.Event()
+    lock = threading.Lock()
+
+    # ACCUMULATORS: the flooded points and size of every batch fetched so far, the passes
+    # finished (or the error of the worker thread), and how many points the last preview showed
+    # (-1 before the first preview)
+    results = []
+    finished = queue.Queue()
+    shown = -1
+
+    def fetch() -> None:
+        try:
+            for indices in passes:
+                for batch_start in range(0, len(indices), batch_size):
+                    if stop.is_set():
+                        return
+                    batch = indices[batch_start:batch_start + batch_size]
+                    altitudes = source.sample([tuple(point) for point in coords[batch].tolist()])
+                    elevations = np.array([np.nan if altitude is None else altitude
+                                           for altitude in altitudes], dtype=float)
+                    point_index, year_index, depth = flooded_points(elevations, regions[batch],
+                                                                    projections)
+                    with lock:
+                        results.append((batch[point_index], year_index, depth, len(batch)))
+                    count('points_fetched', len(batch))
+                finished.put(None)
+        except BaseException as error:
+            finished.put(error)
+
+    def comparison() -> Tuple[FloodResult, int]:
+        with lock:
+            batches = list(results)
+        return (FloodResult.from_points(
+            coords, *(np.concatenate([np.zeros(0, dtype=dtype)] + [r[i] for r in batches])
+                      for i, dtype in enumerate([np.int64, np.int64, float])), years=DECADES),
+                sum(r[3] for r in batches))
+
+    worker = threading.Thread(target=fetch, daemon=True)
+    worker.start()
+    try:
+        for _ in passes:
+            # wait for the pass to finish, but show what there is as soon as the budget runs out
+            while True:
+                if cancel is not None and cancel.is_set():
+                    raise Cancelled()
+                wait = POLL_INTERVAL
+                if shown < 0 and preview is not None:
+                    wait = min(wait, start_time + budget - time.perf_counter())
+                try:
+                    error = finished.get(timeout=max(wait, 0))
+                    break
+                except queue.Empty:
+                    if shown < 0 and preview is not None \
+                            and time.perf_counter() - start_time >= budget:
+                        partial, shown = comparison()
+                        preview(partial, shown / len(coords))
+            if error is not None:
+                raise error
+
+            if preview is not None:
+                partial, fetched = comparison()
+                if fetched > shown:
+                    preview(partial, fetched / len(coords))
+                    shown = fetched
+    finally:
+        stop.set()
+        worker.join()
+
+    return comparison()[0]
+
+
+def write_preview(result: FloodResult, filename: str, my_map: Optional[MapArea] = None,
+                  final: bool = True,
+                  title: str = 'Areas at risk of flooding in the next century') -> None:
+    """Write the bubble map of result to the HTML file filename, replacing it in one step so a
+    browser never reads a half-written file. Unless final is True, the page reloads itself every
+    few seconds to show the next version of the file. my_map is the area shown, as in
+    bubble.build_figure.
+    """
+    import bubble
+
+    data = result.to_long()
+    if data['year'] == []:
+        # plotly express cannot draw an empty frame, so draw one bubble of size 0 instead
+        area = CANADA if my_map is None else my_map
+        data = {'year': [result.years[0]], 'lat': [float(np.mean(area.latitude))],
+                'lon': [float(area.longitude[0])], 'diff': [0.0]}
+
+    figure = bubble.build_figure(data, title, my_map)
+    figure.write_html(filename + '.tmp', include_plotlyjs='cdn',
+                      post_script=None if final else RELOAD_SCRIPT)
+    os.replace(filename + '.tmp', filename)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Draw a coarse flooding map first and refine '
+                                                 'it in place.')
+    parser.add_argument('--dem', help='read altitudes from this raster instead of the API')
+    parser.add_argument('--output', default='preview.html', help='the HTML file to write')
+    parser.add_argument('--budget', type=float, default=5.0,
+                        help='seconds to wait at most before the first preview')
+    parser.add_argument('--coarsest', type=int, default=16,
+                        help='the step between the rows and columns of the first pass')
+    args = parser.parse_args()
+
+    def show(partial: FloodResult, done: float) -> None:
+        """Redraw the preview with the points fetched so far."""
+        write_preview(partial, args.output, final=False)
+        print('%3.0f%% of the grid drawn to %s' % (100 * done, args.output))
+
+    elevation_source = None if args.dem is None else RasterElevationSource(args.dem)
+    final_result = run_progressive(source=elevation_source, preview=show, budget=args.budget,
+                                   coarsest=args.coarsest)
+    write_preview(final_result, args.output)
+    print('Finished drawing', args.output)
@@ -0,0 +1,193 @@
+"""This module assigns locations to regions of any shape, such as provinces, watersheds or
+coastal zones, instead of the 4 quadrants used by flooding.categorize.
+
+Regions are polygons, usually loaded from a GeoJSON file. To assign many points quickly, a
+RegionIndex first splits the map into a grid of buckets and records which regions' bounding boxes
+overlap each bucket, so each point is only tested against the few regions near it. The
+point-in-polygon test itself runs on all candidate points at once, edge by edge, and each edge
+only looks at the points in its band of latitudes, which are found by binary search.
+"""
+from typing import Any, Dict, List, Tuple
+from dataclasses import dataclass, field
+import json
+import numpy as np
+from map_setup import MapArea
+from altitudes import split_into_grid
+from instrumentation import timed
+
+
+@dataclass
+class Region:
+    """An area of the map made of one or more polygons.
+
+    Each polygon is a list of rings, and each ring an array of (longitude, latitude) vertices,
+    as in GeoJSON. The first ring of a polygon is its outline and the others are holes in it.
+
+    Instance Attributes:
+        - name: the name of the region
+        - polygons: the polygons making up the region
+        - properties: any other information about the region, such as GeoJSON properties
+
+    Representation Invariants:
+        - self.polygons != []
+        - all(len(ring) >= 3 for polygon in self.polygons for ring in polygon)
+    """
+    name: str
+    polygons: List[List[np.ndarray]]
+    properties: Dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def bounds(self) -> Tuple[float, float, float, float]:
+        """Return the (west, south, east, north) edges of the region's bounding box."""
+        vertices = np.concatenate([polygon[0] for polygon in self.polygons])
+        return (float(vertices[:, 0].min()), float(vertices[:, 1].min()),
+                float(vertices[:, 0].max()), float(vertices[:, 1].max()))
+
+
+def load_geojson(filename: str, name_property: str = 'name') -> List[Region]:
+    """Return the Polygon and MultiPolygon features of the GeoJSON file as regions, named by the
+    given property of each feature (or by their position in the file if they do not have it).
+    """
+    with open(filename) as f:
+        features = json.load(f)['features']
+
+    # ACCUMULATOR: one region per polygon feature
+    regions = []
+    for i, feature in enumerate(features):
+        geometry = feature['geometry']
+        if geometry['type'] == 'Polygon':
+            polygons = [geometry['coordinates']]
+        elif geometry['type'] == 'MultiPolygon':
+            polygons = geometry['coordinates']
+        else:
+            continue
+
+        properties = feature.get('properties') or {}
+        regions.append(Region(str(properties.get(name_property, i)),
+                              [[np.array(ring, dtype=float)[:, :2] for ring in polygon]
+                               for polygon in polygons],
+                              properties))
+
+    return regions
+
+
+def quadrant_regions(my_map: MapArea) -> List[Region]:
+    """Return the 4 quadrants of my_map as regions, in the same order as the prediction lists of
+    flooding.categorize (bottom-left, bottom-right, top-left, top-right).
+
+    >>> [region.name for region in quadrant_regions(MapArea((40.0, 84.0), (-146.0, -50.0)))]
+    ['bottom-left', 'bottom-right', 'top-left', 'top-right']
+    """
+    latitudes, longitudes = split_into_grid(2, 2, my_map)
+    names = ['bottom-left', 'bottom-right', 'top-left', 'top-right']
+
+    return [Region(names[2 * row + col],
+                   [[np.array([(longitudes[col], latitudes[row]),
+                               (longitudes[col + 1], latitudes[row]),
+                               (longitudes[col + 1], latitudes[row + 1]),
+                               (longitudes[col], latitudes[row + 1])])]])
+            for row in range(2) for col in range(2)]
+
+
+class RegionIndex:
+    """A spatial index of regions, used to find which region each point lies in.
+
+    Instance Attributes:
+        - regions: the indexed regions, numbered by their position in this list
+        - bucket_size: the width and height of the index's buckets, in degrees
+
+    Representation Invariants:
+        - self.bucket_size > 0
+    """
+    regions: List[Region]
+    bucket_size: float
+    _buckets: Dict[Tuple[int, int], List[int]]
+
+    def __init__(self, regions: List[Region], bucket_size: float = 1.0) -> None:
+        self.regions = regions
+        self.bucket_size = bucket_size
+        self._buckets = {}
+
+        # record every bucket that each region's bounding box overlaps
+        for number, region in enumerate(regions):
+            west, south, east, north = region.bounds
+            for row in range(self._bucket(south), self._bucket(north) + 1):
+                for col in range(self._bucket(west), self._bucket(east) + 1):
+                    self._buckets.setdefault((row, col), []).append(number)
+
+    @timed('assign_regions')
+    def assign(self, coords: np.ndarray) -> np.ndarray:
+        """Return the number of the region that each (latitude, longitude) row of coords lies in,
+        or -1 if it is not in any region. A point in several overlapping regions is assigned the
+        first of them.
+
+        >>> square = Region('square', [[np.array([(0, 0), (2, 0), (2, 2), (0, 2)])]])
+        >>> RegionIndex([square]).assign(np.array([[1.0, 1.0], [3.0, 1.0]])).tolist()
+        [0, -1]
+        """
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        assigned = np.full(len(coords), -1)
+        if len(coords) == 0:
+            return assigned
+
+        # group the points by bucket, numbering the buckets row by row
+        rows = self._bucket(coords[:, 0])
+        cols = self._bucket(coords[:, 1])
+        width = int(cols.max() - cols.min()) + 1
+        keys = (rows - rows.min()) * width + (cols - cols.min())
+        order = np.argsort(keys, kind='stable')
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(keys[order])) + 1, [len(keys)]])
+
+        # ACCUMULATOR: the points to test against each region, from every bucket it overlaps
+        candidates = {}
+        for k in range(len(starts) - 1):
+            first_point = order[starts[k]]
+            for number in self._buckets.get((rows[first_point], cols[first_point]), []):
+                candidates.setdefault(number, []).append(order[starts[k]:starts[k + 1]])
+
+        for number in sorted(candidates):
+            points = np.concatenate(candidates[number])
+            points = points[assigned[points] == -1]  # first region wins
+            if len(points) > 0:
+                inside = _in_region(self.regions[number], coords[points, 1], coords[points, 0])
+                assigned[points[inside]] = number
+
+        return assigned
+
+    def _bucket(self, degrees: Any) -> Any:
+        """Return the bucket row or column of the given latitude(s) or longitude(s)."""
+        return np.floor(np.asarray(degrees) / self.bucket_size).astype(np.int64)
+
+
+def _in_region(region: Region, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """Return whether each point (x[i], y[i]) lies inside the region, using the even-odd rule
+    (a point is inside if a ray from it crosses the region's edges an odd number of times).
+    """
+    # sort the points by latitude, so the points in an edge's band of latitudes are contiguous
+    order = np.argsort(y, kind='stable')
+    x_sorted = x[order]
+    y_sorted = y[order]
+
+    # ACCUMULATOR: whether an odd number of edges have been crossed so far
+    inside = np.zeros(len(x), dtype=bool)
+
+    for polygon in region.polygons:
+        for ring in polygon:
+            start = ring
+            end = np.roll(ring, -1, axis=0)
+            low = np.minimum(start[:, 1], end[:, 1])
+            high = np.maximum(start[:, 1], end[:, 1])
+            first = np.searchsorted(y_sorted, low, side='left')
+            last = np.searchsorted(y_sorted, high, side='left')
+
+            for k in np.flatnonzero(last > first):
+                band = slice(first[k], last[k])
+                (x0, y0), (x1, y1) = start[k], end[k]
+                crossing = x0 + (y_sorted[band] - y0) * (x1 - x0) / (y1 - y0)
+                inside[band] ^= x_sorted[band] < crossing
+
+    # undo the sort
+    result = np.empty(len(x), dtype=bool)
+    result[order] = inside
+    return result
+
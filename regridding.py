@@ -0,0 +1,316 @@
+"""This module maps values on the temperature grid onto the elevation points.
+
+The elevation points and the temperature cells are usually on different grids. Instead of
+matching every point to a cell one at a time, the interpolation from the temperature grid to the
+elevation points is computed once as a sparse weight matrix: row p holds the weights of the
+temperature cells that make up the value at elevation point p. Any field with one row per year
+and one column per cell can then be mapped onto the points with a single matrix product.
+
+The weight matrices are saved to disk under a hash of both grids and the method, so they are
+only computed once for each pair of grids.
+"""
+from typing import Dict, Optional, Tuple
+from dataclasses import dataclass
+import hashlib
+import os
+import numpy as np
+from instrumentation import timed, count
+
+# folder that computed weight matrices are saved in
+CACHE_FOLDER = '.regrid_cache'
+
+# weight matrices already loaded in this process, keyed by their hash
+_loaded = {}
+
+
+@dataclass(frozen=True)
+class RegularGrid:
+    """A regular grid of cells covering a latitude/longitude box.
+
+    Row 0 is the southernmost row of cells and column 0 is the westernmost column, and cells are
+    numbered row by row (cell number = row * columns + column).
+
+    Instance Attributes:
+        - latitude: the (southern, northern) edges of the grid
+        - longitude: the (western, eastern) edges of the grid
+        - shape: the number of (rows, columns) of cells
+
+    Representation Invariants:
+        - self.latitude[0] < self.latitude[1]
+        - self.longitude[0] < self.longitude[1]
+        - self.shape[0] >= 1 and self.shape[1] >= 1
+    """
+    latitude: Tuple[float, float]
+    longitude: Tuple[float, float]
+    shape: Tuple[int, int]
+
+    @staticmethod
+    def from_centers(latitudes: np.ndarray, longitudes: np.ndarray) -> 'RegularGrid':
+        """Return the grid whose cell centers are at the given evenly spaced, increasing
+        latitudes and longitudes, such as the lat and lon variables of a NetCDF file.
+
+        >>> RegularGrid.from_centers(np.array([-45.0, 45.0]), np.array([0.0, 90.0, 180.0]))
+        RegularGrid(latitude=(-90.0, 90.0), longitude=(-45.0, 225.0), shape=(2, 3))
+        """
+        lat_step = (latitudes[-1] - latitudes[0]) / max(len(latitudes) - 1, 1)
+        lon_step = (longitudes[-1] - longitudes[0]) / max(len(longitudes) - 1, 1)
+
+        return RegularGrid((float(latitudes[0] - lat_step / 2),
+                            float(latitudes[-1] + lat_step / 2)),
+                           (float(longitudes[0] - lon_step / 2),
+                            float(longitudes[-1] + lon_step / 2)),
+                           (len(latitudes), len(longitudes)))
+
+    @property
+    def cell_size(self) -> Tuple[float, float]:
+        """Return the (height, width) of a cell in degrees."""
+        return ((self.latitude[1] - self.latitude[0]) / self.shape[0],
+                (self.longitude[1] - self.longitude[0]) / self.shape[1])
+
+    @property
+    def is_global(self) -> bool:
+        """Return whether the grid wraps all the way around in longitude."""
+        return abs(self.longitude[1] - self.longitude[0] - 360) < 1e-9
+
+
+@dataclass
+class SparseWeights:
+    """A sparse matrix of interpolation weights, stored row by row (compressed sparse rows).
+
+    The weights of row p are data[indptr[p]:indptr[p + 1]], for the columns in
+    indices[indptr[p]:indptr[p + 1]].
+
+    Instance Attributes:
+        - indptr: where each row starts in indices and data, with one extra entry at the end
+        - indices: the column (source cell number) of each weight
+        - data: the weights
+        - shape: the (number of target points, number of source cells) of the matrix
+
+    Representation Invariants:
+        - len(self.indptr) == self.shape[0] + 1
+        - len(self.indices) == len(self.data) == self.indptr[-1]
+    """
+    indptr: np.ndarray
+    indices: np.ndarray
+    data: np.ndarray
+    shape: Tuple[int, int]
+
+    def apply(self, field: np.ndarray) -> np.ndarray:
+        """Return field mapped onto the target points.
+
+        field has shape (years, source cells), or (years, rows, columns) for a field on the
+        source grid, and the result has shape (years, target points). Points with no weights
+        are given nan.
+
+        >>> weights = SparseWeights(np.array([0, 2, 2]), np.array([0, 1]), np.array([0.5, 0.5]),
+        ...                         (2, 2))
+        >>> weights.apply(np.array([[1.0, 3.0]])).tolist()
+        [[2.0, nan]]
+        """
+        field = np.asarray(field).reshape(len(field), -1)
+
+        # ACCUMULATOR: nan for the points with no weights
+        result = np.full((field.shape[0], self.shape[0]), np.nan)
+
+        rows = np.flatnonzero(np.diff(self.indptr) > 0)
+        if len(rows) > 0:
+            products = field[:, self.indices] * self.data
+            result[:, rows] = np.add.reduceat(products, self.indptr[rows], axis=1)
+
+        return result
+
+
+@timed()
+def regridding_weights(source: RegularGrid, points: np.ndarray, method: str = 'bilinear',
+                       point_size: Optional[Tuple[float, float]] = None,
+                       cache_folder: Optional[str] = CACHE_FOLDER) -> SparseWeights:
+    """Return the weights that map a field on the source grid onto the given points.
+
+    points is an array of (latitude, longitude) rows, such as the keys of altitude_data. method
+    is one of:
+        - 'nearest': the value of the cell containing the point
+        - 'bilinear': interpolated between the 4 cell centers around the point
+        - 'area': the average over the source cells of a point_size (height, width) box centered
+          on the point, weighted by the area of the overlap with each cell
+
+    The weights are loaded from cache_folder if they were computed before for the same grid,
+    points and method, and saved there otherwise. Pass cache_folder=None to skip the cache.
+
+    Preconditions:
+        - method in {'nearest', 'bilinear', 'area'}
+        - method != 'area' or point_size is not None
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    key = _weights_key(source, points, method, point_size)
+
+    if key in _loaded:
+        count('cache_hits')
+        return _loaded[key]
+
+    filename = None if cache_folder is None else os.path.join(cache_folder, key + '.npz')
+    if filename is not None and os.path.exists(filename):
+        count('cache_hits')
+        with np.load(filename) as saved:
+            weights = SparseWeights(saved['indptr'], saved['indices'], saved['data'],
+                                    tuple(saved['shape']))
+    else:
+        weights = _compute_weights(source, points, method, point_size)
+        if filename is not None:
+            os.makedirs(cache_folder, exist_ok=True)
+            np.savez(filename, indptr=weights.indptr, indices=weights.indices, data=weights.data,
+                     shape=np.array(weights.shape))
+
+    _loaded[key] = weights
+    return weights
+
+
+def _weights_key(source: RegularGrid, points: np.ndarray, method: str,
+                 point_size: Optional[Tuple[float, float]]) -> str:
+    """Return a hash identifying the weights for these grids and method.
+    """
+    digest = hashlib.sha256(repr((source, method, point_size)).encode())
+    digest.update(points.tobytes())
+    return digest.hexdigest()[:32]
+
+
+def _compute_weights(source: RegularGrid, points: np.ndarray, method: str,
+                     point_size: Optional[Tuple[float, float]]) -> SparseWeights:
+    """Return the weights described in regridding_weights, without using the cache.
+    """
+    if method == 'nearest':
+        rows, cols = _cell_of(source, points[:, 0], points[:, 1])
+        weights = {0: (rows, cols, np.ones(len(points)))}
+    elif method == 'bilinear':
+        weights = _bilinear(source, points)
+    elif method == 'area':
+        weights = _area_weighted(source, points, point_size)
+    else:
+        raise ValueError('Unknown regridding method: ' + method)
+
+    return _to_sparse(weights, len(points), source)
+
+
+def _cell_of(source: RegularGrid, latitudes: np.ndarray, longitudes: np.ndarray) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    """Return the (row, column) of the source cells containing the given points. Points outside
+    the grid are given row -1.
+    """
+    height, width = source.cell_size
+    rows = np.floor((latitudes - source.latitude[0]) / height).astype(np.int64)
+    cols = np.floor((_wrap(source, longitudes) - source.longitude[0]) / width).astype(np.int64)
+
+    outside = (rows < 0) | (rows >= source.shape[0]) | (cols < 0) | (cols >= source.shape[1])
+    rows[outside] = -1
+
+    return (rows, cols)
+
+
+def _bilinear(source: RegularGrid, points: np.ndarray) \
+        -> Dict[int, Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Return the bilinear weights of the 4 cell centers around each point, keyed by corner.
+    Points beyond the outermost cell centers use the nearest edge values.
+    """
+    height, width = source.cell_size
+
+    # position of each point in units of cells, relative to the center of cell (0, 0)
+    y = (points[:, 0] - source.latitude[0]) / height - 0.5
+    x = (_wrap(source, points[:, 1]) - source.longitude[0]) / width - 0.5
+
+    row0 = np.floor(y).astype(np.int64)
+    col0 = np.floor(x).astype(np.int64)
+    fy = y - row0
+    fx = x - col0
+
+    inside = (points[:, 0] >= source.latitude[0]) & (points[:, 0] <= source.latitude[1])
+    if not source.is_global:
+        lon = _wrap(source, points[:, 1])
+        inside &= (lon >= source.longitude[0]) & (lon <= source.longitude[1])
+
+    # ACCUMULATOR: (rows, columns, weights) of each of the 4 corners
+    weights = {}
+    for corner, (dr, dc) in enumerate([(0, 0), (0, 1), (1, 0), (1, 1)]):
+        rows = np.clip(row0 + dr, 0, source.shape[0] - 1)
+        cols = col0 + dc
+        cols = cols % source.shape[1] if source.is_global else np.clip(cols, 0, source.shape[1] - 1)
+        w = (fy if dr else 1 - fy) * (fx if dc else 1 - fx)
+        weights[corner] = (np.where(inside, rows, -1), cols, w)
+
+    return weights
+
+
+def _area_weighted(source: RegularGrid, points: np.ndarray, point_size: Tuple[float, float]) \
+        -> Dict[int, Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Return the area weights of the source cells overlapping the box around each point, keyed
+    by the offset of the cell from the first overlapping cell.
+    """
+    height, width = source.cell_size
+    south = points[:, 0] - point_size[0] / 2
+    north = points[:, 0] + point_size[0] / 2
+    west = _wrap(source, points[:, 1]) - point_size[1] / 2
+
+    first_row = np.floor((south - source.latitude[0]) / height).astype(np.int64)
+    first_col = np.floor((west - source.longitude[0]) / width).astype(np.int64)
+    span_rows = int(np.ceil(point_size[0] / height)) + 1
+    span_cols = int(np.ceil(point_size[1] / width)) + 1
+
+    # ACCUMULATOR: (rows, columns, weights) of each overlapping cell
+    weights = {}
+    for dr in range(span_rows):
+        rows = first_row + dr
+        cell_south = source.latitude[0] + rows * height
+        overlap_south = np.clip(np.maximum(south, cell_south), -90, 90)
+        overlap_north = np.clip(np.minimum(north, cell_south + height), -90, 90)
+        # the area of a box on a sphere is proportional to the difference of sin(latitude)
+        lat_weight = np.clip(np.sin(np.radians(overlap_north)) - np.sin(np.radians(overlap_south)),
+                             0, None)
+
+        for dc in range(span_cols):
+            cols = first_col + dc
+            cell_west = source.longitude[0] + cols * width
+            lon_weight = np.clip(np.minimum(west + point_size[1], cell_west + width)
+                                 - np.maximum(west, cell_west), 0, None)
+
+            if source.is_global:
+                cols = cols % source.shape[1]
+            valid = (rows >= 0) & (rows < source.shape[0]) \
+                & (cols >= 0) & (cols < source.shape[1])
+            weights[dr * span_cols + dc] = (np.where(valid, rows, -1), cols,
+                                            lat_weight * lon_weight)
+
+    # normalize the weights of each point so they add up to 1
+    totals = sum(np.where(rows >= 0, w, 0) for rows, _, w in weights.values())
+    totals[totals == 0] = 1
+    return {k: (rows, cols, w / totals) for k, (rows, cols, w) in weights.items()}
+
+
+def _to_sparse(weights: Dict[int, Tuple[np.ndarray, np.ndarray, np.ndarray]], point_count: int,
+               source: RegularGrid) -> SparseWeights:
+    """Return the sparse matrix with the given weights, dropping weights of zero and weights of
+    cells outside the grid (row -1).
+    """
+    rows = np.concatenate([r for r, _, _ in weights.values()])
+    cols = np.concatenate([c for _, c, _ in weights.values()])
+    data = np.concatenate([w for _, _, w in weights.values()])
+    points = np.tile(np.arange(point_count), len(weights))
+
+    keep = (rows >= 0) & (data > 0)
+    points, rows, cols, data = points[keep], rows[keep], cols[keep], data[keep]
+
+    # sort the weights by point, since the matrix is stored row by row
+    order = np.argsort(points, kind='stable')
+    indptr = np.zeros(point_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(points, minlength=point_count), out=indptr[1:])
+
+    return SparseWeights(indptr, (rows * source.shape[1] + cols)[order], data[order],
+                         (point_count, source.shape[0] * source.shape[1]))
+
+
+def _wrap(source: RegularGrid, longitudes: np.ndarray) -> np.ndarray:
+    """Return the longitudes shifted by a multiple of 360 degrees to lie within 360 degrees east
+    of the western edge of the source grid, so that grids going from 0 to 360 degrees and points
+    going from -180 to 180 degrees (or the other way around) line up.
+
+    >>> _wrap(RegularGrid((-90, 90), (0, 360), (1, 1)), np.array([-90.0, 10.0])).tolist()
+    [270.0, 10.0]
+    """
+    return (longitudes - source.longitude[0]) % 360 + source.longitude[0]
@@ -0,0 +1,255 @@
+"""This module contains the semi-empirical sea level models that the projection can be made with.
+
+data_analysis.py uses one model, where sea level rises at a rate proportional to the temperature
+anomaly, dH/dt = a * (T - T0). The models here are all of the form
+    dH/dt = c_1 * f_1(t, T) + ... + c_k * f_k(t, T) - H / tau
+where the terms f_i depend only on the time and the temperature, the coefficients c_i are fitted
+to the sea level data, and tau is the response time of the sea level (infinite if the sea level
+does not relax towards an equilibrium). The registered models are:
+    - 'rahmstorf': dH/dt = a * (T - T0), the model of data_analysis.py
+    - 'equilibrium': dH/dt = a * (T - Te), which rises only above a fitted equilibrium
+      temperature Te, written as a * (T - T0) + b
+    - 'lagged': dH/dt = (a * (T - T0) - H) / tau, where the sea level lags behind its
+      equilibrium a * (T - T0) with a response time of tau years
+
+Since the sea level of such a model is linear in its coefficients, every model is projected the
+same way by model_projections: the response of the sea level to each term is integrated once,
+for every temperature series (every cell or ensemble member) together, and the coefficients of
+every series are then fitted at once by least squares. Models with no response time are
+integrated with the midpoint Riemann sum of data_analysis.integrate_anomalies, so 'rahmstorf'
+reproduces the projections of data_analysis.py. The others are advanced by a shared time stepper.
+A new model only defines its terms (see SeaLevelModel) and is added with register_model.
+"""
+from typing import Dict, List, Optional, Union
+import math
+import numpy as np
+from dataset_cleaner import read_sea_level_data
+from data_analysis import PolynomialFit, evaluate_polynomials
+from instrumentation import timed, count
+
+
+class SeaLevelModel:
+    """A semi-empirical model of the rate of sea level change.
+
+    This is an abstract class. Subclasses must implement the terms method.
+
+    Instance Attributes:
+        - name: the name the model is registered under
+        - term_names: the names of the coefficients of the terms of the rate
+        - response_time: the response time tau of the sea level, in years (math.inf if the rate
+          does not depend on the sea level)
+
+    Representation Invariants:
+        - self.term_names != []
+        - self.response_time > 0
+    """
+    name: str
+    term_names: List[str]
+    response_time: float = math.inf
+
+    def terms(self, time: np.ndarray, temperatures: np.ndarray, t0: np.ndarray) -> np.ndarray:
+        """Return an array of shape (len(self.term_names), number of times, number of series)
+        with the value of every term of the rate at each time, for each series, given the
+        temperature of each series at each time and at the base year (t0).
+
+        time has shape (number of times, 1), temperatures has shape (number of times, number of
+        series), and t0 has shape (number of series,).
+        """
+        raise NotImplementedError
+
+
+class RahmstorfModel(SeaLevelModel):
+    """The sea level rises at a rate proportional to the temperature anomaly:
+    dH/dt = a * (T - T0).
+    """
+    name = 'rahmstorf'
+    term_names = ['a']
+
+    def terms(self, time: np.ndarray, temperatures: np.ndarray, t0: np.ndarray) -> np.ndarray:
+        """Return the temperature anomaly of every series."""
+        return (temperatures - t0)[np.newaxis]
+
+
+class EquilibriumModel(SeaLevelModel):
+    """The sea level rises at a rate proportional to how far the temperature is above an
+    equilibrium temperature Te: dH/dt = a * (T - Te) = a * (T - T0) + b, with b = a * (T0 - Te).
+    """
+    name = 'equilibrium'
+    term_names = ['a', 'b']
+
+    def terms(self, time: np.ndarray, temperatures: np.ndarray, t0: np.ndarray) -> np.ndarray:
+        """Return the temperature anomaly and a constant rate of 1 for every series."""
+        return np.stack([temperatures - t0, np.ones_like(temperatures)])
+
+
+class LaggedModel(SeaLevelModel):
+    """The sea level relaxes towards the equilibrium sea level a * (T - T0) with a response time
+    of tau years: dH/dt = (a * (T - T0) - H) / tau.
+    """
+    name = 'lagged'
+    term_names = ['a']
+
+    def __init__(self, response_time: float = 200.0) -> None:
+        self.response_time = response_time
+
+    def terms(self, time: np.ndarray, temperatures: np.ndarray, t0: np.ndarray) -> np.ndarray:
+        """Return the temperature anomaly of every series, divided by the response time."""
+        return ((temperatures - t0) / self.response_time)[np.newaxis]
+
+
+# the registered models, keyed by name
+MODELS: Dict[str, SeaLevelModel] = {}
+
+
+def register_model(model: SeaLevelModel) -> SeaLevelModel:
+    """Register model under its name, replacing any model registered under the same name, and
+    return it.
+    """
+    MODELS[model.name] = model
+    return model
+
+
+def get_model(name: str) -> SeaLevelModel:
+    """Return the model registered under name.
+
+    Raise a ValueError if no model is registered under name.
+
+    >>> get_model('lagged').response_time
+    200.0
+    """
+    if name not in MODELS:
+        raise ValueError('Unknown sea level model %r, expected one of: %s'
+                         % (name, ', '.join(sorted(MODELS))))
+    return MODELS[name]
+
+
+register_model(RahmstorfModel())
+register_model(EquilibriumModel())
+register_model(LaggedModel())
+
+
+@timed()
+def term_responses(model: SeaLevelModel, fit: PolynomialFit, years: List[int], y0: int = 2012,
+                   steps_per_year: int = 4, n: int = 100) -> np.ndarray:
+    """Return an array of shape (len(model.term_names), len(years), number of series) with the
+    sea level in each year of the model with one coefficient set to 1 and the others to 0, for
+    each of the fitted temperature curves, starting from a sea level of 0 in y0.
+
+    If the model has no response time, the terms are integrated from y0 to each year with the
+    midpoint Riemann sum of n intervals, like data_analysis.integrate_anomalies. Otherwise the
+    sea level is advanced from y0 to each year (forwards or backwards) in steps of
+    1 / steps_per_year years, with the terms evaluated in the middle of each step and the
+    relaxation towards equilibrium solved exactly. Every series is advanced at once.
+
+    Preconditions:
+        - all(year == int(year) for year in years)
+        - steps_per_year >= 1
+        - n >= 1
+
+    >>> fit = PolynomialFit(np.array([[0.0], [1.0]]), 2012.0, 1.0)  # T = year - 2012
+    >>> term_responses(get_model('rahmstorf'), fit, [2010, 2014]).round(6).tolist()
+    [[[2.0], [2.0]]]
+    >>> term_responses(LaggedModel(2.0), fit, [2014]).round(3).tolist()  # exactly 2 / e
+    [[[0.734]]]
+    """
+    years = np.asarray(years, dtype=float)
+    t0 = evaluate_polynomials(fit, np.array([y0]))[0]
+    if model.response_time == math.inf:
+        return _riemann_responses(model, fit, years, y0, t0, n)
+
+    responses = np.zeros((len(model.term_names), len(years), len(t0)))
+
+    for direction in (1, -1):
+        step = direction / steps_per_year
+        # the number of steps from y0 to each year, in this direction
+        steps = np.round((years - y0) / step).astype(int)
+        last = steps.max(initial=0)
+
+        # over one step, H becomes H * decay + gain * (rate without the relaxation)
+        decay = math.exp(-step / model.response_time)
+        gain = model.response_time * (1 - decay)
+
+        state = np.zeros(responses.shape[::2])
+        for k in range(last):
+            time = np.array([y0 + step * (k + 0.5)])
+            temperatures = evaluate_polynomials(fit, time)
+            state = decay * state + gain * model.terms(time[:, np.newaxis], temperatures, t0)[:, 0]
+            responses[:, steps == k + 1] = state[:, np.newaxis]
+        count('integration_steps', last)
+
+    return responses
+
+
+def _riemann_responses(model: SeaLevelModel, fit: PolynomialFit, years: np.ndarray, y0: int,
+                       t0: np.ndarray, n: int) -> np.ndarray:
+    """Return term_responses(model, fit, years, y0, n=n) for a model with no response time.
+
+    The sum runs over the n intervals one at a time, for every year and series at once, so it
+    only ever holds the terms of one midpoint of each year.
+    """
+    dx = (years - y0) / n  # length of the intervals, like data_analysis.integrate_anomalies
+
+    # ACCUMULATOR: the sum of the terms at the midpoints of the intervals so far
+    sums = np.zeros((len(model.term_names), len(years), len(t0)))
+    for j in range(n):
+        midpoints = y0 + dx * (j + 0.5)
+        sums += model.terms(midpoints[:, np.newaxis], evaluate_polynomials(fit, midpoints), t0)
+    count('integration_steps', n)
+
+    return dx[:, np.newaxis] * sums
+
+
+def calibrate(responses: np.ndarray, sea_levels: np.ndarray) -> np.ndarray:
+    """Return an array of shape (terms, number of series) with the least squares coefficients
+    (with an intercept, which is discarded) of the sea levels against the term responses of
+    each series, for responses of shape (terms, years, number of series) as returned by
+    term_responses.
+
+    sea_levels may have shape (years,), or (years, number of series) to give each series its own
+    sea levels.
+
+    >>> calibrate(np.array([[[0.0], [1.0], [2.0]]]), np.array([1.0, 3.0, 5.0])).tolist()
+    [[2.0]]
+    """
+    if sea_levels.ndim == 1:
+        sea_levels = sea_levels[:, np.newaxis]
+
+    x = responses - responses.mean(axis=1, keepdims=True)
+    y = sea_levels - sea_levels.mean(axis=0)
+
+    # the normal equations of every series, solved at once
+    count('fits', responses.shape[2])
+    normal = np.einsum('iys,jys->sij', x, x)
+    target = np.einsum('iys,ys->si', x, y)
+    return np.linalg.solve(normal, target[..., np.newaxis])[..., 0].T
+
+
+def model_projections(model: Union[str, SeaLevelModel], years: List[int], fit: PolynomialFit,
+                      sea_levels: Optional[Dict[int, float]] = None, y0: int = 2012,
+                      calibration_years: Optional[List[int]] = None,
+                      steps_per_year: int = 4, n: int = 100) -> np.ndarray:
+    """Return an array of shape (len(years), number of series) with the sea level predicted by
+    model (or the model registered under that name) in each year, relative to y0, for each of
+    the fitted temperature curves.
+
+    The coefficients of each series are fitted over calibration_years, which are 2006 to 2018
+    (all the years with sea level data) by default. steps_per_year and n are passed on to
+    term_responses.
+
+    Preconditions:
+        - calibration_years is None or all(year in sea_levels for year in calibration_years)
+    """
+    if isinstance(model, str):
+        model = get_model(model)
+    if sea_levels is None:
+        sea_levels = read_sea_level_data('datasets/global_timeseries_measures.nc.nc4')
+    if calibration_years is None:
+        calibration_years = list(range(2006, 2019))
+
+    responses = term_responses(model, fit, list(calibration_years) + list(years), y0,
+                               steps_per_year, n)
+    calibration = responses[:, :len(calibration_years)]
+    levels = np.array([sea_levels[year] for year in calibration_years], dtype=float)
+
+    coefficients = calibrate(calibration, levels)
+    return np.einsum('iys,is->ys', responses[:, len(calibration_years):], coefficients)
@@ -0,0 +1,252 @@
+"""This module measures how sensitive the sea level projections are to the model's parameters.
+
+The projection of data_analysis.py depends on choices that are fixed there:
+    - degree: the degree of the polynomial fitted to the temperatures (6)
+    - n: the number of intervals of the Riemann sum of the temperature anomaly (100)
+    - y0: the year the temperature anomaly is measured from (2012)
+    - calibration: the first and last years the constant is fitted over (2006 to 2018)
+sweep evaluates every combination of a grid of these parameters for the 4 temperature series of
+flooding.py, and tabulates the predicted sea level and the number of flooded locations in every
+decade for each combination.
+
+The combinations are grouped by degree, and each group is split into chunks, so there are a few
+chunks for every worker process however many degrees the grid has. Every worker receives the
+datasets once, when it starts, and then fits the temperature curves once per degree and
+integrates them once per (n, y0) in each chunk, reusing them for every combination of the chunk
+that shares them.
+
+Run it with, for example:
+    python sensitivity.py --degrees 4 5 6 7 --intervals 50 100 --base-years 2010 2012
+"""
+from typing import Dict, List, Optional, Sequence, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+import argparse
+import csv
+import itertools
+import math
+import os
+import sys
+import numpy as np
+from datasets.Temperatures import temp1, temp2, temp3, temp4
+from dataset_cleaner import read_sea_level_data
+from data_analysis import fit_polynomials, integrate_anomalies, regression_slopes
+from flooding import DECADES, altitude_arrays, region_ids, flooded_points
+from map_setup import MapArea, CANADA
+from instrumentation import timed, count
+
+# the datasets of this worker process, set up by _start_worker
+_worker_data = {}
+
+# the number of chunks of combinations to aim for per worker process, so the workers that finish
+# early pick up more chunks instead of waiting for the slowest one
+CHUNKS_PER_WORKER = 4
+
+
+@dataclass(frozen=True)
+class Parameters:
+    """One combination of the parameters of the sea level projection.
+
+    Instance Attributes:
+        - degree: the degree of the polynomial fitted to the temperatures
+        - n: the number of intervals of the Riemann sum of the temperature anomaly
+        - y0: the year the temperature anomaly is measured from
+        - calibration: the first and last years the constant is fitted over
+
+    Representation Invariants:
+        - self.degree >= 1
+        - self.n >= 1
+        - 2006 <= self.calibration[0] < self.calibration[1] <= 2018
+    """
+    degree: int = 6
+    n: int = 100
+    y0: int = 2012
+    calibration: Tuple[int, int] = (2006, 2018)
+
+
+@dataclass
+class SweepResult:
+    """The projection made with one combination of parameters.
+
+    Instance Attributes:
+        - parameters: the parameters of the projection
+        - sea_levels: array of shape (4, len(DECADES)) with the predicted sea level in each
+          decade for each temperature series of flooding.py
+        - flooded: array of shape (len(DECADES),) with the number of flooded locations in each
+          decade
+    """
+    parameters: Parameters
+    sea_levels: np.ndarray
+    flooded: np.ndarray
+
+
+def parameter_grid(degrees: Sequence[int] = (6,), intervals: Sequence[int] = (100,),
+                   base_years: Sequence[int] = (2012,),
+                   calibrations: Sequence[Tuple[int, int]] = ((2006, 2018),)) \
+        -> List[Parameters]:
+    """Return every combination of the given degrees, numbers of intervals, base years and
+    calibration windows.
+
+    >>> len(parameter_grid([5, 6], [50, 100], [2010, 2012, 2014]))
+    12
+    """
+    return [Parameters(degree, n, y0, tuple(calibration))
+            for degree, n, y0, calibration
+            in itertools.product(degrees, intervals, base_years, calibrations)]
+
+
+@timed()
+def sweep(parameters: List[Parameters], altitudes: Optional[Dict] = None,
+          processes: Optional[int] = None, my_map: MapArea = CANADA) -> List[SweepResult]:
+    """Return the projection made with each combination in parameters, in the same order,
+    computed by processes worker processes (one per CPU by default).
+
+    The flooded locations are counted among altitudes (AltitudeData by default), split into the
+    quadrants of my_map (the map of Canada by default) like compare_altitude_to_sea_level.
+
+    Preconditions:
+        - all(len(temp1) > p.degree for p in parameters)
+        - processes is None or processes >= 1
+    """
+    if altitudes is None:
+        from datasets.AltitudeData import altitude_data
+        altitudes = altitude_data
+
+    temps = [temp1, temp2, temp3, temp4]
+    temp_years = np.array(list(temp1), dtype=float)
+    temperatures = np.array([[temp[year] for temp in temps] for year in temp1])
+    sea_levels = read_sea_level_data('datasets/global_timeseries_measures.nc.nc4')
+    sea_levels = {year: float(level) for year, level in sea_levels.items()}
+    coords, elevations = altitude_arrays(altitudes)
+    regions = region_ids(coords, my_map)
+
+    # group the combinations by degree, and then by (n, y0), so each chunk of a group fits the
+    # temperature curves once and reuses each integral for the consecutive combinations sharing it
+    groups = {}
+    for i, combination in enumerate(parameters):
+        groups.setdefault(combination.degree, []).append(i)
+    workers = min(processes or os.cpu_count(), max(len(parameters), 1))
+    size = max(math.ceil(len(parameters) / (CHUNKS_PER_WORKER * workers)), 1)
+    chunks = []
+    for indices in groups.values():
+        indices.sort(key=lambda i: (parameters[i].n, parameters[i].y0))
+        chunks.extend(indices[start:start + size] for start in range(0, len(indices), size))
+
+    # ACCUMULATOR: the result of every combination, filled in as the tasks finish
+    results = [None] * len(parameters)
+
+    with ProcessPoolExecutor(max_workers=min(workers, max(len(chunks), 1)),
+                             initializer=_start_worker,
+                             initargs=(temp_years, temperatures, sea_levels, elevations,
+                                       regions)) as executor:
+        tasks = {executor.submit(_evaluate_task, [parameters[i] for i in indices]): indices
+                 for indices in chunks}
+        for task, indices in tasks.items():
+            for i, result in zip(indices, task.result()):
+                results[i] = result
+
+    return results
+
+
+def evaluate(parameters: List[Parameters], temp_years: np.ndarray, temperatures: np.ndarray,
+             sea_levels: Dict[int, float], elevations: np.ndarray, regions: np.ndarray) \
+        -> List[SweepResult]:
+    """Return the projection made with each combination in parameters, for the temperature
+    series in the columns of temperatures, counting the flooded locations among elevations
+    (numbered by region like flooding.flooded_points).
+
+    Each temperature fit is computed once per degree and each integral once per (degree, n, y0),
+    however many combinations use them.
+
+    Preconditions:
+        - temperatures.shape[0] == len(temp_years)
+        - all(year in sea_levels for p in parameters
+              for year in range(p.calibration[0], p.calibration[1] + 1))
+    """
+    measured = sorted(sea_levels)
+    years = measured + DECADES
+    levels = np.array([sea_levels[year] for year in measured])
+
+    # ACCUMULATORS: the fits by degree, the integrals by (degree, n, y0), and the results
+    fits = {}
+    integrals = {}
+    results = []
+
+    for combination in parameters:
+        if combination.degree not in fits:
+            fits[combination.degree] = fit_polynomials(temp_years, temperatures,
+                                                       combination.degree)
+        key = (combination.degree, combination.n, combination.y0)
+        if key not in integrals:
+            integrals[key] = integrate_anomalies(fits[combination.degree], years, combination.n,
+                                                 combination.y0)
+        integral = integrals[key]
+
+        # fit the constants over the calibration window, like calibration_constants
+        start, end = combination.calibration
+        window = [i for i, year in enumerate(measured) if start <= year <= end]
+        constants = regression_slopes(integral[window], levels[window])
+        projections = (constants * integral[len(measured):]).T
+
+        _, year_index, _ = flooded_points(elevations, regions, projections)
+        count('combinations')
+        results.append(SweepResult(combination, projections,
+                                   np.bincount(year_index, minlength=len(DECADES))))
+
+    return results
+
+
+def write_table(results: List[SweepResult], file: object) -> None:
+    """Write results to the open text file as a CSV table, with one row per combination and
+    decade, giving the parameters, the predicted sea level of each temperature series and the
+    number of flooded locations.
+    """
+    writer = csv.writer(file)
+    writer.writerow(['degree', 'n', 'y0', 'calibration_start', 'calibration_end', 'year']
+                    + ['sea_level_%d' % (i + 1) for i in range(4)] + ['flooded'])
+
+    for result in results:
+        p = result.parameters
+        for j, year in enumerate(DECADES):
+            writer.writerow([p.degree, p.n, p.y0, p.calibration[0], p.calibration[1], year]
+                            + ['%.6g' % level for level in result.sea_levels[:, j]]
+                            + [int(result.flooded[j])])
+
+
+def _start_worker(temp_years: np.ndarray, temperatures: np.ndarray,
+                  sea_levels: Dict[int, float], elevations: np.ndarray,
+                  regions: np.ndarray) -> None:
+    """Keep the datasets sent to this worker process for every task it runs."""
+    _worker_data.update(temp_years=temp_years, temperatures=temperatures, sea_levels=sea_levels,
+                        elevations=elevations, regions=regions)
+
+
+def _evaluate_task(parameters: List[Parameters]) -> List[SweepResult]:
+    """Return evaluate(parameters) on the datasets of this worker process."""
+    return evaluate(parameters, **_worker_data)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tabulate the projections for a grid of '
+                                                 'model parameters.')
+    parser.add_argument('--degrees', type=int, nargs='+', default=[6],
+                        help='degrees of the temperature curves')
+    parser.add_argument('--intervals', type=int, nargs='+', default=[100],
+                        help='numbers of intervals of the Riemann sums')
+    parser.add_argument('--base-years', type=int, nargs='+', default=[2012],
+                        help='years the temperature anomaly is measured from')
+    parser.add_argument('--calibrations', nargs='+', default=['2006-2018'],
+                        help='calibration windows, as FIRST-LAST years')
+    parser.add_argument('--processes', type=int, help='the number of worker processes')
+    parser.add_argument('--output', help='write the table to this CSV file instead of stdout')
+    args = parser.parse_args()
+
+    windows = [tuple(int(year) for year in window.split('-')) for window in args.calibrations]
+    table = sweep(parameter_grid(args.degrees, args.intervals, args.base_years, windows),
+                  processes=args.processes)
+
+    if args.output is None:
+        write_table(table, sys.stdout)
+    else:
+        with open(args.output, 'w', newline='') as output_file:
+            write_table(table, output_file)
@@ -0,0 +1,165 @@
+"""This module shares the project's large arrays between worker processes without copying them.
+
+Passing altitude_data or the predictions to a multiprocessing pool pickles a copy of them for
+every worker. Instead, the arrays used to compare altitudes to sea level (the altitudes, the
+region of each point and the predicted sea levels) are placed in shared memory once, and every
+worker attaches NumPy views of that same memory. parallel_compare splits the points between the
+workers, so adding workers adds throughput without adding copies of the data. map_chunks does
+the same for any function of the shared arrays.
+"""
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from dataclasses import dataclass
+from multiprocessing import Pool, shared_memory
+import os
+import numpy as np
+from flooding import altitude_arrays, region_ids, flooded_points, long_format, prediction_creator
+from map_setup import MapArea, CANADA
+from instrumentation import timed
+
+# arrays attached by this worker process, keyed by name, set up by _attach_worker
+_worker_arrays = {}
+
+# shared memory blocks attached by this worker process, kept open while it runs
+_worker_blocks = []
+
+
+@dataclass(frozen=True)
+class SharedArray:
+    """The description of a NumPy array stored in a block of shared memory. It is small enough
+    to send to other processes, which can then attach the array without copying it.
+
+    Instance Attributes:
+        - name: the name of the shared memory block
+        - shape: the shape of the array
+        - dtype: the NumPy data type of the array, as a string
+    """
+    name: str
+    shape: Tuple[int, ...]
+    dtype: str
+
+    def attach(self) -> Tuple[np.ndarray, shared_memory.SharedMemory]:
+        """Return a view of the array and the shared memory block it is stored in. The block
+        must stay open (referenced) for as long as the view is used.
+        """
+        block = shared_memory.SharedMemory(name=self.name)
+        return (np.ndarray(self.shape, dtype=self.dtype, buffer=block.buf), block)
+
+
+class SharedArrays:
+    """A group of arrays copied into shared memory, which is freed when the group is closed.
+
+    Use it in a with statement:
+        with SharedArrays({'elevations': elevations}) as shared:
+            ... shared.descriptions['elevations'] can be sent to worker processes ...
+
+    Instance Attributes:
+        - descriptions: the SharedArray description of each array, keyed by name
+    """
+    descriptions: Dict[str, SharedArray]
+    _blocks: List[shared_memory.SharedMemory]
+
+    def __init__(self, arrays: Dict[str, np.ndarray]) -> None:
+        self.descriptions = {}
+        self._blocks = []
+
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+
+            self._blocks.append(block)
+            self.descriptions[name] = SharedArray(block.name, array.shape, array.dtype.str)
+
+    def __enter__(self) -> 'SharedArrays':
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Free the shared memory of every array in the group."""
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+
+def map_chunks(func: Callable[[Dict[str, np.ndarray], int, int], Any],
+               arrays: Dict[str, np.ndarray], size: int, processes: Optional[int] = None,
+               chunk_size: int = 100000) -> List[Any]:
+    """Return [func(views, start, stop) for each chunk], where the chunks split range(size) into
+    pieces of chunk_size, computed by a pool of processes workers (one per CPU by default).
+
+    arrays are copied into shared memory once, and func receives views of them in the worker,
+    keyed by the same names. func must be defined at the top level of a module so that it can be
+    sent to the workers.
+
+    Preconditions:
+        - processes is None or processes >= 1
+        - chunk_size >= 1
+    """
+    chunks = [(func, start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+
+    with SharedArrays(arrays) as shared:
+        with Pool(processes or os.cpu_count(), initializer=_attach_worker,
+                  initargs=(shared.descriptions,)) as pool:
+            return pool.map(_run_chunk, chunks)
+
+
+@timed()
+def parallel_compare(altitudes: Dict[Tuple[float, float], float],
+                     predictions: Optional[tuple] = None, processes: Optional[int] = None,
+                     chunk_size: int = 100000, my_map: MapArea = CANADA) -> Dict[str, list]:
+    """Return the same dictionary as
+    flooding.compare_altitude_to_sea_level(altitudes, my_map=my_map), computed by map_chunks.
+
+    The points, their regions and the predictions are shared with the workers through shared
+    memory, and each worker only sends back the points that flood.
+
+    Preconditions:
+        - processes is None or processes >= 1
+        - chunk_size >= 1
+    """
+    if predictions is None:
+        predictions = prediction_creator()
+
+    coords, elevations = altitude_arrays(altitudes)
+    regions = region_ids(coords, my_map)
+
+    results = map_chunks(_compare_chunk, {'elevations': elevations, 'regions': regions,
+                                          'projections': np.array(predictions, dtype=float)},
+                         len(elevations), processes, chunk_size)
+
+    # ACCUMULATORS: results of the chunks, which are already in point order
+    point_index = np.concatenate([np.zeros(0, dtype=np.int64)] + [r[0] for r in results])
+    year_index = np.concatenate([np.zeros(0, dtype=np.int64)] + [r[1] for r in results])
+    depth = np.concatenate([np.zeros(0)] + [r[2] for r in results])
+
+    return long_format(coords, point_index, year_index, depth)
+
+
+def _attach_worker(descriptions: Dict[str, SharedArray]) -> None:
+    """Attach the shared arrays in this worker process. Called once when each worker starts.
+    """
+    for name, description in descriptions.items():
+        array, block = description.attach()
+        _worker_arrays[name] = array
+        _worker_blocks.append(block)
+
+
+def _run_chunk(task: Tuple[Callable, int, int]) -> Any:
+    """Call the function in task on the shared arrays of this worker and the chunk in task.
+    """
+    func, start, stop = task
+    return func(_worker_arrays, start, stop)
+
+
+def _compare_chunk(arrays: Dict[str, np.ndarray], start: int, stop: int) \
+        -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return flooded_points for the points from start to stop (exclusive) of the shared arrays,
+    with point indices counted from the start of the whole array.
+    """
+    point_index, year_index, depth = flooded_points(arrays['elevations'][start:stop],
+                                                    arrays['regions'][start:stop],
+                                                    arrays['projections'])
+    return (point_index + start, year_index, depth)
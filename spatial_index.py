@@ -0,0 +1,411 @@
+"""This module answers questions about the elevation points at any location, not just at the
+exact coordinates stored in altitude_data.
+
+A PointIndex is built once over a set of points. It hashes the points into a grid of buckets, so
+nearest-neighbour, radius and bounding box queries only look at the buckets near each query.
+Values attached to the points (such as altitudes, or flood depths with one column per year) can
+then be interpolated at any location, by inverse distance weighting of the nearest points or,
+for points on a regular grid, bilinearly.
+
+Distances are great-circle distances in kilometres.
+"""
+from typing import List, Optional, Tuple
+import numpy as np
+from instrumentation import timed
+
+# mean radius of the earth, in kilometres
+EARTH_RADIUS = 6371.0088
+
+# length of one degree of latitude, in kilometres
+DEGREE_LENGTH = np.pi * EARTH_RADIUS / 180
+
+
+def haversine(lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray) \
+        -> np.ndarray:
+    """Return the great-circle distance in kilometres between the points (lat1, lon1) and
+    (lat2, lon2), given in degrees.
+
+    >>> round(float(haversine(np.array(0.0), np.array(0.0), np.array(1.0), np.array(0.0))), 3)
+    111.195
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(v) for v in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 \
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class PointIndex:
+    """A spatial index over a set of (latitude, longitude) points and the values at them.
+
+    Instance Attributes:
+        - coords: the indexed points, as an array of shape (points, 2)
+        - values: the values at the points, as an array of shape (points,) or (points, columns),
+          or None
+        - bucket_size: the width and height of the buckets, in degrees
+
+    Representation Invariants:
+        - self.values is None or len(self.values) == len(self.coords)
+        - self.bucket_size > 0
+    """
+    coords: np.ndarray
+    values: Optional[np.ndarray]
+    bucket_size: float
+    _origin: Tuple[float, float]
+    _shape: Tuple[int, int]
+    _order: np.ndarray
+    _starts: np.ndarray
+    _grid: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]]
+    _max_latitude: float
+
+    def __init__(self, coords: np.ndarray, values: Optional[np.ndarray] = None,
+                 bucket_size: Optional[float] = None) -> None:
+        """Build the index. By default the buckets are sized to hold about 2 points each.
+
+        Preconditions:
+            - len(coords) >= 1
+        """
+        self.coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        self.values = None if values is None else np.asarray(values, dtype=float)
+
+        south, west = self.coords.min(axis=0)
+        north, east = self.coords.max(axis=0)
+        if bucket_size is None:
+            area = max((north - south) * (east - west), 1e-12)
+            bucket_size = max(np.sqrt(2 * area / len(self.coords)), 1e-6)
+        self.bucket_size = float(bucket_size)
+
+        # number the buckets row by row, and sort the points by bucket
+        self._origin = (float(south), float(west))
+        self._shape = (int((north - south) // bucket_size) + 1,
+                       int((east - west) // bucket_size) + 1)
+        rows, cols = self._bucket(self.coords[:, 0], self.coords[:, 1])
+        keys = rows * self._shape[1] + cols
+        self._order = np.argsort(keys, kind='stable')
+        self._starts = np.searchsorted(keys[self._order],
+                                       np.arange(self._shape[0] * self._shape[1] + 1))
+
+        self._grid = _detect_grid(self.coords)
+        self._max_latitude = float(np.abs(self.coords[:, 0]).max())
+
+    @timed('nearest_points')
+    def nearest(self, queries: np.ndarray, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (distances, indices), two arrays of shape (queries, k) with the distances to
+        and the indices of the k nearest points to each (latitude, longitude) query, nearest
+        first. If there are fewer than k points, the rest are given distance inf and index -1.
+
+        All queries are searched at once, each in a growing ring of buckets around it. Queries
+        may be outside the area of the points, and longitudes wrap around the antimeridian.
+
+        >>> index = PointIndex(np.array([[0.0, 0.0], [0.0, 1.0], [5.0, 5.0]]))
+        >>> index.nearest(np.array([[0.0, 0.9]]), k=2)[1].tolist()
+        [[1, 0]]
+        >>> index = PointIndex(np.array([[50, -100], [50, -99], [51, -100], [51, -99]], float))
+        >>> index.nearest(np.array([[50.5, -60.0], [80.0, -99.6]]), k=3)[1].tolist()
+        [[3, 1, 2], [2, 3, 0]]
+        >>> index = PointIndex(np.array([[0.0, 179.9], [0.0, 170.0]]))
+        >>> distances, indices = index.nearest(np.array([[0.0, -179.9]]))
+        >>> (indices.tolist(), round(float(distances[0, 0]), 1))
+        ([[0]], 22.2)
+        """
+        queries = np.asarray(queries, dtype=float).reshape(-1, 2)
+        owner, copies = self._wrapped_copies(queries)
+        if len(owner) == len(queries):
+            return self._search(queries, k)
+
+        # keep the k nearest points found by the copies of each query, counting each point once
+        copy_distances, copy_indices = self._search(copies, k)
+        owner, found, d = _closest_first(np.repeat(owner, k), copy_indices.ravel(),
+                                         copy_distances.ravel())
+        rank = _ranks(np.bincount(owner, minlength=len(queries)))
+
+        distances = np.full((len(queries), k), np.inf)
+        indices = np.full((len(queries), k), -1)
+        keep = rank < k
+        distances[owner[keep], rank[keep]] = d[keep]
+        indices[owner[keep], rank[keep]] = found[keep]
+        return (distances, indices)
+
+    def _wrapped_copies(self, queries: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (owner, copies): the queries to search from for the given queries, where
+        owner gives the index of the query of each copy.
+
+        A point across the antimeridian is nearer to the query moved by 360 degrees, so each
+        query is copied as it is, and moved by 360 degrees either way when that copy is within
+        180 degrees of longitude of the points' area.
+        """
+        west, east = self._origin[1], self._origin[1] + self._shape[1] * self.bucket_size
+        shifts = np.array([0.0, 360.0, -360.0])
+        moved = queries[:, 1][:, np.newaxis] + shifts
+        use = (shifts == 0) | ((moved >= west - 180) & (moved <= east + 180))
+        owner, copy = np.nonzero(use)
+        return (owner, np.stack([queries[owner, 0], moved[owner, copy]], axis=1))
+
+    def _search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Return nearest(queries, k), without wrapping the longitudes of the queries."""
+        distances = np.full((len(queries), k), np.inf)
+        indices = np.full((len(queries), k), -1)
+
+        # start each query from the first ring that reaches any bucket, and stop at the latest
+        # with the ring that reaches every bucket
+        rows, cols = self._bucket(queries[:, 0], queries[:, 1])
+        rings = np.max([np.zeros_like(rows), -rows, rows - self._shape[0] + 1,
+                        -cols, cols - self._shape[1] + 1], axis=0)
+        max_rings = np.max([rows, self._shape[0] - 1 - rows, cols, self._shape[1] - 1 - cols],
+                           axis=0)
+        active = np.arange(len(queries))
+
+        while len(active) > 0:
+            owner, found = self._points_near(rows[active], cols[active], rings[active],
+                                             rings[active])
+            lat, lon = queries[active[owner], 0], queries[active[owner], 1]
+            d = haversine(lat, lon, self.coords[found, 0], self.coords[found, 1])
+
+            # sort the points found for each query by distance
+            order = np.lexsort((d, owner))
+            owner, found, d = owner[order], found[order], d[order]
+            counts = np.bincount(owner, minlength=len(active))
+            rank = _ranks(counts)
+
+            # the k nearest points are no further than the k-th nearest found so far, so they
+            # are all in the ring that reaches that far. Until k points are found, double the ring
+            enough = counts >= k
+            kth = np.full(len(active), np.inf)
+            kth[owner[rank == k - 1]] = d[rank == k - 1]
+            needed = np.where(enough, self._rings_reaching(queries[active, 0], kth,
+                                                           max_rings[active]),
+                              np.maximum(2 * rings[active], 1))
+            done = (rings[active] >= max_rings[active]) | (enough & (needed <= rings[active]))
+
+            keep = done[owner] & (rank < k)
+            distances[active[owner[keep]], rank[keep]] = d[keep]
+            indices[active[owner[keep]], rank[keep]] = found[keep]
+
+            rings[active] = np.minimum(needed, max_rings[active])
+            active = active[~done]
+
+        return (distances, indices)
+
+    @timed('points_within_radius')
+    def within_radius(self, queries: np.ndarray, radius: float) -> List[np.ndarray]:
+        """Return, for each (latitude, longitude) query, the indices of the points within radius
+        kilometres of it, nearest first. Longitudes wrap around the antimeridian, as in nearest.
+
+        >>> index = PointIndex(np.array([[-60.0, 178.0], [-60.0, 179.0], [-60.0, 170.0]]))
+        >>> [points.tolist() for points in index.within_radius(np.array([[-60.0, -179.5]]), 200)]
+        [[1, 0]]
+        """
+        queries = np.asarray(queries, dtype=float).reshape(-1, 2)
+        query_owner, copies = self._wrapped_copies(queries)
+        rows, cols = self._bucket(copies[:, 0], copies[:, 1])
+
+        # points more than lat_reach degrees of latitude or lon_reach degrees of longitude away
+        # are further than radius
+        lat_reach = radius / DEGREE_LENGTH
+        chord = radius / (2 * EARTH_RADIUS * np.cos(np.radians(
+            np.maximum(np.abs(copies[:, 0]), self._max_latitude))))
+        lon_reach = np.where(chord >= 1, 360, np.degrees(2 * np.arcsin(np.minimum(chord, 1))))
+
+        owner, found = self._points_near(
+            rows, cols, np.full(len(copies), int(np.ceil(lat_reach / self.bucket_size))),
+            np.ceil(lon_reach / self.bucket_size).astype(np.int64))
+        owner = query_owner[owner]
+        d = haversine(queries[owner, 0], queries[owner, 1],
+                      self.coords[found, 0], self.coords[found, 1])
+
+        close = d <= radius
+        owner, found, d = _closest_first(owner[close], found[close], d[close])
+        return np.split(found, np.cumsum(np.bincount(owner, minlength=len(queries)))[:-1])
+
+    def in_box(self, south: float, west: float, north: float, east: float) -> np.ndarray:
+        """Return the indices of the points with south <= latitude <= north and
+        west <= longitude <= east, in increasing order. If west > east, the box crosses the
+        antimeridian, and the points with longitude >= west or <= east are returned.
+
+        Preconditions:
+            - all(-180 <= lon <= 180 for lon in self.coords[:, 1])
+
+        >>> index = PointIndex(np.array([[0.0, 0.0], [1.0, 1.0], [2.0, 2.0]]))
+        >>> index.in_box(0.5, 0.5, 3, 3).tolist()
+        [1, 2]
+        >>> index = PointIndex(np.array([[0.0, 179.0], [0.0, -179.0], [0.0, 0.0]]))
+        >>> index.in_box(-1, 178, 1, -178).tolist()
+        [0, 1]
+        """
+        if west > east:
+            return np.union1d(self.in_box(south, west, north, 180.0),
+                              self.in_box(south, -180.0, north, east))
+
+        first_row, first_col = self._bucket(np.array([south]), np.array([west]))
+        last_row, last_col = self._bucket(np.array([north]), np.array([east]))
+
+        _, found = self._points_in(first_row, last_row, first_col, last_col)
+        lat, lon = self.coords[found, 0], self.coords[found, 1]
+        inside = (lat >= south) & (lat <= north) & (lon >= west) & (lon <= east)
+        return np.sort(found[inside])
+
+    def idw(self, queries: np.ndarray, k: int = 4, power: float = 2.0) -> np.ndarray:
+        """Return the values at each (latitude, longitude) query, interpolated by inverse
+        distance weighting of the k nearest points. A query exactly on a point gets its value.
+
+        Preconditions:
+            - self.values is not None
+        """
+        distances, indices = self.nearest(queries, k)
+        valid = indices >= 0
+        weights = np.where(valid, 1 / np.maximum(distances, 1e-12) ** power, 0)
+        weights /= weights.sum(axis=1, keepdims=True)
+
+        neighbours = self.values[np.where(valid, indices, 0)]
+        if neighbours.ndim == 3:
+            weights = weights[:, :, np.newaxis]
+        return (weights * neighbours).sum(axis=1)
+
+    def bilinear(self, queries: np.ndarray) -> np.ndarray:
+        """Return the values at each (latitude, longitude) query, interpolated bilinearly between
+        the 4 surrounding points of the regular grid the points lie on.
+
+        Queries that do not have all 4 surrounding points (because they are outside the grid, or
+        the points are missing, or the points are not on a regular grid) are interpolated with
+        idw instead.
+
+        Preconditions:
+            - self.values is not None
+        """
+        queries = np.asarray(queries, dtype=float).reshape(-1, 2)
+        result = np.full((len(queries),) + self.values.shape[1:], np.nan)
+        done = np.zeros(len(queries), dtype=bool)
+
+        if self._grid is not None:
+            latitudes, longitudes, point_at = self._grid
+            i = np.searchsorted(latitudes, queries[:, 0], side='right') - 1
+            j = np.searchsorted(longitudes, queries[:, 1], side='right') - 1
+            i = np.clip(i, 0, len(latitudes) - 2)
+            j = np.clip(j, 0, len(longitudes) - 2)
+
+            corners = np.stack([point_at[i, j], point_at[i, j + 1],
+                                point_at[i + 1, j], point_at[i + 1, j + 1]], axis=1)
+            fy = (queries[:, 0] - latitudes[i]) / (latitudes[i + 1] - latitudes[i])
+            fx = (queries[:, 1] - longitudes[j]) / (longitudes[j + 1] - longitudes[j])
+            done = (corners >= 0).all(axis=1) & (fy >= 0) & (fy <= 1) & (fx >= 0) & (fx <= 1)
+
+            weights = np.stack([(1 - fy) * (1 - fx), (1 - fy) * fx, fy * (1 - fx), fy * fx], 1)
+            corner_values = self.values[np.where(corners >= 0, corners, 0)][done]
+            if corner_values.ndim == 3:
+                weights = weights[:, :, np.newaxis]
+            result[done] = (weights[done] * corner_values).sum(axis=1)
+
+        if not done.all():
+            result[~done] = self.idw(queries[~done])
+
+        return result
+
+    def _bucket(self, lat: np.ndarray, lon: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the bucket (row, column) of the given point(s)."""
+        rows = np.floor((np.asarray(lat) - self._origin[0]) / self.bucket_size).astype(np.int64)
+        cols = np.floor((np.asarray(lon) - self._origin[1]) / self.bucket_size).astype(np.int64)
+        return (rows, cols)
+
+    def _rings_reaching(self, lats: np.ndarray, distances: np.ndarray,
+                        max_rings: np.ndarray) -> np.ndarray:
+        """Return, for each latitude lats[i], the smallest ring of buckets around it such that
+        every point outside the ring is further than distances[i] kilometres away (or
+        max_rings[i], if that ring is smaller).
+
+        A point outside ring r is either r buckets of latitude away, or r buckets of longitude
+        away at a latitude no further from the equator than the ring or the indexed points reach.
+        """
+        lats = np.abs(lats)
+        rings = np.ceil(np.degrees(np.minimum(distances / EARTH_RADIUS, np.pi))
+                        / self.bucket_size).astype(np.int64)
+
+        while True:
+            reach = np.minimum(rings * self.bucket_size, 180)
+            cos_lat = np.cos(np.radians(np.maximum(lats, np.minimum(lats + reach,
+                                                                    self._max_latitude))))
+            short = (2 * EARTH_RADIUS * cos_lat * np.sin(np.radians(reach) / 2) < distances) \
+                & (rings < max_rings)
+            if not short.any():
+                return np.minimum(rings, max_rings)
+
+            # the ring that would be far enough at the latitude reached so far
+            chord = distances[short] / (2 * EARTH_RADIUS * np.maximum(cos_lat[short], 1e-12))
+            lon_reach = np.degrees(2 * np.arcsin(np.minimum(chord, 1)))
+            rings[short] = np.maximum(rings[short] + 1,
+                                      np.ceil(lon_reach / self.bucket_size).astype(np.int64))
+
+    def _points_near(self, rows: np.ndarray, cols: np.ndarray, row_reach: np.ndarray,
+                     col_reach: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (owner, points): the indices of the points in the buckets at most row_reach[i]
+        rows and col_reach[i] columns away from bucket (rows[i], cols[i]), for every i, where
+        owner gives the i of each point.
+        """
+        return self._points_in(rows - row_reach, rows + row_reach,
+                               cols - col_reach, cols + col_reach)
+
+    def _points_in(self, first_rows: np.ndarray, last_rows: np.ndarray, first_cols: np.ndarray,
+                   last_cols: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (owner, points): the indices of the points in the buckets from row
+        first_rows[i] to last_rows[i] and column first_cols[i] to last_cols[i], for every i,
+        where owner gives the i of each point.
+        """
+        first_rows = np.maximum(first_rows, 0)
+        last_rows = np.minimum(last_rows, self._shape[0] - 1)
+        first_cols = np.maximum(first_cols, 0)
+        last_cols = np.minimum(last_cols, self._shape[1] - 1)
+
+        # the buckets of a row are consecutive, so each (i, row) pair is a single slice of points
+        row_counts = np.where(last_cols >= first_cols, np.maximum(last_rows - first_rows + 1, 0), 0)
+        pairs = np.repeat(np.arange(len(first_rows)), row_counts)
+        rows = first_rows[pairs] + _ranks(row_counts)
+        begin = self._starts[rows * self._shape[1] + first_cols[pairs]]
+        end = self._starts[rows * self._shape[1] + last_cols[pairs] + 1]
+
+        lengths = end - begin
+        owner = np.repeat(pairs, lengths)
+        return (owner, self._order[np.repeat(begin, lengths) + _ranks(lengths)])
+
+
+def _ranks(counts: np.ndarray) -> np.ndarray:
+    """Return the concatenation of range(count) for each count in counts.
+
+    >>> _ranks(np.array([2, 0, 3])).tolist()
+    [0, 1, 0, 1, 2]
+    """
+    return np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+
+def _closest_first(owner: np.ndarray, found: np.ndarray, distances: np.ndarray) \
+        -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return (owner, found, distances) sorted by owner and then by distance, keeping the first
+    of the points found more than once for the same owner. Points of index -1 (none found) are
+    all kept.
+
+    >>> [a.tolist() for a in _closest_first(np.array([1, 0, 0, 0]), np.array([4, 3, 2, 3]),
+    ...                                     np.array([1.0, 5.0, 7.0, 5.0]))]
+    [[0, 0, 1], [3, 2, 4], [5.0, 7.0, 1.0]]
+    """
+    order = np.lexsort((found, distances, owner))
+    owner, found, distances = owner[order], found[order], distances[order]
+    repeated = np.zeros(len(found), dtype=bool)
+    repeated[1:] = (owner[1:] == owner[:-1]) & (found[1:] == found[:-1]) & (found[1:] >= 0)
+    return (owner[~repeated], found[~repeated], distances[~repeated])
+
+
+def _detect_grid(coords: np.ndarray) -> Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Return (latitudes, longitudes, point_at) if the points lie on a regular grid with at least
+    2 rows and columns (some grid points may be missing), or None otherwise. point_at[i, j] is the
+    index of the point at (latitudes[i], longitudes[j]), or -1 if it is missing.
+    """
+    # round away floating point noise such as 43.08000000000001
+    latitudes, rows = np.unique(coords[:, 0].round(9), return_inverse=True)
+    longitudes, cols = np.unique(coords[:, 1].round(9), return_inverse=True)
+
+    if len(latitudes) < 2 or len(longitudes) < 2 \
+            or len(latitudes) * len(longitudes) > 4 * len(coords) \
+            or not np.allclose(np.diff(latitudes), latitudes[1] - latitudes[0]) \
+            or not np.allclose(np.diff(longitudes), longitudes[1] - longitudes[0]):
+        return None
+
+    point_at = np.full((len(latitudes), len(longitudes)), -1)
+    point_at[rows.ravel(), cols.ravel()] = np.arange(len(coords))
+    return (latitudes, longitudes, point_at)
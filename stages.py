@@ -0,0 +1,113 @@
+"""This module runs the project's pipeline as a sequence of stages:
+    1. predictions: the sea level predictions for the 4 temperature series
+    2. comparison: the locations below the predicted sea level in each decade
+    3. figure: the bubble map of the comparison
+Each stage's output can be cached with an ArtifactCache (see artifact_cache.py), so a stage only
+runs again when its datasets, parameters, code, or the stages before it change. For example,
+changing only the title of the map only rebuilds the figure.
+"""
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple
+from types import ModuleType
+import numpy as np
+import plotly.graph_objects as go
+import bubble
+import data_analysis
+import dataset_cleaner
+import ensembles
+import flooding
+import land_mask
+import sea_level_models
+from artifact_cache import ArtifactCache, stage_key
+
+# the dataset files read by the stages
+TEMPERATURE_FILE = 'datasets/Temperatures.py'
+SEA_LEVEL_FILE = 'datasets/global_timeseries_measures.nc.nc4'
+ALTITUDE_FILE = 'datasets/AltitudeData.py'
+
+# the modules whose code each stage depends on (the project modules they import are added by
+# stage_key), so editing the code of a later stage never changes the keys of the stages before it
+PREDICTION_MODULES = [flooding, data_analysis, ensembles, dataset_cleaner, sea_level_models]
+COMPARISON_MODULES = [flooding, land_mask]
+FIGURE_MODULES = [bubble]
+
+
+def run_pipeline(cache: Optional[ArtifactCache] = None, members: int = 0,
+                 seed: Optional[int] = None,
+                 title: str = 'Areas at risk of flooding in the next century',
+                 delta_frames: bool = False, land_only: bool = False,
+                 land_raster: Optional[str] = None, model: Optional[str] = None) -> go.Figure:
+    """Return the bubble map of the areas at risk of flooding, running only the stages whose
+    outputs are not in cache. Every stage runs if cache is None.
+
+    members and seed are passed on to compare_altitude_to_sea_level, and title to
+    build_figure. If delta_frames is True, the map is built by build_delta_figure instead, and
+    must be shown with post_script=bubble.DELTA_SCRIPT.
+
+    If land_only is True, water locations are left out of the comparison, using the land mask
+    saved next to the altitude dataset (see land_mask.py), made with land_raster if it is given.
+
+    If model is given, sea level is predicted with the model registered under that name in
+    sea_level_models.py instead of the model of data_analysis.py.
+
+    Editing bubble.py (which only the figure stage uses) leaves the keys of the predictions
+    and comparison stages unchanged:
+    >>> import artifact_cache
+    >>> def keys() -> list:
+    ...     return [stage_key(name, compute, {}, modules=modules) for name, compute, modules in
+    ...             [('predictions', flooding.prediction_creator, PREDICTION_MODULES),
+    ...              ('comparison', flooding.compare_altitude_to_sea_level, COMPARISON_MODULES),
+    ...              ('figure', bubble.build_figure, FIGURE_MODULES)]]
+    >>> before = keys()
+    >>> file_hash = artifact_cache.file_hash
+    >>> artifact_cache.file_hash = lambda filename: ('edited' if filename == bubble.__file__
+    ...                                              else file_hash(filename))
+    >>> [old == new for old, new in zip(before, keys())]
+    [True, True, False]
+    >>> artifact_cache.file_hash = file_hash
+    """
+    stage = _uncached if cache is None else cache.stage
+
+    predictions_key, predictions = stage(
+        'predictions',
+        lambda: (flooding.ensemble_prediction_creator(members, seed, model=model) if members > 0
+                 else flooding.prediction_creator() if model is None
+                 else flooding.model_prediction_creator(model)),
+        {'members': members, 'seed': seed, 'model': model},
+        files=[TEMPERATURE_FILE, SEA_LEVEL_FILE],
+        modules=PREDICTION_MODULES)
+
+    comparison_key, comparison = stage(
+        'comparison',
+        lambda: flooding.compare_altitude_to_sea_level(
+            _altitude_data(), members, seed, predictions, compact=True,
+            land=_land(land_raster) if land_only else None),
+        {'predictions': predictions_key, 'land_only': land_only, 'land_raster': land_raster},
+        files=[ALTITUDE_FILE] + ([land_raster] if land_only and land_raster else []),
+        modules=COMPARISON_MODULES)
+
+    _, figure = stage(
+        'figure',
+        lambda: (bubble.build_delta_figure(comparison, title) if delta_frames
+                 else bubble.build_figure(comparison.to_long(), title)),
+        {'comparison': comparison_key, 'title': title, 'delta_frames': delta_frames},
+        modules=FIGURE_MODULES)
+
+    return figure
+
+
+def _uncached(name: str, compute: Callable[[], Any], inputs: Dict[str, Any],
+              files: Sequence[str] = (), modules: Sequence[ModuleType] = ()) -> Tuple[str, Any]:
+    """Return (key, output) like ArtifactCache.stage, but always call compute."""
+    return (stage_key(name, compute, inputs, files, modules), compute())
+
+
+def _land(land_raster: Optional[str]) -> np.ndarray:
+    """Return the land mask of the altitude dataset."""
+    coords, elevations = flooding.altitude_arrays(_altitude_data())
+    return land_mask.land_mask(coords, elevations, ALTITUDE_FILE, land_raster)
+
+
+def _altitude_data() -> Dict:
+    """Return the altitude dataset, which is only imported when a stage needs it."""
+    from datasets.AltitudeData import altitude_data
+    return altitude_data
@@ -0,0 +1,125 @@
+"""This module compares any map area to the predicted sea level, one tile at a time in parallel.
+
+main.py compares one 50 * 50 grid of points over Canada. Here, any map area, including one that
+crosses the antimeridian or covers the whole globe, is split into tiles (see MapArea.tiles), and
+each tile's own grid of points is fetched and compared by a pool of worker processes,
+independently of the other tiles. The results of the tiles are then stitched together into one
+FloodResult (see FloodResult.concatenate).
+
+Every location is given the predictions of the quadrant of the whole map it lies in (or of its
+region, if regions are given), so splitting the map into more tiles only adds points: the
+predictions of each location do not depend on its tile. Each worker opens its own elevation
+source once, when it starts: the elevation API, or a local raster file, which is read only
+around the points of each tile.
+
+Run it with, for example:
+    python tiled.py --dem world.asc --latitude -60 75 --longitude -180 180 --tiles 8 16
+"""
+from typing import Dict, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import os
+from altitudes import split_into_grid, get_midpoints
+from elevation_sources import ElevationSource, ApiElevationSource, RasterElevationSource
+from flooding import FloodResult, compare_altitude_to_sea_level, prediction_creator, \
+    ensemble_prediction_creator, regional_prediction_creator, region_temperatures
+from map_setup import MapArea
+from regions import RegionIndex
+from instrumentation import timed, count
+
+# the elevation source of this worker process, opened by _open_source
+_worker_source = {}
+
+
+@timed()
+def run_tiled(my_map: MapArea, tiles: Tuple[int, int] = (4, 4), points: int = 50,
+              dem: Optional[str] = None, predictions: Optional[tuple] = None, members: int = 0,
+              seed: Optional[int] = None, regions: Optional[RegionIndex] = None,
+              processes: Optional[int] = None) -> FloodResult:
+    """Return the comparison of the locations of my_map to the predicted sea level, with my_map
+    split into tiles[0] rows and tiles[1] columns of tiles, each sampled with a grid of
+    points * points locations.
+
+    The altitudes are read from the raster file dem, or from the elevation API if dem is None,
+    and the tiles are processed by processes worker processes (one per CPU by default).
+    predictions, members, seed and regions are used as in compare_altitude_to_sea_level, and
+    the predictions are computed once for every tile if they are not given.
+
+    Preconditions:
+        - tiles[0] >= 1 and tiles[1] >= 1
+        - points >= 1
+        - processes is None or processes >= 1
+    """
+    if predictions is None:
+        temps = None if regions is None else region_temperatures(regions)
+        if members > 0:
+            predictions = ensemble_prediction_creator(members, seed, temps)
+        elif regions is None:
+            predictions = prediction_creator()
+        else:
+            predictions = regional_prediction_creator(temps)
+
+    areas = my_map.tiles(*tiles)
+    with ProcessPoolExecutor(max_workers=min(processes or os.cpu_count(), len(areas)),
+                             initializer=_open_source, initargs=(dem,)) as executor:
+        results = list(executor.map(_compare_tile, areas, [points] * len(areas),
+                                    [my_map] * len(areas), [predictions] * len(areas),
+                                    [members] * len(areas), [regions] * len(areas)))
+
+    return FloodResult.concatenate(results)
+
+
+def tile_altitudes(tile: MapArea, points: int, source: ElevationSource) \
+        -> Dict[Tuple[float, float], float]:
+    """Return the altitudes of the points * points grid of tile, read from source, in the same
+    format as get_altitude_data.
+    """
+    locations = [point.coords for point in get_midpoints(split_into_grid(points, points, tile),
+                                                         tile)]
+    return {location: altitude for location, altitude in zip(locations, source.sample(locations))
+            if altitude is not None}
+
+
+def _open_source(dem: Optional[str]) -> None:
+    """Open the elevation source of this worker process."""
+    _worker_source['source'] = ApiElevationSource() if dem is None \
+        else RasterElevationSource(dem)
+
+
+def _compare_tile(tile: MapArea, points: int, my_map: MapArea, predictions: tuple,
+                  members: int, regions: Optional[RegionIndex]) -> FloodResult:
+    """Return the comparison of the grid of points of tile, a tile of my_map."""
+    altitudes = tile_altitudes(tile, points, _worker_source['source'])
+    count('tiles')
+    return compare_altitude_to_sea_level(altitudes, members, predictions=predictions,
+                                         regions=regions, compact=True, my_map=my_map)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare a map area to the predicted sea level '
+                                                 'in tiles.')
+    parser.add_argument('--latitude', type=float, nargs=2, default=[40.0, 84.0],
+                        metavar=('SOUTH', 'NORTH'), help='the latitudes of the map')
+    parser.add_argument('--longitude', type=float, nargs=2, default=[-146.0, -50.0],
+                        metavar=('WEST', 'EAST'),
+                        help='the longitudes of the map (WEST > EAST crosses the antimeridian)')
+    parser.add_argument('--tiles', type=int, nargs=2, default=[4, 4], metavar=('ROWS', 'COLS'),
+                        help='the number of tiles to split the map into')
+    parser.add_argument('--points', type=int, default=50,
+                        help='sample each tile with a grid of POINTS * POINTS locations')
+    parser.add_argument('--dem', help='read altitudes from this raster instead of the API')
+    parser.add_argument('--members', type=int, default=0,
+                        help='predict with an ensemble of this many members')
+    parser.add_argument('--processes', type=int, help='the number of worker processes')
+    parser.add_argument('--output', help='save the result to this .npz file instead of drawing it')
+    args = parser.parse_args()
+
+    area = MapArea(tuple(args.latitude), tuple(args.longitude))
+    result = run_tiled(area, tuple(args.tiles), args.points, args.dem, members=args.members,
+                       processes=args.processes)
+
+    if args.output is None:
+        import bubble
+        bubble.draw_map(result.to_long(), area)
+    else:
+        result.save(args.output)